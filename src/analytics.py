@@ -0,0 +1,64 @@
+"""
+Email Analytics
+Counts per status / priority / sentiment and per-hour received/replied volume live
+in small rollup tables (email_rollups, email_hourly), so the dashboard reads a few
+dozen rows instead of walking every email. Triggers on the emails table (db.py)
+apply a +1/-1 to the affected rollup rows on every insert, delete or change of a
+counted column, so they are always current and no writer has to refresh them.
+
+Usage: python analytics.py   (full rebuild from the emails table)
+"""
+
+from datetime import datetime, timedelta
+from sqlalchemy import func, select
+from db import ROLLUP_METRICS, engine, read_engine, init_db, rebuild_rollups
+from models import Email, EmailRollup, EmailHourly
+
+
+def _seconds_between(start, end):
+    if engine.dialect.name == "postgresql":
+        return func.extract("epoch", end - start)
+    return (func.julianday(end) - func.julianday(start)) * 86400
+
+
+def get_counts() -> dict:
+    """{"status": {"pending": 3, ...}, "priority": {...}, "sentiment": {...}}"""
+    counts = {metric: {} for metric in ROLLUP_METRICS}
+    with read_engine.connect() as conn:
+        for metric, value, count in conn.execute(select(EmailRollup.metric, EmailRollup.value, EmailRollup.count)):
+            # Values whose last email changed away stay behind with a count of 0
+            if count:
+                counts.setdefault(metric, {})[value] = count
+    return counts
+
+
+def get_hourly(hours=48):
+    since = (datetime.now() - timedelta(hours=hours)).replace(minute=0, second=0, microsecond=0)
+    with read_engine.connect() as conn:
+        return conn.execute(
+            select(EmailHourly.bucket, EmailHourly.received, EmailHourly.replied)
+            .where(EmailHourly.bucket >= since)
+            .order_by(EmailHourly.bucket)
+        ).all()
+
+
+def median_reply_seconds(days=30):
+    """Median date_received -> date_sent over replies sent in the last `days`.
+
+    Uses the (status, date_sent) index for the window plus one ORDER BY ... LIMIT 1
+    OFFSET n/2, so the cost follows recent reply volume rather than table size.
+    """
+    since = datetime.now() - timedelta(days=days)
+    window = (Email.status == "replied", Email.date_sent >= since, Email.date_received != None)
+    with read_engine.connect() as conn:
+        n = conn.execute(select(func.count()).select_from(Email).where(*window)).scalar_one()
+        if not n:
+            return None
+        latency = _seconds_between(Email.date_received, Email.date_sent)
+        return conn.execute(select(latency).where(*window).order_by(latency).limit(1).offset(n // 2)).scalar_one()
+
+
+if __name__ == "__main__":
+    init_db()
+    rebuild_rollups(engine)
+    print("✅ Analytics rollups rebuilt.")
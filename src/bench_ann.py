@@ -0,0 +1,95 @@
+"""
+ANN Index Benchmark
+Measures recall@k and per-query latency of the KB index types (flat, IVF-Flat,
+IVF-PQ, HNSW) over a synthetic corpus shaped like normalised MiniLM embeddings,
+sweeping nprobe / efSearch so a setting can be picked for a given KB size.
+
+Usage: python bench_ann.py [--docs 100000] [--queries 500] [--k 5]
+"""
+
+import argparse
+import time
+import faiss
+import numpy as np
+from kb_index import make_index, set_search_params, index_type_of
+
+
+def synthetic_corpus(n_docs, n_queries, dim, n_topics, seed=0):
+    """Clustered unit vectors, with queries drawn as noisy copies of random docs."""
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(n_topics, dim)).astype("float32")
+    docs = topics[rng.integers(0, n_topics, n_docs)] + 0.6 * rng.normal(size=(n_docs, dim)).astype("float32")
+    docs /= np.linalg.norm(docs, axis=1, keepdims=True)
+    queries = docs[rng.integers(0, n_docs, n_queries)] + 0.3 * rng.normal(size=(n_queries, dim)).astype("float32")
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return docs, queries.astype("float32")
+
+
+def recall_at_k(found, truth, k):
+    hits = sum(len(set(f[:k]) & set(t[:k])) for f, t in zip(found, truth))
+    return hits / (k * len(truth))
+
+
+def run(index, queries, k):
+    # One query at a time, like the drafting path does
+    latencies = []
+    found = []
+    for q in queries:
+        start = time.perf_counter()
+        _, I = index.search(q[None, :], k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        found.append(I[0])
+    latencies.sort()
+    return found, latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--topics", type=int, default=2000)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=1, help="FAISS OpenMP threads during search")
+    args = parser.parse_args()
+
+    print(f"Generating {args.docs} docs x {args.dim} dims, {args.queries} queries...")
+    docs, queries = synthetic_corpus(args.docs, args.queries, args.dim, args.topics)
+    ids = np.arange(args.docs, dtype="int64")
+
+    sweeps = {
+        "flat": [None],
+        "ivf_flat": [1, 4, 16, 64],
+        "ivf_pq": [1, 4, 16, 64],
+        "hnsw": [16, 32, 64, 128],
+    }
+
+    truth = None
+    build_threads = faiss.omp_get_max_threads()
+    print(f"{'index':<10} {'param':>10} {'build s':>9} {'recall@' + str(args.k):>10} {'p50 ms':>8} {'p95 ms':>8}")
+    for index_type, params in sweeps.items():
+        start = time.perf_counter()
+        index = make_index(docs, index_type)
+        index.add_with_ids(docs, ids)
+        build_s = time.perf_counter() - start
+        faiss.omp_set_num_threads(args.threads)
+
+        for param in params:
+            if index_type == "hnsw":
+                set_search_params(index, ef_search=param)
+                label = f"ef={param}"
+            elif param is not None:
+                set_search_params(index, nprobe=param)
+                label = f"nprobe={param}"
+            else:
+                label = "-"
+            found, p50, p95 = run(index, queries, args.k)
+            if truth is None:
+                truth = found
+            recall = recall_at_k(found, truth, args.k)
+            print(f"{index_type_of(index):<10} {label:>10} {build_s:>9.1f} {recall:>10.3f} {p50:>8.3f} {p95:>8.3f}")
+        faiss.omp_set_num_threads(build_threads)
+
+
+if __name__ == "__main__":
+    main()
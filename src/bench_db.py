@@ -0,0 +1,124 @@
+"""
+Database Concurrency Benchmark
+Runs writer and reader processes against one database at the same time, the way
+the fetcher, the NLP pass and several dashboard sessions do, and reports commits/s,
+reads/s, p95 commit latency and "database is locked" errors. On SQLite it compares
+a plain engine (rollback journal, library defaults) with the tuned engine from
+db.make_engine (WAL, synchronous=NORMAL, busy_timeout, mmap and cache size).
+
+Usage: python bench_db.py [--writers 4] [--readers 8] [--seconds 10] [--batch 50] [--url URL]
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import statistics
+import tempfile
+import time
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from db import make_engine
+
+CREATE = "CREATE TABLE IF NOT EXISTS bench_rows (id {id_type} PRIMARY KEY, worker INTEGER, payload TEXT, created_at FLOAT)"
+INSERT = text("INSERT INTO bench_rows (worker, payload, created_at) VALUES (:worker, :payload, :created_at)")
+READS = [
+    text("SELECT COUNT(*) FROM bench_rows"),
+    text("SELECT worker, COUNT(*) FROM bench_rows GROUP BY worker"),
+    text("SELECT id, payload FROM bench_rows ORDER BY id DESC LIMIT 50"),
+]
+
+
+def _writer(url, tuned, worker, seconds, batch, results):
+    eng = make_engine(url, tuned=tuned)
+    payload = "x" * 2000
+    latencies, errors = [], 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        rows = [{"worker": worker, "payload": payload, "created_at": time.time()} for _ in range(batch)]
+        start = time.perf_counter()
+        try:
+            with eng.begin() as conn:
+                conn.execute(INSERT, rows)
+            latencies.append(time.perf_counter() - start)
+        except OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            errors += 1
+    results.put(("write", latencies, errors))
+
+
+def _reader(url, tuned, seconds, results):
+    eng = make_engine(url, read_only=True, tuned=tuned)
+    done, errors = 0, 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        try:
+            with eng.connect() as conn:
+                for q in READS:
+                    conn.execute(q).all()
+            done += 1
+        except OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            errors += 1
+    results.put(("read", done, errors))
+
+
+def run(url, tuned, writers, readers, seconds, batch):
+    eng = make_engine(url, tuned=tuned)
+    with eng.begin() as conn:
+        if url.startswith("sqlite") and not tuned:
+            conn.execute(text("PRAGMA journal_mode=DELETE"))
+        conn.execute(text(CREATE.format(id_type="SERIAL" if eng.dialect.name == "postgresql" else "INTEGER")))
+        conn.execute(text("DELETE FROM bench_rows"))
+    eng.dispose()
+
+    results = mp.Queue()
+    procs = [mp.Process(target=_writer, args=(url, tuned, i, seconds, batch, results)) for i in range(writers)]
+    procs += [mp.Process(target=_reader, args=(url, tuned, seconds, results)) for _ in range(readers)]
+    for p in procs:
+        p.start()
+    collected = [results.get() for _ in procs]
+    for p in procs:
+        p.join()
+
+    latencies = [lat for kind, lats, _ in collected if kind == "write" for lat in lats]
+    reads = sum(n for kind, n, _ in collected if kind == "read")
+    errors = sum(err for _, _, err in collected)
+    p95 = statistics.quantiles(latencies, n=20)[-1] * 1000 if len(latencies) >= 2 else float("nan")
+    return {
+        "commits_s": len(latencies) / seconds,
+        "rows_s": len(latencies) * batch / seconds,
+        "reads_s": reads / seconds,
+        "p95_ms": p95,
+        "locked": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--batch", type=int, default=50, help="rows per write transaction")
+    parser.add_argument("--url", help="database to benchmark (default: throwaway SQLite files)")
+    args = parser.parse_args()
+
+    if args.url:
+        modes = [("configured", args.url, True)]
+    else:
+        tmp = tempfile.mkdtemp(prefix="bench_db_")
+        # Separate files, because journal_mode=WAL is persisted in the database file
+        modes = [("sqlite default", f"sqlite:///{os.path.join(tmp, 'default.sqlite')}", False),
+                 ("sqlite tuned", f"sqlite:///{os.path.join(tmp, 'tuned.sqlite')}", True)]
+
+    print(f"{args.writers} writers x {args.batch} rows/commit, {args.readers} readers, {args.seconds:.0f}s")
+    print(f"{'mode':<16}{'commits/s':>11}{'rows/s':>10}{'reads/s':>10}{'p95 commit':>12}{'locked':>8}")
+    for name, url, tuned in modes:
+        r = run(url, tuned, args.writers, args.readers, args.seconds, args.batch)
+        print(f"{name:<16}{r['commits_s']:>11.1f}{r['rows_s']:>10.0f}{r['reads_s']:>10.1f}"
+              f"{r['p95_ms']:>10.1f}ms{r['locked']:>8}")
+
+
+if __name__ == "__main__":
+    main()
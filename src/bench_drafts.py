@@ -0,0 +1,82 @@
+"""
+Draft Worker Benchmark
+Starts fake_llm.py in-process and drafts synthetic emails through the real Gemini
+client and draft_worker's concurrency, rate limiting and retry logic, first one at
+a time and then concurrently. Drafts are counted rather than written to the database.
+
+Usage: python bench_drafts.py [--emails 100] [--concurrency 16] [--latency-ms 300]
+                              [--throttle-rate 0.1] [--error-rate 0.05] [--rate 0]
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from types import SimpleNamespace
+import fake_llm
+
+
+class CountingWriter:
+    def __init__(self):
+        self.saved = 0
+
+    async def add(self, email_id, draft):
+        self.saved += 1
+
+    async def flush(self):
+        pass
+
+
+def synthetic_emails(n):
+    return [SimpleNamespace(id=f"BENCH{i:05d}", sender=f"user{i}@example.com", subject=f"Order {i} has not arrived",
+                            body="Hi, I ordered a laptop two weeks ago and it still has not been delivered. " * 5,
+                            sentiment="Negative", priority="Urgent") for i in range(n)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--rate", type=float, default=0, help="max requests per minute, 0 for no limit")
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--throttle-rate", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--max-retries", type=int, default=5)
+    parser.add_argument("--skip-sequential", action="store_true")
+    args = parser.parse_args()
+
+    server = fake_llm.start(latency_ms=args.latency_ms, throttle_rate=args.throttle_rate, error_rate=args.error_rate)
+    # The Gemini client reads these when first configured, so set them before importing the worker
+    os.environ.update(GOOGLE_API_KEY="fake", GEMINI_TRANSPORT="rest",
+                      GEMINI_API_ENDPOINT=f"http://127.0.0.1:{server.server_port}")
+    from draft_worker import RateLimiter, draft_emails
+    from responder import generate_with_gemini
+
+    emails = synthetic_emails(args.emails)
+    contexts = [[] for _ in emails]
+    generate_with_gemini("warm up the client")
+
+    runs = [] if args.skip_sequential else [("sequential", 1)]
+    runs.append((f"concurrency {args.concurrency}", args.concurrency))
+    print(f"{args.emails} emails, fake LLM latency {args.latency_ms:.0f} ms, "
+          f"{args.throttle_rate:.0%} throttled, {args.error_rate:.0%} errors")
+    for name, concurrency in runs:
+        writer = CountingWriter()
+
+        async def run():
+            from concurrent.futures import ThreadPoolExecutor
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=concurrency + 2))
+            return await draft_emails(emails, contexts, writer, generate_with_gemini, concurrency,
+                                      RateLimiter(args.rate), max_retries=args.max_retries)
+
+        start = time.perf_counter()
+        stats = asyncio.run(run())
+        elapsed = time.perf_counter() - start
+        print(f"{name:<16} {elapsed:7.1f}s  {stats['drafted'] / elapsed:6.1f} drafts/s  "
+              f"drafted={stats['drafted']} failed={stats['failed']} retries={stats['retries']}")
+    print(f"fake LLM: {server.counts}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Fetch Benchmark
+Ingests the mailbox of fake_imap.py (every fourth message carries a --attach-kb
+PDF) twice: once the old way, downloading and parsing each message's full RFC822
+source, and once through imap_fetcher.sync_folder, which reads BODYSTRUCTURE and
+downloads only the text parts. Reports bytes sent by the server, time and peak
+Python memory (tracemalloc) for each.
+
+Usage: python bench_fetch.py [--messages 100] [--attach-kb 2048] [--chunk 50]
+"""
+
+import argparse
+import os
+import tempfile
+
+# Use a scratch database; db.py reads DB_PATH on import
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench_fetch_"), "bench.sqlite")
+os.environ.pop("DB_URL", None)
+
+import imaplib
+import time
+import tracemalloc
+from sqlalchemy import func, select
+import fake_imap
+from db import engine, init_db
+from models import Attachment, Email
+from imap_fetcher import _chunks, _fetch_raw, _parse_message, select_folder, sync_folder
+
+
+def full_source(m, uids, chunk):
+    for part in _chunks(uids, chunk):
+        for _, raw in _fetch_raw(m, part):
+            _parse_message(raw)
+
+
+def measure(name, server, fn):
+    sent_before = server.counts["bytes"]
+    tracemalloc.start()
+    started = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{name:<22} {(server.counts['bytes'] - sent_before) / 1e6:9.1f} MB sent  {elapsed:6.2f}s  "
+          f"peak {peak / 1e6:7.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--attach-kb", type=int, default=2048)
+    parser.add_argument("--chunk", type=int, default=50)
+    args = parser.parse_args()
+
+    server = fake_imap.start(messages=args.messages, attach_kb=args.attach_kb)
+    init_db()
+    m = imaplib.IMAP4("127.0.0.1", server.server_address[1])
+    m.login("bench", "bench")
+    uidvalidity = select_folder(m, "INBOX")
+    uids = sorted(server.mailbox)
+
+    print(f"{args.messages} messages, {args.messages // 4} with a {args.attach_kb} KB attachment, chunks of {args.chunk}")
+    measure("full RFC822 source", server, lambda: full_source(m, uids, args.chunk))
+    measure("BODYSTRUCTURE + text", server,
+            lambda: sync_folder(m, "INBOX", uidvalidity, limit=len(uids), backfill=True, chunk_size=args.chunk, workers=1))
+    with engine.connect() as conn:
+        stored = conn.execute(select(func.count()).select_from(Email)).scalar_one()
+        attachments = conn.execute(select(func.count()).select_from(Attachment)).scalar_one()
+    print(f"stored {stored} emails and {attachments} attachment records")
+    m.logout()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+IDLE Push Benchmark
+Runs the imap_idle.py listener against fake_imap.py with a throwaway database and
+exercises the push path end to end: each message delivered to the server is
+announced to the idling listener with "* N EXISTS", fetched by sync_folder and
+analyzed; the report is the time from delivery until the row is stored. Then the
+server drops the IDLE connection and a message arrives while the listener backs
+off and reconnects, which the catch-up sync after reconnecting must pick up.
+
+Usage: python bench_idle.py [--deliveries 5] [--messages 20] [--timeout 30]
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+# Use a scratch database and point the listener at the fake server; config.py reads
+# these on import
+PORT = free_port()
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench_idle_"), "bench.sqlite")
+os.environ.pop("DB_URL", None)
+os.environ.update(IMAP_SSL="0", IMAP_HOST="127.0.0.1", IMAP_PORT=str(PORT),
+                  IMAP_USER="bench", IMAP_PASS="bench", IMAP_FOLDER="INBOX")
+
+from sqlalchemy import func, select
+import fake_imap
+import imap_idle
+from db import engine, init_db
+from models import Email
+
+
+def stored(message_ids) -> int:
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(Email)
+                            .where(Email.message_id.in_(message_ids))).scalar_one()
+
+
+def wait_for(check, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if check():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def message_ids(server, uids):
+    return [server.mailbox[uid][1]["Message-ID"] for uid in uids]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--deliveries", type=int, default=5)
+    parser.add_argument("--messages", type=int, default=20, help="mail already in the INBOX when the listener starts")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for each step")
+    args = parser.parse_args()
+
+    server = fake_imap.start(PORT, messages=args.messages, attach_kb=16)
+    init_db()
+    threading.Thread(target=imap_idle.run, daemon=True).start()
+
+    def idling_since(count):
+        return lambda: server.counts["idles"] > count
+
+    initial = message_ids(server, server.uids())
+    if not wait_for(lambda: stored(initial) == len(initial), args.timeout) or not wait_for(idling_since(0), args.timeout):
+        print(f"❌ Listener did not catch up on the {len(initial)} existing messages and enter IDLE.")
+        sys.exit(1)
+
+    latencies = []
+    for _ in range(args.deliveries):
+        idles = server.counts["idles"]
+        started = time.perf_counter()
+        new = message_ids(server, server.deliver(1))
+        if not wait_for(lambda: stored(new) == 1, args.timeout):
+            print("❌ A delivered message was not stored; the IDLE push path is broken.")
+            sys.exit(1)
+        latencies.append((time.perf_counter() - started) * 1000)
+        # Wait for the listener to re-enter IDLE before the next delivery
+        wait_for(idling_since(idles), args.timeout)
+
+    connections = server.counts["connections"]
+    idles = server.counts["idles"]
+    server.drop_idle()
+    started = time.perf_counter()
+    new = message_ids(server, server.deliver(1))
+    if not wait_for(lambda: stored(new) == 1, args.timeout) or not wait_for(idling_since(idles), args.timeout):
+        print("❌ Listener did not reconnect and catch up after the server dropped the connection.")
+        sys.exit(1)
+    recovery = time.perf_counter() - started
+
+    print(f"{len(initial)} existing messages caught up, {args.deliveries} pushed deliveries")
+    print(f"delivery -> stored: median {statistics.median(latencies):.0f} ms, max {max(latencies):.0f} ms")
+    print(f"dropped connection -> reconnected and caught up: {recovery:.1f}s "
+          f"({server.counts['connections'] - connections} new connection)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Import-time Benchmark
+Imports each entry-point module in a fresh interpreter with `python -X importtime`
+and checks its cumulative import time against a budget. Exits non-zero when a
+module is over budget, so it can run in CI.
+
+Usage: python bench_import.py [--budget-ms 1000] [--top 5] [module ...]
+"""
+
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+# Modules whose import cost every script or Streamlit worker pays up front
+DEFAULT_MODULES = ["db", "kb_index", "nlp", "responder", "draft_worker", "imap_fetcher", "setup_kb"]
+
+
+def import_times(module):
+    """Return [(cumulative_us, depth, name)] for the imports made while importing `module`.
+
+    Interpreter start-up imports (site, encodings, ...) are dropped; depth 0 is
+    `module` itself and depth 1 its direct imports.
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=Path(__file__).parent, capture_output=True, text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr.strip().splitlines()[-1]}")
+    times = []
+    for line in proc.stderr.splitlines():
+        # "import time:   self [us] |  cumulative | imported package"
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nesting is shown as two extra spaces of indentation per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((int(cumulative), depth, name.strip()))
+    # Entries are listed children-first; the module's own block starts after the previous top-level entry
+    end = next(i for i, t in enumerate(times) if t[1] == 0 and t[2] == module)
+    start = max((i for i, t in enumerate(times[:end]) if t[1] == 0), default=-1) + 1
+    return times[start:end + 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=DEFAULT_MODULES)
+    parser.add_argument("--budget-ms", type=float, default=1000)
+    parser.add_argument("--top", type=int, default=5, help="show the N slowest direct imports per module")
+    args = parser.parse_args()
+
+    over = []
+    for module in args.modules:
+        times = import_times(module)
+        total_ms = times[-1][0] / 1000
+        status = "OK  " if total_ms <= args.budget_ms else "OVER"
+        print(f"{status} {module:<14} {total_ms:8.1f} ms")
+        heaviest = sorted((t for t in times if t[1] == 1), reverse=True)[:args.top]
+        for us, _, name in heaviest:
+            print(f"       {name:<30} {us / 1000:8.1f} ms")
+        if total_ms > args.budget_ms:
+            over.append(module)
+
+    if over:
+        print(f"❌ Over the {args.budget_ms:.0f} ms import budget: {', '.join(over)}")
+        sys.exit(1)
+    print(f"✅ All modules import within {args.budget_ms:.0f} ms.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+KB Retrieval Micro-benchmark
+Compares cold (fresh retriever: model load + index read) against warm query latency,
+with an empty persistent query embedding cache for the cold run. Runs in a
+throwaway directory with its own database, sample KB (setup_kb.py) and index, so
+the real query embedding cache and KB index are left alone.
+
+Usage: python bench_kb.py [--runs 20] [--query "how do I reset my password"]
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+# db.py and kb_index.py keep data/ relative to the working directory and read the
+# database URL on import; setting DB_URL here also keeps a .env value from applying
+os.chdir(tempfile.mkdtemp(prefix="bench_kb_"))
+os.environ["DB_URL"] = os.environ["DB_READ_URL"] = f"sqlite:///{os.path.abspath('data/bench.sqlite')}"
+
+from db import init_db
+from kb_index import KBRetriever
+from setup_kb import create_sample_kb_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--query", default="I cannot log in and need to reset my password")
+    parser.add_argument("--top-k", type=int, default=2)
+    args = parser.parse_args()
+
+    init_db()
+    create_sample_kb_data(auto_mode=True)
+    retriever = KBRetriever()
+
+    start = time.perf_counter()
+    retriever.search(args.query, args.top_k)
+    cold_ms = (time.perf_counter() - start) * 1000
+
+    warm = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        retriever.search(args.query, args.top_k)
+        warm.append((time.perf_counter() - start) * 1000)
+
+    warm.sort()
+    p95 = warm[min(len(warm) - 1, int(len(warm) * 0.95))]
+    print(f"cold query:  {cold_ms:9.1f} ms")
+    print(f"warm median: {statistics.median(warm):9.1f} ms")
+    print(f"warm p95:    {p95:9.1f} ms")
+    print(f"speedup:     {cold_ms / statistics.median(warm):9.1f}x")
+    print(f"embedding cache: {retriever.cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
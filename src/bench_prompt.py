@@ -0,0 +1,62 @@
+"""
+Prompt Size Benchmark
+Compares drafting prompt sizes for emails in the database: the whole body plus the
+whole retrieved KB documents (as before prompts.py) against the budgeted prompt,
+reporting estimated tokens p50/p95/max and the build time per prompt.
+
+Usage: python bench_prompt.py [--limit 500] [--top-k 2] [--budget 2000]
+"""
+
+import argparse
+import time
+from sqlalchemy import select
+from db import SessionLocal, init_db
+from models import Email
+from kb_index import query_kb_batch
+from prompts import PROMPT_TEMPLATE, build_prompt, estimate_tokens
+from config import PROMPT_TOKEN_BUDGET
+
+
+def unbudgeted(email, docs):
+    return PROMPT_TEMPLATE.format(history="", subject=email.subject, body=email.body,
+                                  sentiment=email.sentiment, priority=email.priority,
+                                  context="\n".join(docs) or "No extra context.")
+
+
+def percentiles(values):
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return f"p50 {pick(0.5):>6,}  p95 {pick(0.95):>6,}  max {values[-1]:>7,}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--limit", type=int, default=500)
+    parser.add_argument("--top-k", type=int, default=2)
+    parser.add_argument("--budget", type=int, default=PROMPT_TOKEN_BUDGET)
+    args = parser.parse_args()
+
+    init_db()
+    session = SessionLocal()
+    try:
+        emails = session.execute(select(Email).order_by(Email.date_received.desc()).limit(args.limit)).scalars().all()
+    finally:
+        session.close()
+    if not emails:
+        print("❌ No emails in the database; fetch some first.")
+        return
+    hits = query_kb_batch([f"{em.subject} {em.body}" for em in emails], top_k=args.top_k)
+    contexts = [[h["content"] for h in hs] for hs in hits]
+
+    before = [estimate_tokens(unbudgeted(em, docs)) for em, docs in zip(emails, contexts)]
+    started = time.perf_counter()
+    after = [build_prompt(em, docs, budget=args.budget)[1]["tokens"] for em, docs in zip(emails, contexts)]
+    build_ms = (time.perf_counter() - started) * 1000 / len(emails)
+
+    print(f"{len(emails)} emails, top {args.top_k} KB docs, budget {args.budget} tokens")
+    print(f"whole body + docs  {percentiles(before)}")
+    print(f"budgeted           {percentiles(after)}   ({build_ms:.2f} ms/prompt)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Rule Engine Benchmark
+Compares the single-pass RuleEngine with the old approach (one substring scan per
+keyword over the lowercased text, plus a separate subject regex) on large bodies.
+First checks that the engine fires exactly the rules a separate word-boundary
+search per rule finds, on hand-written nested phrases ("reset" / "reset password"
+/ "password") and on the first --check synthetic emails, whose rules include
+nested phrases.
+
+Usage: python bench_rules.py [--emails 200] [--body-kb 50] [--rules 300] [--check 20]
+"""
+
+import argparse
+import random
+import re
+import sys
+import time
+from rules import DEFAULT_RULES, RuleEngine
+
+NESTED_RULES = [
+    {"phrase": "reset", "kind": "priority"},
+    {"phrase": "reset password", "kind": "support", "category": "auth"},
+    {"phrase": "password", "kind": "support", "category": "auth"},
+    {"phrase": "server down", "kind": "priority", "weight": 2.0},
+    {"phrase": "e", "kind": "priority", "weight": 0.1},
+    {"phrase": "e-1042", "kind": "priority"},
+]
+NESTED_EMAILS = [
+    ("Reset password please", "the server down now"),
+    ("", "Error E-1042 again, reset  password"),
+    ("password", "RESET"),
+]
+
+WORDS = ("account billing login password invoice refund order shipping please thanks team "
+         "customer product update error page browser mobile app payment card email reset").split()
+
+
+def synthetic_rules(n, rng):
+    rules = list(DEFAULT_RULES)
+    teams = ["billing", "auth", "shipping", "mobile", "web"]
+    while len(rules) < n:
+        phrase = " ".join(rng.choice(WORDS) + str(rng.randint(0, 999)) for _ in range(rng.randint(1, 3)))
+        team = rng.choice(teams)
+        kind = rng.choice(["priority", "support"])
+        rules.append({"phrase": phrase, "kind": kind, "weight": round(rng.uniform(0.2, 1.0), 2),
+                      "category": team, "team": team})
+        # Some phrases also get rules for their first and last word, which sit inside them
+        if " " in phrase and rng.random() < 0.2:
+            for word in (phrase.split()[0], phrase.split()[-1]):
+                rules.append({"phrase": word, "kind": kind, "category": team, "team": team})
+    return rules
+
+
+def synthetic_emails(n, body_kb, rules, rng):
+    phrases = [r["phrase"] for r in rules]
+    emails = []
+    for _ in range(n):
+        words = []
+        size = 0
+        while size < body_kb * 1024:
+            word = rng.choice(phrases) if rng.random() < 0.002 else rng.choice(WORDS)
+            words.append(word)
+            size += len(word) + 1
+        emails.append((f"Need help with {rng.choice(WORDS)}", " ".join(words)))
+    return emails
+
+
+def old_approach(subject, body, keywords, support_re):
+    text_lower = f"{subject} {body}".lower()
+    # Weighted scoring needs every keyword that fired, so no short-circuiting any()
+    fired = [kw for kw in keywords if kw in text_lower]
+    support = bool(support_re.search(subject))
+    return fired, support
+
+
+def reference_fired(engine, subject, body):
+    """Rules found by one word-boundary regex search per rule, in RuleEngine.evaluate's text layout."""
+    subject = (subject or "").lower()
+    text = f"{subject}\n{(body or '').lower()}"
+    fired = set()
+    for rule in engine.rules:
+        pattern = r"(?<!\w)" + r"\s+".join(re.escape(w) for w in rule.phrase.split(" ")) + r"(?!\w)"
+        for m in re.finditer(pattern, text):
+            in_subject = m.start() < len(subject)
+            if rule.field == "any" or (rule.field == "subject") == in_subject:
+                fired.add(rule)
+                break
+    return fired
+
+
+def check(engine, emails) -> int:
+    """Number of emails where the engine's fired rules differ from reference_fired()."""
+    bad = 0
+    for subject, body in emails:
+        got, want = set(engine.evaluate(subject, body).fired), reference_fired(engine, subject, body)
+        if got != want:
+            bad += 1
+            if bad <= 3:
+                print(f"❌ {subject!r}: missing {sorted(r.phrase for r in want - got)}, "
+                      f"extra {sorted(r.phrase for r in got - want)}")
+    return bad
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, default=200)
+    parser.add_argument("--body-kb", type=int, default=50)
+    parser.add_argument("--rules", type=int, default=300)
+    parser.add_argument("--check", type=int, default=20, help="emails compared against a search per rule")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    rules = synthetic_rules(args.rules, rng)
+    emails = synthetic_emails(args.emails, args.body_kb, rules, rng)
+
+    start = time.perf_counter()
+    engine = RuleEngine(rules)
+    compile_ms = (time.perf_counter() - start) * 1000
+
+    bad = check(RuleEngine(NESTED_RULES), NESTED_EMAILS) + check(engine, emails[:args.check])
+    if bad:
+        print(f"❌ {bad} emails fired different rules than a separate search per rule.")
+        sys.exit(1)
+
+    # The old code scans once per keyword; with a real rule set that is once per rule
+    keywords = [r["phrase"] for r in rules if r["kind"] == "priority"]
+    support_re = re.compile(r"\b(" + "|".join(re.escape(r["phrase"]) for r in rules if r["kind"] == "support") + r")\b", re.I)
+
+    start = time.perf_counter()
+    for subject, body in emails:
+        old_approach(subject, body, keywords, support_re)
+    old_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fired = 0
+    for subject, body in emails:
+        fired += len(engine.evaluate(subject, body).fired)
+    new_s = time.perf_counter() - start
+
+    mb = args.emails * args.body_kb / 1024
+    print(f"{args.emails} emails x {args.body_kb} KB, {len(rules)} rules (compiled in {compile_ms:.1f} ms), "
+          f"fired rules match a separate search per rule")
+    print(f"per-keyword scans: {old_s * 1000 / args.emails:8.2f} ms/email  {mb / old_s:7.1f} MB/s")
+    print(f"rule engine:       {new_s * 1000 / args.emails:8.2f} ms/email  {mb / new_s:7.1f} MB/s  "
+          f"({fired / args.emails:.1f} rules fired/email)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Sender Benchmark
+Queues synthetic replies in a throwaway database and sends them through
+sender.send_outbox to fake_smtp.py, once with a new SMTP session per message (the
+old send_reply behaviour) and once over the pooled connection. --connect-ms
+simulates the TLS handshake + login a real provider costs per session, and
+--drop-after makes the server hang up mid-batch to exercise reconnects.
+
+Usage: python bench_sender.py [--messages 200] [--connect-ms 300] [--batch 50] [--drop-after 0]
+"""
+
+import argparse
+import os
+import tempfile
+
+# Use a scratch database; db.py reads DB_PATH on import
+os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(prefix="bench_sender_"), "bench.sqlite")
+os.environ.pop("DB_URL", None)
+
+from datetime import datetime
+from sqlalchemy import insert, update
+import fake_smtp
+from db import engine, init_db
+from models import Email, OutboxMessage
+from sender import SMTPConnection, queue_reply, send_outbox
+
+
+def seed(n):
+    with engine.begin() as conn:
+        conn.execute(insert(Email.__table__), [
+            {"id": f"BENCH{i:05d}", "message_id": f"<bench{i}@example.com>", "sender": f"user{i}@example.com",
+             "subject": f"Order {i}", "body": "Where is my order?", "status": "drafted",
+             "date_received": datetime.now()} for i in range(n)
+        ])
+    for i in range(n):
+        queue_reply(f"BENCH{i:05d}", "Hello,\n\nYour order is on its way.\n\nBest regards,\nSupport Team\n")
+
+
+def requeue():
+    with engine.begin() as conn:
+        conn.execute(update(OutboxMessage.__table__).values(status="queued", attempts=0, sent_at=None))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=50)
+    parser.add_argument("--connect-ms", type=float, default=300)
+    parser.add_argument("--drop-after", type=int, default=0)
+    args = parser.parse_args()
+
+    server = fake_smtp.start(connect_ms=args.connect_ms, drop_after=args.drop_after)
+    port = server.server_address[1]
+    init_db()
+    seed(args.messages)
+
+    print(f"{args.messages} replies, {args.connect_ms:.0f} ms per new SMTP session, batches of {args.batch}")
+    for name, per_conn in (("session per message", 1), ("pooled connection", 10 ** 9)):
+        requeue()
+        conn = SMTPConnection("127.0.0.1", port, user=None, starttls=False, max_per_connection=per_conn)
+        result = send_outbox(args.batch, connection=conn)
+        conn.close()
+        print(f"{name:<20} {result['sent'] / result['elapsed']:8.1f} msg/s  sent={result['sent']} "
+              f"failed={result['failed']} connections={result['connects']}")
+    print(f"fake SMTP: {server.counts}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""
+Email Classifier
+Small softmax (multinomial logistic regression) heads for sentiment, priority and
+support category, trained on emails whose labels a person has confirmed. They run
+on the MiniLM embeddings the KB retriever already computes for each email, so
+classification adds one matrix multiply per batch on top of retrieval instead of
+a second transformer. Embeddings go through the retriever's embedding cache, so
+an email embedded here is not encoded again when its reply is drafted.
+
+nlp.process_new_emails uses the trained heads when CLASSIFIER_PATH exists and was
+trained on the retriever's current encoder, and keeps the VADER/rule result
+wherever a head is less than CLASSIFIER_MIN_CONFIDENCE sure.
+
+Usage: python classifier.py train [--epochs 300] [--holdout 0.2]
+       python classifier.py label labels.csv   # columns: id, sentiment, priority, category
+"""
+
+import argparse
+import csv
+import os
+import threading
+import time
+import zlib
+from datetime import datetime
+import numpy as np
+from sqlalchemy import select, update
+from db import SessionLocal, init_db
+from models import Email
+from config import CLASSIFIER_PATH, CLASSIFIER_MIN_CONFIDENCE
+
+HEADS = ("sentiment", "priority", "category")
+# Stored label for emails no support rule or head assigns a category to
+NO_CATEGORY = "none"
+_EMBED_CHUNK = 256
+
+
+def _softmax(z):
+    z = z - z.max(axis=1, keepdims=True)
+    e = np.exp(z)
+    return e / e.sum(axis=1, keepdims=True)
+
+
+def _normalize(X):
+    X = np.asarray(X, dtype="float32")
+    norms = np.linalg.norm(X, axis=1, keepdims=True)
+    return X / np.maximum(norms, 1e-12)
+
+
+class SoftmaxHead:
+    """A linear layer + softmax over L2-normalized embeddings."""
+
+    def __init__(self, labels, W, b):
+        self.labels = np.asarray(labels)
+        self.W = np.asarray(W, dtype="float32")
+        self.b = np.asarray(b, dtype="float32")
+
+    @classmethod
+    def fit(cls, X, y, epochs=300, lr=0.5, l2=1e-4):
+        """Full-batch gradient descent with momentum on class-balanced cross-entropy."""
+        X = _normalize(X)
+        labels, idx, counts = np.unique(np.asarray(y), return_inverse=True, return_counts=True)
+        n, k = len(idx), len(labels)
+        Y = np.eye(k, dtype="float32")[idx]
+        # Rare classes (e.g. Urgent) weigh as much in total as common ones
+        sample_w = (n / (k * counts))[idx].astype("float32")
+        sample_w /= sample_w.sum()
+        W = np.zeros((X.shape[1], k), dtype="float32")
+        b = np.zeros(k, dtype="float32")
+        vW, vb = np.zeros_like(W), np.zeros_like(b)
+        for _ in range(epochs):
+            G = (_softmax(X @ W + b) - Y) * sample_w[:, None]
+            vW = 0.9 * vW - lr * (X.T @ G + l2 * W)
+            vb = 0.9 * vb - lr * G.sum(axis=0)
+            W += vW
+            b += vb
+        return cls(labels, W, b)
+
+    def predict_proba(self, X):
+        return _softmax(_normalize(X) @ self.W + self.b)
+
+    def predict(self, X):
+        """Return (labels, confidences) for each row of X."""
+        P = self.predict_proba(X)
+        best = P.argmax(axis=1)
+        return self.labels[best], P[np.arange(len(P)), best]
+
+
+class EmailClassifier:
+    def __init__(self, heads: dict, model_name: str, trained_at=None):
+        self.heads = heads
+        self.model_name = model_name
+        self.trained_at = trained_at
+
+    def predict(self, embeddings) -> dict:
+        """{head: (labels, confidences)} for a batch of embeddings."""
+        return {name: head.predict(embeddings) for name, head in self.heads.items()}
+
+    def save(self, path=CLASSIFIER_PATH):
+        arrays = {"model_name": np.array(self.model_name), "trained_at": np.array(self.trained_at or "")}
+        for name, head in self.heads.items():
+            arrays[f"{name}_labels"] = head.labels.astype(str)
+            arrays[f"{name}_W"] = head.W
+            arrays[f"{name}_b"] = head.b
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, **arrays)
+        # Replace atomically so a running pipeline never loads a half-written file
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path=CLASSIFIER_PATH):
+        with np.load(path, allow_pickle=False) as data:
+            heads = {name: SoftmaxHead(data[f"{name}_labels"], data[f"{name}_W"], data[f"{name}_b"])
+                     for name in HEADS if f"{name}_W" in data}
+            return cls(heads, str(data["model_name"]), str(data["trained_at"]) or None)
+
+
+_state = (None, None)
+_state_lock = threading.Lock()
+
+
+def get_classifier(path=CLASSIFIER_PATH):
+    """The trained classifier, reloaded when its file changes.
+
+    None until one is trained, or while the file was trained on another encoder
+    than kb_index.MODEL_NAME.
+    """
+    global _state
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    stamp = (st.st_mtime_ns, st.st_size)
+    if _state[0] != stamp:
+        with _state_lock:
+            if _state[0] != stamp:
+                from kb_index import MODEL_NAME
+                clf = EmailClassifier.load(path)
+                if clf.model_name != MODEL_NAME:
+                    # Heads fitted to another encoder's embedding space give confident nonsense
+                    print(f"⚠️ {path} was trained on {clf.model_name} embeddings, not {MODEL_NAME}; "
+                          f"using rule-based labels until `python classifier.py train` is run again.")
+                    clf = None
+                _state = (stamp, clf)
+    return _state[1]
+
+
+def embed(texts):
+    """MiniLM embeddings for `texts` via the KB retriever (and its embedding cache)."""
+    from kb_index import get_retriever
+    texts = list(texts)
+    retriever = get_retriever()
+    chunks = [retriever.embed(texts[i:i + _EMBED_CHUNK]) for i in range(0, len(texts), _EMBED_CHUNK)]
+    return np.vstack(chunks) if chunks else np.zeros((0, 0), dtype="float32")
+
+
+def classify_results(texts, results, min_confidence=CLASSIFIER_MIN_CONFIDENCE):
+    """Overwrite sentiment/priority/category in nlp result dicts where the trained heads are confident.
+
+    `texts` are the emails' "{subject} {body}", the same text KB retrieval embeds.
+    Leaves `results` untouched when no classifier is trained or the encoder is unavailable.
+    """
+    clf = get_classifier()
+    if clf is None or not results:
+        return results
+    try:
+        predictions = clf.predict(embed(texts))
+    except Exception as e:
+        print(f"⚠️ Classifier skipped, keeping rule-based labels: {e}")
+        return results
+    for name, (labels, confidences) in predictions.items():
+        for result, label, conf in zip(results, labels, confidences):
+            if conf < min_confidence:
+                continue
+            if name == "category":
+                result["category"] = None if label == NO_CATEGORY else str(label)
+                result["support"] = "No" if label == NO_CATEGORY else "Yes"
+            else:
+                result[name] = str(label)
+    return results
+
+
+def load_labelled(session):
+    """(ids, [(subject, body)], {head: labels}) for every email a person has labelled."""
+    rows = session.execute(
+        select(Email.id, Email.subject, Email.body, Email.sentiment, Email.priority, Email.category)
+        .where(Email.labeled_at != None)
+        .order_by(Email.id)
+    ).all()
+    pairs = [(r.subject, r.body) for r in rows]
+    labels = {
+        "sentiment": [r.sentiment for r in rows],
+        "priority": [r.priority for r in rows],
+        "category": [r.category or NO_CATEGORY for r in rows],
+    }
+    return [r.id for r in rows], pairs, labels
+
+
+def holdout_mask(ids, fraction):
+    """Stable train/test split: an email is held out based on a hash of its id."""
+    return np.array([zlib.crc32(i.encode()) % 1000 < fraction * 1000 for i in ids])
+
+
+def fit_heads(X, labels, epochs=300):
+    heads = {}
+    for name, y in labels.items():
+        y = np.asarray(y)
+        if len(np.unique(y)) < 2:
+            print(f"⚠️ Skipping {name}: labelled emails only have one class ({y[0] if len(y) else 'none'}).")
+            continue
+        heads[name] = SoftmaxHead.fit(X, y, epochs)
+    return heads
+
+
+def train(epochs=300, holdout=0.2, path=CLASSIFIER_PATH):
+    from kb_index import MODEL_NAME
+    session = SessionLocal()
+    try:
+        ids, pairs, labels = load_labelled(session)
+    finally:
+        session.close()
+    if len(ids) < 10:
+        print(f"❌ Only {len(ids)} labelled emails; label more with `python classifier.py label` or in the dashboard.")
+        return None
+
+    started = time.perf_counter()
+    X = embed(f"{subject} {body}" for subject, body in pairs)
+    print(f"🔢 Embedded {len(ids)} labelled emails in {time.perf_counter() - started:.1f}s")
+
+    test = holdout_mask(ids, holdout)
+    if holdout and test.any() and (~test).any():
+        heads = fit_heads(X[~test], {n: np.asarray(y)[~test] for n, y in labels.items()}, epochs)
+        for name, head in heads.items():
+            predicted, _ = head.predict(X[test])
+            accuracy = float((predicted == np.asarray(labels[name])[test]).mean())
+            print(f"   {name:<10} holdout accuracy {accuracy:.1%} on {int(test.sum())} emails")
+
+    clf = EmailClassifier(fit_heads(X, labels, epochs), MODEL_NAME, datetime.utcnow().isoformat(timespec="seconds"))
+    clf.save(path)
+    print(f"✅ Saved {', '.join(clf.heads)} heads trained on {len(ids)} emails to {path}")
+    return clf
+
+
+def import_labels(path):
+    """Set labels from a CSV with an id column and any of sentiment, priority, category."""
+    now = datetime.utcnow()
+    rows = []
+    with open(path, newline="", encoding="utf-8") as f:
+        for rec in csv.DictReader(f):
+            row = {"email_id": rec["id"], "labeled_at": now}
+            for name in HEADS:
+                if rec.get(name):
+                    row[name] = None if name == "category" and rec[name] == NO_CATEGORY else rec[name]
+            rows.append(row)
+    session = SessionLocal()
+    updated = 0
+    try:
+        # Rows can set different columns, so each is its own UPDATE
+        for row in rows:
+            email_id = row.pop("email_id")
+            if "category" in row:
+                row["support"] = "Yes" if row["category"] else "No"
+            updated += session.execute(update(Email).where(Email.id == email_id).values(**row)).rowcount
+        session.commit()
+    finally:
+        session.close()
+    print(f"🏷️ Labelled {updated} of {len(rows)} emails from {path}")
+    return updated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the embedding classifier or import labels.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    train_p = sub.add_parser("train", help="train heads on labelled emails")
+    train_p.add_argument("--epochs", type=int, default=300)
+    train_p.add_argument("--holdout", type=float, default=0.2, help="fraction held out to report accuracy")
+    label_p = sub.add_parser("label", help="import labels from a CSV")
+    label_p.add_argument("csv")
+    args = parser.parse_args()
+    init_db()
+    if args.command == "train":
+        train(args.epochs, args.holdout)
+    else:
+        import_labels(args.csv)
@@ -1,19 +1,29 @@
 import streamlit as st
 import pandas as pd
-from db import SessionLocal
+from datetime import datetime
+from db import SessionLocal, init_db
 from models import Email
-from responder import send_reply, generate_draft
+from search import count_matches, search_emails
+from inbox import PENDING_STATUSES, count_emails, count_threads, list_emails, list_threads, page_count
+from threads import strip_quoted, thread_messages
+from responder import send_reply, stream_draft
+from sender import queue_reply, queued_count, send_outbox
+from draft_worker import run_drafts
+from response_cache import get_response_cache
+import metrics
 from nlp import process_new_emails
 from imap_fetcher import fetch_and_store
-from config import PROCESS_BATCH
+from analytics import get_counts, get_hourly, median_reply_seconds
+from config import PROCESS_BATCH, ANALYTICS_TTL
 from setup_kb import create_sample_kb_data
 
 st.set_page_config(page_title="SupportBot Dashboard", layout="wide")
 
-# Initialize knowledge base on startup
+# Initialize database schema and knowledge base on startup
 @st.cache_resource
 def initialize_kb():
     """Initialize knowledge base with sample data if empty"""
+    init_db()
     try:
         create_sample_kb_data(auto_mode=True)
     except Exception as e:
@@ -21,76 +31,204 @@ def initialize_kb():
 
 initialize_kb()
 
+@st.cache_data(ttl=ANALYTICS_TTL)
+def load_analytics():
+    return get_counts(), get_hourly(), median_reply_seconds()
+
+def analytics_changed():
+    """Drop the cached analytics after an action; the rollups themselves are updated by triggers."""
+    load_analytics.clear()
+
 st.title("📬 SupportBot Dashboard")
 
 # --- Buttons ---
-col1, col2 = st.columns(2)
+col1, col2, col3, col4 = st.columns(4)
 with col1:
     if st.button("🔄 Fetch New Emails"):
         try:
             fetch_and_store(limit=PROCESS_BATCH)
             process_new_emails()
+            load_analytics.clear()
             # generate_drafts()
             st.success("New emails fetched and processed!")
         except Exception as e:
             st.error(f"Error fetching emails: {str(e)}")
 
 with col2:
+    if st.button("✍️ Draft All Analyzed"):
+        try:
+            with st.spinner("Generating drafts..."):
+                stats = run_drafts()
+            load_analytics.clear()
+            if stats["drafted"]:
+                st.success(f"Generated {stats['drafted']} drafts!")
+            else:
+                st.info("No analyzed emails waiting for a draft.")
+            if stats["failed"]:
+                st.warning(f"{stats['failed']} drafts failed after retries; they stay in the queue.")
+        except Exception as e:
+            st.error(f"Error generating drafts: {str(e)}")
+
+with col3:
+    approved = queued_count()
+    if st.button(f"📤 Send Approved ({approved})", disabled=not approved):
+        try:
+            with st.spinner(f"Sending {approved} replies..."):
+                result = send_outbox()
+            load_analytics.clear()
+            st.success(f"Sent {result['sent']} replies ({result['sent'] / result['elapsed'] if result['elapsed'] else 0:.1f} msg/s).")
+            if result["failed"]:
+                st.warning(f"{result['failed']} replies failed to send; they will be retried.")
+        except Exception as e:
+            st.error(f"Error sending replies: {str(e)}")
+
+with col4:
     if st.button("📊 Refresh Data"):
         st.rerun()
 
 # --- Fetch emails ---
 session = SessionLocal()
-all_emails = session.query(Email).order_by(Email.priority.desc(), Email.id.desc()).all()
 
-# Separate pending and replied emails
-pending_emails = [e for e in all_emails if e.status != 'replied']
-replied_emails = [e for e in all_emails if e.status == 'replied']
+PAGE_SIZES = [25, 50, 100]
+
+def pager(label, total, key):
+    """Page size and page number controls; returns (page, page_size)."""
+    col_size, col_page, col_info = st.columns([1, 1, 2])
+    with col_size:
+        page_size = st.selectbox(f"{label} per page", PAGE_SIZES, key=f"{key}_size")
+    with col_page:
+        page = st.number_input("Page", min_value=1, max_value=page_count(total, page_size), value=1, key=f"{key}_page")
+    with col_info:
+        st.caption(f"{total} {label.lower()} · page {page} of {page_count(total, page_size)}")
+    return int(page), page_size
+
+total_count = count_emails(session)
 
-if not all_emails:
+if not total_count:
     st.info("No emails in the system yet.")
 else:
+    # --- SEARCH ---
+    search_query = st.text_input("🔍 Search emails", placeholder='e.g. reset password, "order 1234", E-1042')
+    if search_query.strip():
+        search_total = count_matches(search_query)
+        if search_total:
+            page, page_size = pager("Results", search_total, "search")
+            hits = search_emails(search_query, page=page, page_size=page_size)
+            st.dataframe(pd.DataFrame([{
+                "ID": h["id"],
+                "From": h["sender"],
+                "Subject": h["subject"],
+                "Status": h["status"],
+                "Match": h["snippet"],
+                "Date Received": h["date_received"],
+            } for h in hits]), use_container_width=True)
+            with st.expander("View Search Result"):
+                found_id = st.selectbox("Select a result to view:", [h["id"] for h in hits], key="search_select")
+                found = session.get(Email, found_id)
+                if found:
+                    st.write(f"**From:** {found.sender}")
+                    st.write(f"**Subject:** {found.subject}")
+                    st.write(f"**Status:** {found.status}")
+                    st.write(f"**Body:** {found.body}")
+                    if found.draft_reply:
+                        st.write(f"**Reply:** {found.draft_reply}")
+        else:
+            st.info("No emails match your search.")
+
     # --- PENDING EMAILS QUEUE ---
-    if pending_emails:
+    st.subheader("📋 Pending Email Queue")
+    status_filter = st.multiselect("Status", PENDING_STATUSES, default=PENDING_STATUSES)
+    # One entry per conversation, represented by its newest waiting message
+    pending_total = count_threads(session, statuses=status_filter or PENDING_STATUSES)
+    email = None
+    if pending_total:
+        page, page_size = pager("Conversations", pending_total, "pending")
+        pending_threads = list_threads(session, statuses=status_filter or PENDING_STATUSES, page=page, page_size=page_size)
         pending_df = pd.DataFrame([{
             "ID": e.id,
             "From": e.sender,
             "Subject": e.subject,
+            "Messages": messages,
             "Sentiment": e.sentiment,
             "Priority": e.priority,
             "Date Received": e.date_received,
             "Status": e.status
-        } for e in pending_emails])
+        } for e, messages in pending_threads])
 
-        st.subheader("📋 Pending Email Queue")
         st.dataframe(pending_df, use_container_width=True)
 
         # --- Select email ---
         selected_id = st.selectbox("Select an email to review:", pending_df["ID"].tolist())
-        email = session.query(Email).get(selected_id)
+        email = session.get(Email, selected_id)
     else:
         st.info("No pending emails in the queue.")
-        email = None
 
     if email:
         st.subheader("📧 Email Details")
+        conversation = thread_messages(session, email)
+        if len(conversation) > 1:
+            with st.expander(f"🧵 Conversation ({len(conversation)} messages)"):
+                for msg in conversation:
+                    marker = "➡️ " if msg.id == email.id else ""
+                    st.markdown(f"{marker}**{msg.sender}** · {msg.date_received} · _{msg.status}_")
+                    st.text(strip_quoted(msg.body))
+                    if msg.status == "replied" and msg.draft_reply:
+                        st.markdown("**Our reply:**")
+                        st.text(msg.draft_reply)
         st.write(f"**From:** {email.sender}")
         st.write(f"**Subject:** {email.subject}")
         st.write(f"**Body:** {email.body}")
         st.write(f"**Sentiment:** {email.sentiment}")
         st.write(f"**Priority:** {email.priority}")
-        st.write(f"**Support Type:** {email.support}")
+        st.write(f"**Support Type:** {email.support}" + (f" ({email.category})" if email.category else ""))
+        if email.extracted_emails:
+            st.write(f"**Extracted Emails:** {email.extracted_emails}")
+        if email.extracted_phones:
+            st.write(f"**Extracted Phones:** {email.extracted_phones}")
+
+        # --- Label correction (training data for classifier.py) ---
+        with st.expander("🏷️ Correct labels" + (" (confirmed)" if email.labeled_at else "")):
+            sentiments = ["Positive", "Neutral", "Negative"]
+            priorities = ["Urgent", "Not urgent"]
+            new_sentiment = st.selectbox("Sentiment", sentiments, key=f"label_sentiment_{email.id}",
+                                         index=sentiments.index(email.sentiment) if email.sentiment in sentiments else 1)
+            new_priority = st.selectbox("Priority", priorities, key=f"label_priority_{email.id}",
+                                        index=priorities.index(email.priority) if email.priority in priorities else 1)
+            new_category = st.text_input("Support category (empty if not a support request)",
+                                         value=email.category or "", key=f"label_category_{email.id}")
+            if st.button("💾 Save Labels", key=f"label_save_{email.id}"):
+                email.sentiment, email.priority = new_sentiment, new_priority
+                email.category = new_category.strip() or None
+                email.support = "Yes" if email.category else "No"
+                email.labeled_at = datetime.utcnow()
+                session.commit()
+                analytics_changed()
+                st.success("Labels saved; they will be used the next time the classifier is trained.")
+                st.rerun()
 
         # --- Draft Generation ---
         col_draft, col_send = st.columns(2)
         
         with col_draft:
-            if st.button("✍️ Generate Draft"):
-                with st.spinner("Generating draft..."):
-                    generate_draft(email)
-                    session.commit()  # Save draft to database
-                    st.success("Draft generated!")
-                    st.rerun()  # Refresh to show new draft
+            start_draft = st.button("✍️ Generate Draft")
+
+        if start_draft:
+            # Show the reply as it is generated, then save the finished text once
+            st.subheader("✍️ Draft Reply")
+            stream_box = st.empty()
+            streamed = ""
+            try:
+                for chunk in stream_draft(email):
+                    streamed += chunk
+                    stream_box.text(streamed + " ▌")
+                stream_box.text(streamed)
+                session.commit()  # Save draft to database
+                analytics_changed()
+                st.success("Draft generated!")
+                st.rerun()  # Refresh to show the editable draft
+            except Exception as e:
+                session.rollback()
+                st.error(f"Error generating draft: {str(e)}")
         
         # --- Show Draft (if exists) ---
         if email.draft_reply:
@@ -109,18 +247,32 @@ else:
                             success = send_reply(email, draft)
                             if success:
                                 session.commit()
+                                load_analytics.clear()
                                 st.success("Reply sent and email marked as replied!")
                                 st.rerun()
                             else:
                                 st.error("Failed to send reply. Please try again.")
                     else:
                         st.error("Please enter a reply message.")
+                if st.button("📥 Approve for Batch Send"):
+                    if draft.strip():
+                        queue_reply(email.id, draft)
+                        session.expire(email)
+                        analytics_changed()
+                        st.success("Reply approved; it will go out with the next batch send.")
+                        st.rerun()
+                    else:
+                        st.error("Please enter a reply message.")
         else:
             st.info("Click 'Generate Draft' to create an AI-powered reply.")
 
     # --- REPLIED EMAILS SECTION ---
-    if replied_emails:
+    replied_total = count_emails(session, statuses=["replied"])
+    if replied_total:
         st.subheader("✅ Replied Emails")
+        page, page_size = pager("Replies", replied_total, "replied")
+        replied_emails = list_emails(session, statuses=["replied"], page=page, page_size=page_size,
+                                     order_by=(Email.date_sent.desc(),))
         replied_df = pd.DataFrame([{
             "ID": e.id,
             "From": e.sender,
@@ -135,7 +287,7 @@ else:
         # Show replied email details in expander
         with st.expander("View Replied Email Details"):
             replied_id = st.selectbox("Select a replied email to view:", replied_df["ID"].tolist(), key="replied_select")
-            replied_email = session.query(Email).get(replied_id)
+            replied_email = session.get(Email, replied_id)
             
             if replied_email:
                 st.write(f"**From:** {replied_email.sender}")
@@ -149,25 +301,13 @@ else:
 # --- Analytics ---
 st.subheader("📊 Analytics Dashboard")
 
-if all_emails:
-    # Create analytics data
-    status_counts = {}
-    priority_counts = {}
-    sentiment_counts = {}
-    
-    for email in all_emails:
-        # Status distribution
-        status = email.status or 'unknown'
-        status_counts[status] = status_counts.get(status, 0) + 1
-        
-        # Priority distribution
-        priority = email.priority or 'Not urgent'
-        priority_counts[priority] = priority_counts.get(priority, 0) + 1
-        
-        # Sentiment distribution
-        sentiment = email.sentiment or 'Neutral'
-        sentiment_counts[sentiment] = sentiment_counts.get(sentiment, 0) + 1
-    
+# Counts come from the rollup tables, cached for ANALYTICS_TTL seconds
+counts, hourly, median_reply = load_analytics()
+status_counts = counts["status"]
+priority_counts = counts["priority"]
+sentiment_counts = counts["sentiment"]
+
+if total_count:
     # Create three columns for charts
     col1, col2, col3 = st.columns(3)
     
@@ -192,9 +332,9 @@ if all_emails:
             }, use_container_width=True, config={'displayModeBar': False})
         
         # Show metrics below chart
-        total = len(all_emails)
-        pending = len(pending_emails)
-        replied = len(replied_emails)
+        total = total_count
+        replied = status_counts.get("replied", 0)
+        pending = sum(status_counts.values()) - replied
         st.metric("Total Emails", total)
         st.metric("Pending", pending)
         st.metric("Replied", replied)
@@ -247,6 +387,28 @@ if all_emails:
             for sentiment, count in sentiment_counts.items():
                 st.metric(sentiment, count)
     
+    # --- Volume and response time ---
+    st.subheader("🕒 Volume per Hour")
+    if hourly:
+        hourly_df = pd.DataFrame(hourly, columns=["Hour", "Received", "Replied"]).set_index("Hour")
+        st.line_chart(hourly_df)
+    else:
+        st.info("No emails in the last 48 hours.")
+    col_reply, col_ttft, col_cache = st.columns(3)
+    col_reply.metric("Median Time to Reply (30 days)",
+                     f"{median_reply / 3600:.1f} h" if median_reply is not None else "N/A")
+    # Recorded by stream_draft in this dashboard process
+    ttft = metrics.summary("draft.ttft_ms")
+    prompt_tokens = metrics.summary("draft.prompt_tokens")
+    col_ttft.metric("Draft Time to First Token (p50 / p95)",
+                    f"{ttft['p50'] / 1000:.1f}s / {ttft['p95'] / 1000:.1f}s" if ttft["count"] else "N/A",
+                    help=f"Prompt size p50 / p95: ~{prompt_tokens['p50']:.0f} / ~{prompt_tokens['p95']:.0f} tokens"
+                         if prompt_tokens["count"] else None)
+    cache_stats = get_response_cache().stats()
+    col_cache.metric("Drafts Reused from Cache", cache_stats["lifetime_hits"],
+                     help=f"LLM time saved: {cache_stats['lifetime_saved_ms'] / 1000:.0f}s · "
+                          f"hit rate this session: {cache_stats['hit_rate']:.0%}")
+
 else:
     st.info("No emails available for analytics. Fetch some emails first!")
 
@@ -1,14 +1,65 @@
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 #import sqlite3
 from pathlib import Path
-from config import DB_PATH
+from config import (DB_URL, DB_READ_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW,
+                    SQLITE_BUSY_TIMEOUT_MS, SQLITE_CACHE_SIZE_KB, SQLITE_MMAP_SIZE)
 from models import Base
 
 
+def _sqlite_pragmas(read_only=False):
+    """Connect hook applying the SQLite settings every connection needs.
+
+    WAL lets readers run alongside the single writer instead of blocking it,
+    synchronous=NORMAL only fsyncs at checkpoints (safe in WAL mode), and
+    busy_timeout makes a writer wait for the lock instead of failing with
+    "database is locked" straight away. journal_mode is stored in the file,
+    so only write connections set it.
+    """
+    def on_connect(dbapi_conn, _):
+        cur = dbapi_conn.cursor()
+        if not read_only:
+            cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        # A negative cache_size is in KiB rather than pages
+        cur.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        if read_only:
+            cur.execute("PRAGMA query_only=ON")
+        cur.close()
+    return on_connect
+
+
+def make_engine(url=DB_URL, read_only=False, tuned=True):
+    """Create an engine for `url`, with the SQLite pragmas above unless tuned=False."""
+    if url.startswith("sqlite"):
+        db_file = url.split("///", 1)[1] if "///" in url else ""
+        if db_file and db_file != ":memory:":
+            Path(db_file).parent.mkdir(parents=True, exist_ok=True)
+        # Pooled connections are handed between threads (Streamlit runs each session in its own)
+        eng = create_engine(url, future=True, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                            connect_args={"check_same_thread": False})
+        if tuned:
+            event.listen(eng, "connect", _sqlite_pragmas(read_only))
+        return eng
+    return create_engine(url, future=True, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                         pool_pre_ping=True)
+
+
+# Writes (ingest, analysis, drafts, sends) go through `engine`; read-only work such
+# as dashboard analytics can use `read_engine`, which points at DB_READ_URL
 Path("data").mkdir(exist_ok=True)
-engine = create_engine(f"sqlite:///{DB_PATH}", future=True)
+engine = make_engine(DB_URL)
+if DB_READ_URL == DB_URL and not DB_URL.startswith("sqlite"):
+    read_engine = engine
+else:
+    # On SQLite a separate query_only pool keeps dashboard reads off the writer's connections
+    read_engine = make_engine(DB_READ_URL, read_only=True)
 SessionLocal = sessionmaker(bind=engine, future=True)
+ReadSession = sessionmaker(bind=read_engine, future=True)
 
 # def exec_script(path="schema.sql"):
 #     with engine.connect() as conn:
@@ -22,4 +73,175 @@ SessionLocal = sessionmaker(bind=engine, future=True)
 #         with open(path, "r", encoding="utf-8") as f:
 #             conn.executescript(f.read())
 
-Base.metadata.create_all(engine)
\ No newline at end of file
+def insert_or_ignore(table):
+    """INSERT that silently skips rows whose primary/unique key already exists."""
+    insert = pg_insert if engine.dialect.name == "postgresql" else sqlite_insert
+    return insert(table).on_conflict_do_nothing()
+
+def _migrate(engine):
+    """Add columns and indexes that create_all() skips on tables that already exist."""
+    insp = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not insp.has_table(table.name):
+                continue
+            existing = {c["name"] for c in insp.get_columns(table.name)}
+            for col in table.columns:
+                if col.name not in existing:
+                    col_type = col.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN "{col.name}" {col_type}'))
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+# SQLite FTS5 (BM25) indexes over emails and KB docs. They are external-content
+# tables: the text lives only in emails/kb_docs and the triggers keep the index in
+# step by rowid. Email status updates don't touch subject/body, so they never reindex.
+# (emails has no INTEGER PRIMARY KEY, so after a VACUUM run `python search.py --rebuild`.)
+_FTS_TABLES = {
+    "emails_fts": ("emails", "rowid", ("subject", "body")),
+    "kb_fts": ("kb_docs", "id", ("title", "content")),
+}
+
+def _fts_ddl(fts, table, rowid, cols):
+    names = ", ".join(cols)
+    new = ", ".join(f"new.{c}" for c in cols)
+    old = ", ".join(f"old.{c}" for c in cols)
+    return [
+        f"CREATE VIRTUAL TABLE {fts} USING fts5({names}, content='{table}', content_rowid='{rowid}', "
+        f"tokenize='porter unicode61')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, {names}) VALUES (new.{rowid}, {new}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {names}) VALUES ('delete', old.{rowid}, {old}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {names} ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {names}) VALUES ('delete', old.{rowid}, {old}); "
+        f"INSERT INTO {fts}(rowid, {names}) VALUES (new.{rowid}, {new}); END",
+    ]
+
+def rebuild_fts(engine, names=None):
+    """Re-index every row of the given FTS tables (all by default) from their content tables."""
+    with engine.begin() as conn:
+        for fts in names or _FTS_TABLES:
+            conn.execute(text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+
+def _create_fts(engine):
+    """Create the FTS5 tables and triggers if missing, indexing existing rows once."""
+    if engine.dialect.name != "sqlite":
+        return
+    created = []
+    with engine.begin() as conn:
+        for fts, (table, rowid, cols) in _FTS_TABLES.items():
+            exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+                                  {"name": fts}).first()
+            for i, stmt in enumerate(_fts_ddl(fts, table, rowid, cols)):
+                if i == 0 and exists:
+                    continue
+                conn.execute(text(stmt))
+            if not exists:
+                created.append(fts)
+    if created:
+        rebuild_fts(engine, created)
+
+# Dashboard rollups (email_rollups, email_hourly; see analytics.py) are kept current by
+# triggers on emails: an insert or delete, or a change to one of the counted columns,
+# adds +1/-1 to just the rows it affects, so each write costs the same however large
+# the table grows. email_rollups metric -> label counted for NULL values:
+ROLLUP_METRICS = {"status": "unknown", "priority": "Not urgent", "sentiment": "Neutral"}
+# email_hourly column -> emails column whose hour it counts
+HOURLY_COLUMNS = {"received": "date_received", "replied": "date_sent"}
+_ROLLUP_SOURCES = (*ROLLUP_METRICS, *HOURLY_COLUMNS.values())
+
+def _hour_sql(dialect, expr):
+    if dialect == "postgresql":
+        return f"date_trunc('hour', {expr})"
+    # The text format SQLAlchemy stores DateTime values in, so buckets compare equal
+    return f"strftime('%Y-%m-%d %H:00:00.000000', {expr})"
+
+def _hourly_values(field, count):
+    return ", ".join(str(count) if f == field else "0" for f in HOURLY_COLUMNS)
+
+def _rollup_delta(dialect, col, rec, sign):
+    """Statement adding `sign` to the rollup row that emails.`col` of trigger row `rec` counts in."""
+    if col in ROLLUP_METRICS:
+        return (f"INSERT INTO email_rollups (metric, value, count) "
+                f"VALUES ('{col}', COALESCE({rec}.{col}, '{ROLLUP_METRICS[col]}'), {sign}) "
+                f"ON CONFLICT (metric, value) DO UPDATE SET count = email_rollups.count + excluded.count")
+    field = next(f for f, c in HOURLY_COLUMNS.items() if c == col)
+    return (f"INSERT INTO email_hourly (bucket, {', '.join(HOURLY_COLUMNS)}) "
+            f"SELECT {_hour_sql(dialect, f'{rec}.{col}')}, {_hourly_values(field, sign)} "
+            f"WHERE {rec}.{col} IS NOT NULL "
+            f"ON CONFLICT (bucket) DO UPDATE SET {field} = email_hourly.{field} + excluded.{field}")
+
+def _rollup_trigger_ddl(dialect):
+    def all_deltas(rec, sign):
+        return " ".join(_rollup_delta(dialect, col, rec, sign) + ";" for col in _ROLLUP_SOURCES)
+
+    def moved(col, old, new):
+        return f"{_rollup_delta(dialect, col, old, -1)}; {_rollup_delta(dialect, col, new, 1)};"
+
+    if dialect == "sqlite":
+        ddl = [
+            f"CREATE TRIGGER IF NOT EXISTS emails_rollup_ai AFTER INSERT ON emails BEGIN {all_deltas('new', 1)} END",
+            f"CREATE TRIGGER IF NOT EXISTS emails_rollup_ad AFTER DELETE ON emails BEGIN {all_deltas('old', -1)} END",
+        ]
+        for col in _ROLLUP_SOURCES:
+            ddl.append(f"CREATE TRIGGER IF NOT EXISTS emails_rollup_au_{col} AFTER UPDATE OF {col} ON emails "
+                       f"WHEN old.{col} IS NOT new.{col} BEGIN {moved(col, 'old', 'new')} END")
+        return ddl
+    changed = " ".join(f"IF OLD.{col} IS DISTINCT FROM NEW.{col} THEN {moved(col, 'OLD', 'NEW')} END IF;"
+                       for col in _ROLLUP_SOURCES)
+    return [
+        "CREATE OR REPLACE FUNCTION emails_rollup() RETURNS trigger AS $$ BEGIN "
+        f"IF TG_OP = 'INSERT' THEN {all_deltas('NEW', 1)} "
+        f"ELSIF TG_OP = 'DELETE' THEN {all_deltas('OLD', -1)} "
+        f"ELSE {changed} END IF; RETURN NULL; END $$ LANGUAGE plpgsql",
+        "DROP TRIGGER IF EXISTS emails_rollup ON emails",
+        f"CREATE TRIGGER emails_rollup AFTER INSERT OR DELETE OR UPDATE OF {', '.join(_ROLLUP_SOURCES)} ON emails "
+        "FOR EACH ROW EXECUTE FUNCTION emails_rollup()",
+    ]
+
+def _rebuild_rollups(conn, dialect):
+    conn.exec_driver_sql("DELETE FROM email_rollups")
+    conn.exec_driver_sql("DELETE FROM email_hourly")
+    for metric, null_label in ROLLUP_METRICS.items():
+        conn.exec_driver_sql(f"INSERT INTO email_rollups (metric, value, count) "
+                             f"SELECT '{metric}', COALESCE({metric}, '{null_label}'), COUNT(*) FROM emails GROUP BY 2")
+    for field, col in HOURLY_COLUMNS.items():
+        conn.exec_driver_sql(f"INSERT INTO email_hourly (bucket, {', '.join(HOURLY_COLUMNS)}) "
+                             f"SELECT {_hour_sql(dialect, col)}, {_hourly_values(field, 'COUNT(*)')} "
+                             f"FROM emails WHERE {col} IS NOT NULL GROUP BY 1 "
+                             f"ON CONFLICT (bucket) DO UPDATE SET {field} = email_hourly.{field} + excluded.{field}")
+
+def rebuild_rollups(engine):
+    """Recompute the dashboard rollups from every email, e.g. to check them after a bulk import."""
+    with engine.begin() as conn:
+        _rebuild_rollups(conn, engine.dialect.name)
+
+def _create_rollup_triggers(engine):
+    """Install the rollup triggers if missing, counting the existing rows once when they are new."""
+    dialect = engine.dialect.name
+    if dialect == "sqlite":
+        exists_sql = "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'emails_rollup_ai'"
+    elif dialect == "postgresql":
+        exists_sql = "SELECT 1 FROM pg_trigger WHERE tgname = 'emails_rollup'"
+    else:
+        return
+    with engine.begin() as conn:
+        if conn.exec_driver_sql(exists_sql).first():
+            return
+        for stmt in _rollup_trigger_ddl(dialect):
+            conn.exec_driver_sql(stmt)
+        _rebuild_rollups(conn, dialect)
+
+_initialized = False
+
+def init_db():
+    """Create missing tables, columns and indexes. Call once from each entry point."""
+    global _initialized
+    if _initialized:
+        return
+    Base.metadata.create_all(engine)
+    _migrate(engine)
+    _create_fts(engine)
+    _create_rollup_triggers(engine)
+    _initialized = True
@@ -0,0 +1,216 @@
+"""
+Draft Worker
+Drafts replies for every `analyzed` email with concurrent LLM calls. asyncio keeps
+up to DRAFT_CONCURRENCY requests in flight (the Gemini SDK call is blocking, so each
+one runs in a worker thread) and spaces request starts to DRAFT_RATE_PER_MIN.
+Throttling (429), server errors and timeouts are retried with exponential backoff
+and jitter; drafts are written back DRAFT_WRITE_BATCH at a time.
+
+Point GEMINI_API_ENDPOINT at fake_llm.py (with GEMINI_TRANSPORT=rest) to try it
+without a real API key or quota.
+
+Usage: python draft_worker.py [--limit N] [--concurrency 8] [--rate 60] [--watch SECONDS]
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import bindparam, select, update
+from db import SessionLocal, engine, init_db
+from models import Email
+from responder import GEMINI_API_KEY, fallback_reply, generate_with_gemini, make_prompt, retrieve_context
+from response_cache import get_response_cache
+from config import (DRAFT_CONCURRENCY, DRAFT_RATE_PER_MIN, DRAFT_MAX_RETRIES, DRAFT_WRITE_BATCH, LLM_TIMEOUT)
+
+# HTTP statuses worth retrying: timeouts, throttling and transient server errors
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+emails_table = Email.__table__
+# Only emails still waiting for a draft are updated, so a reply sent meanwhile is never overwritten
+SAVE_DRAFTS = (
+    update(emails_table)
+    .where(emails_table.c.id == bindparam("email_id"), emails_table.c.status == "analyzed")
+    .values(draft_reply=bindparam("draft"), status="drafted")
+)
+
+
+class RateLimiter:
+    """Spaces request starts at least 60 / rate_per_min seconds apart (no limit when 0)."""
+
+    def __init__(self, rate_per_min):
+        self.interval = 60.0 / rate_per_min if rate_per_min > 0 else 0.0
+        self._next = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        start = max(now, self._next)
+        self._next = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+def is_retryable(exc) -> bool:
+    """True for timeouts, dropped connections and google.api_core errors with a retryable status."""
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return True
+    try:
+        return int(getattr(exc, "code", None)) in RETRYABLE_STATUS
+    except (TypeError, ValueError):
+        return False
+
+
+class DraftWriter:
+    """Buffers finished drafts and saves them with one executemany UPDATE per batch."""
+
+    def __init__(self, batch_size=DRAFT_WRITE_BATCH):
+        self.batch_size = batch_size
+        self.saved = 0
+        self._rows = []
+
+    async def add(self, email_id, draft):
+        self._rows.append({"email_id": email_id, "draft": draft})
+        if len(self._rows) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        rows, self._rows = self._rows, []
+        if rows:
+            self.saved += await asyncio.to_thread(self._save, rows)
+
+    @staticmethod
+    def _save(rows):
+        with engine.begin() as conn:
+            return conn.execute(SAVE_DRAFTS, rows).rowcount
+
+
+async def generate_with_retry(prompt, generate, limiter, stats, max_retries=DRAFT_MAX_RETRIES, timeout=LLM_TIMEOUT):
+    for attempt in range(max_retries + 1):
+        await limiter.wait()
+        try:
+            # The SDK enforces `timeout` on the request itself; wait_for is a backstop for a stuck thread
+            return await asyncio.wait_for(asyncio.to_thread(generate, prompt), timeout + 5)
+        except Exception as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+            stats["retries"] += 1
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+            await asyncio.sleep(delay)
+
+
+async def draft_emails(emails, contexts, writer, generate=generate_with_gemini, concurrency=DRAFT_CONCURRENCY,
+                       limiter=None, stats=None, max_retries=DRAFT_MAX_RETRIES, keys=None, threads=None):
+    """Draft `emails` (objects or rows with id, sender, subject, body, sentiment, priority)
+    concurrently and hand each draft to `writer`. Emails whose call fails for good are
+    counted in stats["failed"] and stay `analyzed` for the next run. `keys` and
+    `threads` are the emails' responder.retrieve_context() entries; with keys,
+    near-duplicates reuse a cached draft instead of calling the LLM, and with
+    threads, follow-ups are prompted with only their new text and our last reply."""
+    limiter = limiter or RateLimiter(0)
+    stats = stats if stats is not None else {"drafted": 0, "cached": 0, "failed": 0, "retries": 0}
+    sem = asyncio.Semaphore(concurrency)
+    cache = get_response_cache()
+
+    async def one(email, context_docs, key, thread):
+        async with sem:
+            cached = await asyncio.to_thread(cache.lookup, *key) if key else None
+            if cached is not None:
+                draft = cached
+                stats["cached"] += 1
+            elif generate is None:
+                draft = fallback_reply(email)
+            else:
+                try:
+                    started = time.perf_counter()
+                    draft = await generate_with_retry(make_prompt(email, context_docs, thread), generate, limiter, stats, max_retries)
+                except Exception as e:
+                    stats["failed"] += 1
+                    print(f"❌ Draft failed for email {email.id}: {e}")
+                    return
+                if key:
+                    await asyncio.to_thread(cache.store, *key, draft, (time.perf_counter() - started) * 1000)
+            await writer.add(email.id, draft)
+            stats["drafted"] += 1
+
+    keys = keys or [None] * len(emails)
+    threads = threads or [None] * len(emails)
+    await asyncio.gather(*(one(em, ctx, key, thread) for em, ctx, key, thread in zip(emails, contexts, keys, threads)))
+    return stats
+
+
+def _pages(session, page_size, limit=None):
+    """Yield analyzed emails page by page, keyed on id so drafts can commit in between."""
+    last_id, remaining = "", limit
+    while remaining is None or remaining > 0:
+        size = page_size if remaining is None else min(page_size, remaining)
+        page = session.execute(
+            select(Email.id, Email.thread_id, Email.sender, Email.subject, Email.body, Email.sentiment, Email.priority)
+            .where(Email.status == "analyzed", Email.id > last_id)
+            .order_by(Email.id)
+            .limit(size)
+        ).all()
+        if not page:
+            return
+        yield page
+        last_id = page[-1].id
+        if remaining is not None:
+            remaining -= len(page)
+
+
+async def _run(limit, concurrency, rate_per_min, generate):
+    loop = asyncio.get_running_loop()
+    # to_thread uses the default executor, which must be at least as wide as the semaphore
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency + 2))
+    limiter = RateLimiter(rate_per_min)
+    writer = DraftWriter()
+    stats = {"drafted": 0, "cached": 0, "failed": 0, "retries": 0}
+    session = SessionLocal()
+    try:
+        # Pages are large enough to keep every slot busy between KB lookups
+        for page in _pages(session, max(100, concurrency * 10), limit):
+            # Follow-ups in a known thread reuse its KB context instead of a new lookup
+            hits, keys, threads = await asyncio.to_thread(retrieve_context, page)
+            contexts = [[hit["content"] for hit in em_hits] for em_hits in hits]
+            await draft_emails(page, contexts, writer, generate, concurrency, limiter, stats,
+                               keys=keys if generate is not None else None, threads=threads)
+            await writer.flush()
+            print(f"   {stats['drafted']} drafted ({stats['cached']} from cache), {stats['failed']} failed, "
+                  f"{stats['retries']} retries")
+    finally:
+        await writer.flush()
+        session.close()
+    stats["saved"] = writer.saved
+    return stats
+
+
+def run_drafts(limit=None, concurrency=DRAFT_CONCURRENCY, rate_per_min=DRAFT_RATE_PER_MIN, generate=None):
+    """Draft replies for up to `limit` analyzed emails and return counts of drafted/failed/retries."""
+    if generate is None and GEMINI_API_KEY:
+        generate = generate_with_gemini
+    started = time.perf_counter()
+    stats = asyncio.run(_run(limit, concurrency, rate_per_min, generate))
+    elapsed = time.perf_counter() - started
+    print(f"🎯 Drafted {stats['drafted']} emails ({stats['cached']} from cache) in {elapsed:.1f}s "
+          f"({stats['drafted'] / elapsed if elapsed else 0:.1f} drafts/s), "
+          f"{stats['failed']} failed, {stats['retries']} retries.")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Draft replies for all analyzed emails.")
+    parser.add_argument("--limit", type=int, help="max emails to draft this run")
+    parser.add_argument("--concurrency", type=int, default=DRAFT_CONCURRENCY)
+    parser.add_argument("--rate", type=float, default=DRAFT_RATE_PER_MIN, help="max LLM requests per minute, 0 for no limit")
+    parser.add_argument("--watch", type=float, help="keep running, checking for newly analyzed emails every N seconds")
+    args = parser.parse_args()
+    init_db()
+    while True:
+        run_drafts(args.limit, args.concurrency, args.rate)
+        if not args.watch:
+            break
+        time.sleep(args.watch)
@@ -0,0 +1,127 @@
+"""
+Persistent embedding cache.
+Stores query embeddings in the query_embeddings table, keyed by a hash of the
+model name and the whitespace-normalized text, so re-drafting the same email
+never re-runs the encoder. Least recently used rows are evicted past a size limit.
+
+Lookups are plain reads: last_used is only rewritten once it is more than
+TOUCH_INTERVAL old, which is precise enough for LRU eviction. The row count is
+tracked in memory (one COUNT(*) on first insert, then every RECOUNT_INTERVAL to
+pick up rows other processes added) rather than counted on every miss.
+"""
+
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import delete, func, select, update
+from db import engine, insert_or_ignore
+from models import QueryEmbedding
+from config import EMBED_CACHE_MAX_ENTRIES
+
+_table = QueryEmbedding.__table__
+# Stay well below SQLite's bound-parameter limit
+_CHUNK = 500
+TOUCH_INTERVAL = timedelta(minutes=10)
+RECOUNT_INTERVAL = 300
+# Eviction trims to this share of max_entries, so a full cache doesn't evict on every miss
+EVICT_TO = 0.9
+
+
+def normalize(text: str) -> str:
+    return " ".join((text or "").split())
+
+
+class EmbeddingCache:
+    def __init__(self, model_name: str, max_entries=EMBED_CACHE_MAX_ENTRIES):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._rows = None
+        self._counted_at = 0.0
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{normalize(text)}".encode("utf-8")).hexdigest()
+
+    def get_or_encode(self, texts, encode):
+        """Return embeddings for `texts`, calling encode(list_of_texts) only for cache misses."""
+        texts = list(texts)
+        keys = [self.key(t) for t in texts]
+        unique = list(dict.fromkeys(keys))
+        now = datetime.utcnow()
+
+        found, stale = {}, []
+        with engine.connect() as conn:
+            for i in range(0, len(unique), _CHUNK):
+                chunk = unique[i:i + _CHUNK]
+                rows = conn.execute(select(_table.c.text_hash, _table.c.embedding, _table.c.last_used)
+                                    .where(_table.c.text_hash.in_(chunk)))
+                for text_hash, blob, last_used in rows:
+                    found[text_hash] = np.frombuffer(blob, dtype="float32")
+                    if last_used is None or now - last_used > TOUCH_INTERVAL:
+                        stale.append(text_hash)
+        if stale:
+            with engine.begin() as conn:
+                for i in range(0, len(stale), _CHUNK):
+                    conn.execute(update(_table).where(_table.c.text_hash.in_(stale[i:i + _CHUNK])).values(last_used=now))
+
+        missing = [k for k in unique if k not in found]
+        if missing:
+            first_text = {}
+            for k, t in zip(keys, texts):
+                first_text.setdefault(k, t)
+            vecs = np.asarray(encode([first_text[k] for k in missing]), dtype="float32")
+            with engine.begin() as conn:
+                inserted = conn.execute(insert_or_ignore(_table), [
+                    {"text_hash": k, "embedding": v.tobytes(), "last_used": now} for k, v in zip(missing, vecs)
+                ]).rowcount
+            found.update(zip(missing, vecs))
+            self._added(max(inserted, 0))
+
+        with self._lock:
+            self.hits += len(unique) - len(missing)
+            self.misses += len(missing)
+        return np.vstack([found[k] for k in keys]) if keys else np.empty((0, 0), dtype="float32")
+
+    def _added(self, inserted):
+        """Update the running row count after an insert, evicting once it passes max_entries."""
+        with self._lock:
+            recount = self._rows is None or time.monotonic() - self._counted_at > RECOUNT_INTERVAL
+            if not recount:
+                self._rows += inserted
+                if self._rows <= self.max_entries:
+                    return
+        self._evict()
+
+    def _evict(self):
+        with engine.begin() as conn:
+            rows = conn.execute(select(func.count()).select_from(_table)).scalar_one()
+            removed = 0
+            if rows > self.max_entries:
+                excess = rows - int(self.max_entries * EVICT_TO)
+                oldest = select(_table.c.text_hash).order_by(_table.c.last_used).limit(excess)
+                removed = conn.execute(delete(_table).where(_table.c.text_hash.in_(oldest))).rowcount
+        with self._lock:
+            self._rows = rows - removed
+            self._counted_at = time.monotonic()
+            self.evictions += removed
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def clear(self):
+        with engine.begin() as conn:
+            conn.execute(delete(_table))
+        with self._lock:
+            self._rows = 0
@@ -0,0 +1,268 @@
+"""
+Fake IMAP Server
+A local, read-only IMAP server for imap_fetcher.py with one INBOX of generated
+support emails: plain text, multipart/alternative, HTML-only, and plain text with
+a PDF attachment of --attach-kb. It answers just what the fetcher and the IDLE
+listener use - LOGIN, SELECT/EXAMINE, UID SEARCH, UID FETCH of UID, BODYSTRUCTURE,
+BODY.PEEK[] / [HEADER] / [section]<origin.count>, NOOP and IDLE - and counts the
+bytes it sends. server.deliver() adds mail and pushes "* N EXISTS" to idling
+clients; server.drop_idle() hangs up on them, as a server restart would.
+
+    python fake_imap.py --port 1143 --messages 200 --attach-kb 2048
+    IMAP_SSL=0 IMAP_HOST=127.0.0.1 IMAP_PORT=1143 IMAP_USER=me IMAP_PASS=x python imap_fetcher.py
+"""
+
+import argparse
+import email
+import random
+import re
+import select
+import socketserver
+import threading
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+from email.utils import format_datetime, make_msgid
+from datetime import datetime, timedelta
+
+UIDVALIDITY = 1
+# How often an idling connection checks for new mail or a DONE from the client
+IDLE_POLL_SECONDS = 0.05
+FETCH_ITEM_RE = re.compile(r"BODY\.PEEK\[([^\]]*)\](?:<(\d+)\.(\d+)>)?|BODYSTRUCTURE|UID", re.I)
+
+
+def make_messages(n, attach_kb=1024, first=0):
+    """Generate `n` RFC822 messages cycling through plain, alternative, HTML-only and attachment layouts.
+
+    Messages are numbered from `first`, so later deliveries get their own order numbers.
+    """
+    rng = random.Random(42 + first)
+    start = datetime(2024, 1, 1, 9, 0)
+    messages = []
+    for i in range(first, first + n):
+        text = (f"Hello,\n\nMy order #{1000 + i} has not arrived yet and the tracking page shows error E-{1000 + i % 50}.\n"
+                "Could you please check what happened?\n\nThanks,\nCustomer\n")
+        html = "<html><head><style>p {color: red}</style></head><body>" + "".join(
+            f"<p>{line}</p>" for line in text.splitlines() if line) + "</body></html>"
+        kind = i % 4
+        if kind == 0:
+            msg = MIMEText(text, "plain", "utf-8")
+        elif kind == 1:
+            msg = MIMEMultipart("alternative")
+            msg.attach(MIMEText(text, "plain", "utf-8"))
+            msg.attach(MIMEText(html, "html", "utf-8"))
+        elif kind == 2:
+            msg = MIMEText(html, "html", "utf-8")
+        else:
+            msg = MIMEMultipart("mixed")
+            msg.attach(MIMEText(text, "plain", "utf-8"))
+            pdf = MIMEApplication(rng.randbytes(attach_kb * 1024), "pdf")
+            pdf.add_header("Content-Disposition", "attachment", filename=f"invoice-{1000 + i}.pdf")
+            msg.attach(pdf)
+        msg["From"] = f"customer{i}@example.com"
+        msg["To"] = "support@example.com"
+        msg["Subject"] = f"Order #{1000 + i} not delivered"
+        msg["Date"] = format_datetime(start + timedelta(minutes=i))
+        msg["Message-ID"] = make_msgid(f"fake{i}")
+        messages.append(msg.as_bytes())
+    return messages
+
+
+def _quote(value):
+    return "NIL" if value is None else '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def bodystructure(part) -> str:
+    if part.is_multipart():
+        return "(" + "".join(bodystructure(p) for p in part.get_payload()) + f" {_quote(part.get_content_subtype().upper())})"
+    params = part.get_params()[1:] if part.get_params() else []
+    param_list = "(" + " ".join(f"{_quote(k.upper())} {_quote(v)}" for k, v in params) + ")" if params else "NIL"
+    payload = part.get_payload()
+    encoding = part.get("Content-Transfer-Encoding", "7BIT").upper()
+    fields = [_quote(part.get_content_maintype().upper()), _quote(part.get_content_subtype().upper()), param_list,
+              "NIL", "NIL", _quote(encoding), str(len(payload.encode()))]
+    if part.get_content_maintype() == "text":
+        fields.append(str(payload.count("\n")))
+    disposition = part.get_content_disposition()
+    if disposition:
+        filename = part.get_filename()
+        disp_params = f"({_quote('FILENAME')} {_quote(filename)})" if filename else "NIL"
+        fields += ["NIL", f"({_quote(disposition.upper())} {disp_params})"]
+    return "(" + " ".join(fields) + ")"
+
+
+def section_bytes(msg, raw, section) -> bytes:
+    if section == "":
+        return raw
+    if section.upper() == "HEADER":
+        end = raw.find(b"\n\n")
+        return raw[:end + 2] if end >= 0 else raw
+    part = msg
+    for n in section.split("."):
+        part = part.get_payload()[int(n) - 1] if part.is_multipart() else part
+    return part.get_payload().encode()
+
+
+def _uid_set(spec, uids):
+    top = max(uids, default=0)
+    wanted = set()
+    for piece in spec.split(","):
+        lo, _, hi = piece.partition(":")
+        lo = top if lo == "*" else int(lo)
+        hi = lo if not hi else top if hi == "*" else int(hi)
+        wanted.update(range(min(lo, hi), max(lo, hi) + 1))
+    return [u for u in uids if u in wanted]
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, messages=100, attach_kb=1024):
+        super().__init__(address, FakeIMAPHandler)
+        self.attach_kb = attach_kb
+        raws = make_messages(messages, attach_kb)
+        # uid -> (raw bytes, parsed message)
+        self.mailbox = {uid: (raw, email.message_from_bytes(raw)) for uid, raw in enumerate(raws, start=1)}
+        self.lock = threading.Lock()
+        self.counts = {"connections": 0, "fetches": 0, "bytes": 0, "idles": 0}
+        # Bumped by drop_idle(); an idling connection that sees a new value hangs up
+        self.generation = 0
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def uids(self):
+        with self.lock:
+            return sorted(self.mailbox)
+
+    def deliver(self, n=1):
+        """Add `n` generated messages; idling clients get "* N EXISTS". Returns their UIDs."""
+        with self.lock:
+            top = max(self.mailbox, default=0)
+            raws = make_messages(n, self.attach_kb, first=top)
+            new = list(range(top + 1, top + 1 + n))
+            for uid, raw in zip(new, raws):
+                self.mailbox[uid] = (raw, email.message_from_bytes(raw))
+        return new
+
+    def drop_idle(self):
+        """Disconnect every client currently in IDLE with "* BYE"."""
+        with self.lock:
+            self.generation += 1
+
+
+class FakeIMAPHandler(socketserver.StreamRequestHandler):
+    def send(self, data: bytes):
+        self.wfile.write(data)
+        self.server.count("bytes", len(data))
+
+    def handle(self):
+        server = self.server
+        server.count("connections")
+        self.send(b"* OK [CAPABILITY IMAP4rev1 IDLE] fake-imap ready\r\n")
+        uids = server.uids()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            uids = server.uids()
+            tag, _, rest = line.decode(errors="replace").strip().partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+            if command == "UID":
+                command, _, args = args.partition(" ")
+                command = "UID " + command.upper()
+            if command == "CAPABILITY":
+                self.send(b"* CAPABILITY IMAP4rev1 IDLE\r\n")
+            elif command in ("SELECT", "EXAMINE"):
+                self.send(f"* {len(uids)} EXISTS\r\n* OK [UIDVALIDITY {UIDVALIDITY}] UIDs valid\r\n"
+                          f"* OK [UIDNEXT {max(uids, default=0) + 1}] Predicted next UID\r\n".encode())
+            elif command == "UID SEARCH":
+                spec = args.split()[-1]
+                self.send(("* SEARCH " + " ".join(map(str, _uid_set(spec, uids))) + "\r\n").encode())
+            elif command == "UID FETCH":
+                spec, _, items = args.partition(" ")
+                for uid in _uid_set(spec, uids):
+                    self.fetch(uid, uids.index(uid) + 1, items)
+            elif command == "IDLE":
+                if not self.idle(tag, len(uids)):
+                    return
+                continue
+            elif command == "NOOP":
+                self.send(f"* {len(uids)} EXISTS\r\n".encode())
+            elif command == "LOGOUT":
+                self.send(b"* BYE fake-imap closing\r\n" + f"{tag} OK LOGOUT completed\r\n".encode())
+                return
+            elif command not in ("LOGIN", "CLOSE"):
+                self.send(f"{tag} BAD Command not implemented\r\n".encode())
+                continue
+            self.send(f"{tag} OK {command} completed\r\n".encode())
+
+    def idle(self, tag, reported):
+        """Serve one IDLE until the client sends DONE. Returns False if the connection was dropped."""
+        server = self.server
+        server.count("idles")
+        generation = server.generation
+        self.send(b"+ idling\r\n")
+        while True:
+            readable, _, _ = select.select([self.connection], [], [], IDLE_POLL_SECONDS)
+            if readable:
+                line = self.rfile.readline()
+                if not line:
+                    return False
+                if line.strip().upper() == b"DONE":
+                    self.send(f"{tag} OK IDLE terminated\r\n".encode())
+                    return True
+                self.send(f"{tag} BAD Expected DONE\r\n".encode())
+                return True
+            if server.generation != generation:
+                self.send(b"* BYE fake-imap going away\r\n")
+                return False
+            exists = len(server.uids())
+            if exists > reported:
+                reported = exists
+                self.send(f"* {exists} EXISTS\r\n".encode())
+
+    def fetch(self, uid, seq, items):
+        raw, msg = self.server.mailbox[uid]
+        self.server.count("fetches")
+        out = [f"* {seq} FETCH (UID {uid}".encode()]
+        for m in FETCH_ITEM_RE.finditer(items):
+            word = m.group(0).upper()
+            if word == "UID":
+                continue
+            if word == "BODYSTRUCTURE":
+                out.append(f" BODYSTRUCTURE {bodystructure(msg)}".encode())
+                continue
+            section, origin, count = m.groups()
+            data = section_bytes(msg, raw, section)
+            key = f"BODY[{section.upper()}]"
+            if origin is not None:
+                data = data[int(origin):int(origin) + int(count)]
+                key += f"<{origin}>"
+            out.append(f" {key} {{{len(data)}}}\r\n".encode() + data)
+        out.append(b")\r\n")
+        self.send(b"".join(out))
+
+
+def start(port=0, **options):
+    """Start a FakeIMAPServer on a background thread and return it (server.server_address[1] has the port)."""
+    server = FakeIMAPServer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=1143)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--attach-kb", type=int, default=1024, help="size of the PDF attached to every fourth message")
+    args = parser.parse_args()
+    server = FakeIMAPServer(("127.0.0.1", args.port), args.messages, args.attach_kb)
+    print(f"📬 Fake IMAP server listening on 127.0.0.1:{args.port} with {args.messages} messages")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Stopping fake IMAP server: {server.counts}")
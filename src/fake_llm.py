@@ -0,0 +1,147 @@
+"""
+Fake LLM Endpoint
+A local stand-in for the Gemini REST API (POST /v1beta/models/<model>:generateContent
+and :streamGenerateContent) that answers with a canned reply after a configurable
+delay and injects 429 throttling and 503 errors at the given rates. Use it to
+exercise draft_worker.py and streamed drafts without an API key or quota:
+
+    python fake_llm.py --port 8001 --latency-ms 400 --throttle-rate 0.1 --error-rate 0.05
+    GOOGLE_API_KEY=fake GEMINI_TRANSPORT=rest GEMINI_API_ENDPOINT=http://127.0.0.1:8001 python draft_worker.py
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GENERATE_RE = re.compile(r"^/v1beta/models/([^/:]+):(generateContent|streamGenerateContent)")
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency_ms=300, jitter_ms=100, throttle_rate=0.0, error_rate=0.0, max_concurrent=0,
+                 chunk_ms=30):
+        super().__init__(address, FakeLLMHandler)
+        self.latency_ms = latency_ms
+        # Delay between streamed chunks after the first one
+        self.chunk_ms = chunk_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        # Requests beyond this many in flight get a 429, like a per-key concurrency quota (0 = unlimited)
+        self.max_concurrent = max_concurrent
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.counts = {"requests": 0, "ok": 0, "throttled": 0, "errors": 0, "peak_in_flight": 0}
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, text, usage):
+        """Send `text` a few words per response object, streamed as one JSON array like streamGenerateContent."""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        words = text.split(" ")
+        self.wfile.write(b"[")
+        for i in range(0, len(words), 4):
+            if i:
+                time.sleep(self.server.chunk_ms / 1000)
+            piece = " ".join(words[i:i + 4]) + (" " if i + 4 < len(words) else "")
+            last = i + 4 >= len(words)
+            candidate = {"content": {"role": "model", "parts": [{"text": piece}]}, "index": 0}
+            if last:
+                candidate["finishReason"] = "STOP"
+            event = {"candidates": [candidate], **({"usageMetadata": usage} if last else {})}
+            self.wfile.write((b",\r\n" if i else b"") + json.dumps(event).encode())
+            self.wfile.flush()
+        self.wfile.write(b"]")
+
+    def _error(self, status, reason, message):
+        self._reply(status, {"error": {"code": status, "message": message, "status": reason}})
+
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        match = GENERATE_RE.match(self.path)
+        if not match:
+            return self._error(404, "NOT_FOUND", f"Unknown path {self.path}")
+        server.count("requests")
+
+        with server.lock:
+            server.in_flight += 1
+            server.counts["peak_in_flight"] = max(server.counts["peak_in_flight"], server.in_flight)
+            over_quota = server.max_concurrent and server.in_flight > server.max_concurrent
+        try:
+            roll = random.random()
+            if over_quota or roll < server.throttle_rate:
+                server.count("throttled")
+                return self._error(429, "RESOURCE_EXHAUSTED", "Resource has been exhausted (e.g. check quota).")
+            time.sleep(max(0.0, server.latency_ms + random.uniform(-server.jitter_ms, server.jitter_ms)) / 1000)
+            if roll < server.throttle_rate + server.error_rate:
+                server.count("errors")
+                return self._error(503, "UNAVAILABLE", "The model is overloaded. Please try again later.")
+
+            prompt = " ".join(p.get("text", "") for c in request.get("contents", []) for p in c.get("parts", []))
+            text = (f"Hello,\n\nThank you for reaching out. We are looking into your request and will "
+                    f"follow up shortly.\n\nBest regards,\nSupport Team\n\n[fake reply to a {len(prompt)}-char prompt]")
+            usage = {"promptTokenCount": len(prompt) // 4, "candidatesTokenCount": len(text) // 4,
+                     "totalTokenCount": (len(prompt) + len(text)) // 4}
+            server.count("ok")
+            if match.group(2) == "streamGenerateContent":
+                return self._stream(text, usage)
+            self._reply(200, {
+                "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "finishReason": "STOP", "index": 0}],
+                "usageMetadata": usage,
+            })
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+
+def start(port=0, **options):
+    """Start a FakeLLMServer on a background thread and return it (server.server_port has the port)."""
+    server = FakeLLMServer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--chunk-ms", type=float, default=30, help="delay between streamed chunks")
+    parser.add_argument("--max-concurrent", type=int, default=0, help="429 requests beyond this many in flight")
+    args = parser.parse_args()
+    server = FakeLLMServer(("127.0.0.1", args.port), args.latency_ms, args.jitter_ms,
+                           args.throttle_rate, args.error_rate, args.max_concurrent, args.chunk_ms)
+    print(f"🤖 Fake LLM listening on http://127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Stopping fake LLM: {server.counts}")
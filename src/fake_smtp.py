@@ -0,0 +1,92 @@
+"""
+Fake SMTP Server
+A local debugging SMTP sink for sender.py: accepts every message, stores nothing,
+and can simulate the cost of a new session (TLS handshake + login) with a delay
+before the greeting, plus a server that drops the session after N messages.
+
+    python fake_smtp.py --port 1025 --connect-ms 300 --drop-after 40
+    SMTP_HOST=127.0.0.1 SMTP_PORT=1025 SMTP_STARTTLS=0 SMTP_USER= python sender.py
+"""
+
+import argparse
+import socketserver
+import threading
+import time
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, connect_ms=0, message_ms=0, drop_after=0):
+        super().__init__(address, FakeSMTPHandler)
+        self.connect_ms = connect_ms
+        self.message_ms = message_ms
+        # Answer 421 and hang up after this many messages in one session (0 = never)
+        self.drop_after = drop_after
+        self.lock = threading.Lock()
+        self.counts = {"connections": 0, "messages": 0, "dropped": 0}
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b"\r\n")
+
+    def handle(self):
+        server = self.server
+        server.count("connections")
+        time.sleep(server.connect_ms / 1000)
+        self.reply("220 fake-smtp ready")
+        messages = 0
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            verb = line.decode(errors="replace").strip().split(" ", 1)[0].upper()
+            if verb == "EHLO":
+                self.wfile.write(b"250-fake-smtp\r\n250-8BITMIME\r\n250 SIZE 10485760\r\n")
+            elif verb in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif verb == "DATA":
+                if server.drop_after and messages >= server.drop_after:
+                    server.count("dropped")
+                    self.reply("421 Too many messages in this session")
+                    return
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while self.rfile.readline() not in (b".\r\n", b".\n", b""):
+                    pass
+                time.sleep(server.message_ms / 1000)
+                messages += 1
+                server.count("messages")
+                self.reply("250 OK queued")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+def start(port=0, **options):
+    """Start a FakeSMTPServer on a background thread and return it (server.server_address[1] has the port)."""
+    server = FakeSMTPServer(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=1025)
+    parser.add_argument("--connect-ms", type=float, default=0, help="delay before the greeting, like a TLS handshake + login")
+    parser.add_argument("--message-ms", type=float, default=0, help="delay before accepting each message")
+    parser.add_argument("--drop-after", type=int, default=0, help="answer 421 and disconnect after N messages per session")
+    args = parser.parse_args()
+    server = FakeSMTPServer(("127.0.0.1", args.port), args.connect_ms, args.message_ms, args.drop_after)
+    print(f"📮 Fake SMTP server listening on 127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"Stopping fake SMTP server: {server.counts}")
@@ -1,13 +1,40 @@
 import imaplib, email, re
+import argparse
+import hashlib
 import time
-import random
+from concurrent.futures import ProcessPoolExecutor
 from email.header import decode_header
+from email.parser import BytesHeaderParser
 from datetime import datetime
-from config import IMAP_HOST, IMAP_USER, IMAP_PASS, IMAP_FOLDER, PROCESS_BATCH
-from db import engine
+from config import (IMAP_HOST, IMAP_PORT, IMAP_SSL, IMAP_USER, IMAP_PASS, IMAP_FOLDER, PROCESS_BATCH,
+                    IMAP_FETCH_CHUNK, IMAP_PARSE_WORKERS, IMAP_BODY_MAX_BYTES)
+from mime_body import decode_part, html_to_text, parse_fetch, split_parts, walk_structure
+from db import engine, init_db
+from threads import link_outbox_replies, parse_msgids, thread_root
 from sqlalchemy import text
 
-SUPPORT_TERMS = re.compile(r"\b(support|query|request|help)\b", re.I)
+INSERT_EMAIL = text("""
+    INSERT INTO emails (id, message_id, in_reply_to, reference_ids, thread_id, sender, subject, body,
+                        date_received, support, status)
+    VALUES (:id, :message_id, :in_reply_to, :reference_ids, :thread_id, :sender, :subject, :body,
+            :received_at, :is_support, :status)
+    ON CONFLICT DO NOTHING
+""")
+
+INSERT_ATTACHMENT = text("""
+    INSERT INTO attachments (email_id, section, filename, content_type, size, disposition)
+    VALUES (:email_id, :section, :filename, :type, :size, :disposition)
+    ON CONFLICT DO NOTHING
+""")
+
+SAVE_SYNC_STATE = text("""
+    INSERT INTO sync_state (folder, uidvalidity, last_uid, updated_at)
+    VALUES (:folder, :uidvalidity, :last_uid, :updated_at)
+    ON CONFLICT (folder) DO UPDATE SET
+        uidvalidity = excluded.uidvalidity, last_uid = excluded.last_uid, updated_at = excluded.updated_at
+""")
+
+UID_RE = re.compile(rb"\bUID (\d+)")
 
 def _decode(val):
     if isinstance(val, bytes):
@@ -28,65 +55,291 @@ def _decode_header(h):
             s += txt
     return s
 
-def fetch_and_store(limit=50):
+def make_email_id(message_id, sender="", date="", subject="", body=""):
+    """Deterministic email id: HKU + 16 hex chars of a hash of the Message-ID.
+
+    Messages without a Message-ID are hashed on their sender, date, subject and
+    body instead, so a re-delivery of the same message always maps to the same
+    row and the insert's ON CONFLICT DO NOTHING drops it.
+    """
+    if message_id:
+        key = message_id.strip()
+    else:
+        key = "\0".join([sender or "", date or "", subject or "", body or ""])
+    return "HKU" + hashlib.sha256(key.encode("utf-8", errors="ignore")).hexdigest()[:16].upper()
+
+def _make_row(msg, body) -> dict:
+    """Build an emails row from a parsed message (or just its headers) and its body text."""
+    message_id = (msg.get("Message-ID") or "").strip() or None
+    in_reply_to = " ".join(parse_msgids(msg.get("In-Reply-To"))) or None
+    references = " ".join(parse_msgids(msg.get("References"))) or None
+    sender = email.utils.parseaddr(msg.get("From",""))[1]
+    subject = _decode_header(msg.get("Subject", ""))
+    date_str = msg.get("Date")
+    try:
+        received_at = datetime.fromtimestamp(email.utils.mktime_tz(email.utils.parsedate_tz(date_str)))
+    except Exception:
+        received_at = datetime.utcnow()
+    email_id = make_email_id(message_id, sender, date_str, subject, body)
+    root = thread_root(message_id, in_reply_to, references)
+    return dict(
+        id=email_id,
+        message_id=message_id,
+        in_reply_to=in_reply_to,
+        reference_ids=references,
+        thread_id=make_email_id(root) if root else email_id,
+        sender=sender,
+        subject=subject,
+        body=body,
+        received_at=received_at,
+        # Support type is scored by the rule engine during NLP analysis
+        is_support='No',
+        status='pending',
+    )
+
+def _body_text(texts) -> str:
+    """Join decoded (content type, text) parts, converting HTML to plain text."""
+    return "".join(html_to_text(t) if ctype == "text/html" else t for ctype, t in texts)
+
+def _parse_parts(header: bytes, texts, attachments):
+    """Build an emails row from headers and downloaded text parts. Runs in worker processes.
+
+    `texts` are (part, raw bytes) pairs from BODYSTRUCTURE; returns (row, attachments).
+    """
+    msg = BytesHeaderParser().parsebytes(header or b"")
+    body = _body_text((part["type"], decode_part(raw, part["encoding"], part["charset"])) for part, raw in texts)
+    return _make_row(msg, body), attachments
+
+def _leaf_parts(part, section=""):
+    """Yield (IMAP section number, part) for each leaf of a parsed message."""
+    if part.is_multipart() and part.get_content_type() != "message/rfc822":
+        for i, child in enumerate(part.get_payload()):
+            yield from _leaf_parts(child, f"{section}.{i + 1}" if section else str(i + 1))
+    else:
+        yield section or "1", part
+
+def _encoded_size(part) -> int:
+    """Size of a part's encoded body, as BODYSTRUCTURE reports it."""
+    if part.is_multipart():
+        # message/rfc822 (or a multipart kept whole) holds parsed messages, not a string
+        return sum(len(sub.as_bytes()) for sub in part.get_payload())
+    payload = part.get_payload()
+    return len(payload.encode("utf-8", "surrogateescape")) if isinstance(payload, str) else 0
+
+def _parse_message(raw: bytes):
+    """Parse a whole RFC822 message into (row, attachments), for servers whose BODYSTRUCTURE we can't read."""
+    msg = email.message_from_bytes(raw)
+    plain, html, attachments = [], [], []
+    for section, part in _leaf_parts(msg):
+        ctype = part.get_content_type()
+        disp = part.get_content_disposition()
+        filename = part.get_filename()
+        if disp != "attachment" and not filename and ctype in ("text/plain", "text/html"):
+            payload = part.get_payload(decode=True)
+            if payload:
+                (plain if ctype == "text/plain" else html).append((ctype, _decode(payload)))
+        elif disp == "attachment" or filename or not ctype.startswith("text/"):
+            attachments.append({"section": section, "type": ctype, "size": _encoded_size(part),
+                                "disposition": disp, "filename": filename})
+    return _make_row(msg, _body_text(plain or html)), attachments
+
+def _message_set(ids):
+    """Compress message numbers/UIDs into an IMAP set, e.g. [1, 2, 3, 7] -> b"1:3,7"."""
+    nums = sorted(int(i) for i in ids)
+    ranges = []
+    start = prev = nums[0]
+    for n in nums[1:]:
+        if n != prev + 1:
+            ranges.append(f"{start}:{prev}" if start != prev else f"{start}")
+            start = n
+        prev = n
+    ranges.append(f"{start}:{prev}" if start != prev else f"{start}")
+    return ",".join(ranges).encode()
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def _fetch_raw(m, uids, fetch_item="(UID BODY.PEEK[])"):
+    """Fetch a whole UID set in one round trip and return (uid, raw bytes) pairs.
+
+    BODY.PEEK[] leaves the \\Seen flag alone, so people reading the mailbox are unaffected.
+    """
+    typ, data = m.uid("FETCH", _message_set(uids), fetch_item)
+    if typ != "OK":
+        raise imaplib.IMAP4.error(f"FETCH failed: {data}")
+    # Literal responses come back as (b'N (UID 123 BODY[] {size}', raw) tuples interleaved with b')'
+    results = []
+    for item in data:
+        if isinstance(item, tuple):
+            uid = UID_RE.search(item[0])
+            results.append((int(uid.group(1)) if uid else None, item[1]))
+    return results
+
+def _fetch_structures(m, uids):
+    """Fetch headers and BODYSTRUCTURE for a UID set in one round trip.
+
+    Returns ({uid: (header bytes, text parts, attachments)}, [uids whose structure
+    could not be read]); no part content is downloaded.
+    """
+    typ, data = m.uid("FETCH", _message_set(uids), "(UID BODYSTRUCTURE BODY.PEEK[HEADER])")
+    if typ != "OK":
+        raise imaplib.IMAP4.error(f"FETCH failed: {data}")
+    plans, unreadable = {}, []
+    try:
+        fetched = parse_fetch(data)
+    except ValueError as e:
+        print(f"⚠️ Could not parse BODYSTRUCTURE ({e}), fetching whole messages instead.")
+        return {}, list(uids)
+    for uid in uids:
+        fields = fetched.get(uid)
+        if fields is None:
+            # Expunged since the UID SEARCH
+            continue
+        try:
+            text_parts, attachments = split_parts(list(walk_structure(fields["BODYSTRUCTURE"])))
+        except (KeyError, IndexError, TypeError):
+            unreadable.append(uid)
+            continue
+        plans[uid] = (fields.get("BODY[HEADER]") or b"", text_parts, attachments)
+    return plans, unreadable
+
+def _fetch_text_parts(m, plans, max_bytes=IMAP_BODY_MAX_BYTES):
+    """Download the first `max_bytes` of each planned text part: {uid: {section: raw bytes}}.
+
+    Messages sharing the same part layout (most of them: "1" or "1.1") are fetched
+    together with one UID FETCH per layout.
+    """
+    layouts = {}
+    for uid, (_, text_parts, _) in plans.items():
+        if text_parts:
+            layouts.setdefault(tuple(p["section"] for p in text_parts), []).append(uid)
+    contents = {}
+    for sections, uids in layouts.items():
+        items = " ".join(f"BODY.PEEK[{section}]<0.{max_bytes}>" for section in sections)
+        typ, data = m.uid("FETCH", _message_set(uids), f"(UID {items})")
+        if typ != "OK":
+            raise imaplib.IMAP4.error(f"FETCH failed: {data}")
+        for uid, fields in parse_fetch(data).items():
+            contents[uid] = {section: fields.get(f"BODY[{section}]") or b"" for section in sections}
+    return contents
+
+def _load_sync_state(folder):
+    with engine.connect() as conn:
+        row = conn.execute(text("SELECT uidvalidity, last_uid FROM sync_state WHERE folder = :folder"),
+                           dict(folder=folder)).first()
+    return (row.uidvalidity, row.last_uid) if row else (None, 0)
+
+def connect():
+    """Open and log in an IMAP connection (plain IMAP when IMAP_SSL=0, e.g. a local test server)."""
     print("Connecting to IMAP...", IMAP_HOST)
-    m = imaplib.IMAP4_SSL(IMAP_HOST)
+    m = imaplib.IMAP4_SSL(IMAP_HOST, IMAP_PORT) if IMAP_SSL else imaplib.IMAP4(IMAP_HOST, IMAP_PORT)
     m.login(IMAP_USER, IMAP_PASS)
-    m.select(IMAP_FOLDER)
-    typ, data = m.search(None, "UNSEEN")
-    ids = data[0].split()
-    if not ids:
-        print("No unseen emails.")
-        m.logout()
-        return
-    ids = ids[-limit:]
-    print(f"Found {len(ids)} unseen messages (processing up to {limit})")
-
-    with engine.begin() as conn:
-        for i in ids:
-            typ, msg_data = m.fetch(i, "(RFC822)")
-            raw = msg_data[0][1]
-            msg = email.message_from_bytes(raw)
-            #msg_id = msg.get("Message-ID") or str(i)
-            sender = email.utils.parseaddr(msg.get("From",""))[1]
-            subject = _decode_header(msg.get("Subject", ""))
-            date_str = msg.get("Date")
-            try:
-                received_at = datetime.fromtimestamp(email.utils.mktime_tz(email.utils.parsedate_tz(date_str)))
-            except Exception:
-                received_at = datetime.utcnow()
-
-            body = ""
-            if msg.is_multipart():
-                for part in msg.walk():
-                    ctype = part.get_content_type()
-                    disp = str(part.get("Content-Disposition"))
-                    if ctype == "text/plain" and "attachment" not in disp:
-                        payload = part.get_payload(decode=True)
-                        if payload:
-                            body += _decode(payload)
+    return m
+
+def select_folder(m, folder=IMAP_FOLDER) -> int:
+    """Open `folder` read-only and return its UIDVALIDITY."""
+    typ, data = m.select(folder, readonly=True)
+    if typ != "OK":
+        raise imaplib.IMAP4.error(f"SELECT {folder} failed: {data}")
+    return int(m.response("UIDVALIDITY")[1][0])
+
+def _uids_to_sync(m, folder, uidvalidity, limit, backfill):
+    """Work out the next page of UIDs to fetch for `folder`."""
+    stored_validity, last_uid = _load_sync_state(folder)
+    first_sync = stored_validity is None
+    if not first_sync and stored_validity != uidvalidity:
+        print(f"⚠️ UIDVALIDITY of {folder} changed ({stored_validity} -> {uidvalidity}), resyncing.")
+        first_sync, last_uid = True, 0
+
+    typ, data = m.uid("SEARCH", None, f"UID {last_uid + 1}:*")
+    # "n:*" always matches the highest UID, even when it is below n
+    uids = [int(u) for u in data[0].split() if int(u) > last_uid]
+    if first_sync and not backfill:
+        # Without a backfill, a new folder starts from its most recent messages
+        uids = uids[-limit:]
+    return uids[:limit]
+
+def sync_folder(m, folder, uidvalidity, limit=50, backfill=False, chunk_size=IMAP_FETCH_CHUNK, workers=IMAP_PARSE_WORKERS):
+    """Fetch and store the next page of new messages on an already selected connection.
+
+    Returns the number of UIDs fetched, so callers can keep paging while it equals `limit`.
+    """
+    uids = _uids_to_sync(m, folder, uidvalidity, limit, backfill)
+    if not uids:
+        print("No new emails.")
+        return 0
+    print(f"Found {len(uids)} new messages in {folder} (processing up to {limit})")
+
+    started = time.perf_counter()
+    stored = duplicates = downloaded = 0
+    # Spinning up worker processes only pays off for a reasonably sized batch
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 and len(uids) >= 4 * workers else None
+    try:
+        for chunk in _chunks(uids, chunk_size):
+            plans, unreadable = _fetch_structures(m, chunk)
+            contents = _fetch_text_parts(m, plans)
+            jobs = [(header, [(p, contents.get(uid, {}).get(p["section"], b"")) for p in text_parts], attachments)
+                    for uid, (header, text_parts, attachments) in plans.items()]
+            downloaded += sum(len(raw) for parts in contents.values() for raw in parts.values())
+            downloaded += sum(len(header) for header, _, _ in jobs)
+            headers, texts, attachments = zip(*jobs) if jobs else ((), (), ())
+            if pool:
+                parsed = pool.map(_parse_parts, headers, texts, attachments, chunksize=max(1, len(jobs) // (workers * 4)))
             else:
-                if msg.get_content_type() == "text/plain":
-                    payload = msg.get_payload(decode=True)
-                    if payload:
-                        body = _decode(payload)
+                parsed = map(_parse_parts, headers, texts, attachments)
+            results = list(parsed)
+            if unreadable:
+                raws = [raw for _, raw in _fetch_raw(m, unreadable)]
+                downloaded += sum(len(raw) for raw in raws)
+                results += map(_parse_message, raws)
+            rows = [row for row, _ in results]
+            attachment_rows = [dict(a, email_id=row["id"]) for row, attachments in results for a in attachments]
+            inserted = 0
+            with engine.begin() as conn:
+                if rows:
+                    inserted = conn.execute(INSERT_EMAIL, rows).rowcount
+                if attachment_rows:
+                    conn.execute(INSERT_ATTACHMENT, attachment_rows)
+                link_outbox_replies(conn, [row["id"] for row in rows if row["in_reply_to"]])
+                conn.execute(SAVE_SYNC_STATE, dict(folder=folder, uidvalidity=uidvalidity,
+                                                   last_uid=max(chunk), updated_at=datetime.utcnow()))
+            stored += inserted
+            duplicates += len(rows) - inserted
+            print(f"Stored {stored}/{len(uids)} messages (up to UID {max(chunk)})")
+    finally:
+        if pool:
+            pool.shutdown()
+    elapsed = time.perf_counter() - started
+    print(f"Done. {stored} messages in {elapsed:.1f}s ({stored / elapsed if elapsed else 0:.1f} msg/s), "
+          f"{downloaded / 1024:.0f} KB downloaded, {duplicates} duplicates skipped")
+    return len(uids)
 
-            is_support = 'Yes' if SUPPORT_TERMS.search(subject or "") else 'No'
-            status = 'pending'
-            # Generate short unique ID: HKU + timestamp last 4 digits + random 2 digits
-            timestamp = str(int(time.time()))[-4:]
-            random_num = f"{random.randint(10, 99)}"
-            id = f"HKU{timestamp}{random_num}"
+def fetch_and_store(limit=50, backfill=False, folder=IMAP_FOLDER, chunk_size=IMAP_FETCH_CHUNK, workers=IMAP_PARSE_WORKERS):
+    """Fetch messages that arrived since the last run and store them.
 
-            conn.execute(text("""
-                INSERT OR IGNORE INTO emails (id, sender, subject, body, date_received, support, status)
-                VALUES (:id, :sender, :subject, :body, :received_at, :is_support, :status)
-            """), dict(id=id, sender=sender, subject=subject, body=body, received_at=received_at, is_support=is_support, status=status))
-            print("Stored:", subject[:80], "from", sender)
-    m.logout()
-    print("Done.")
+    Only UIDs above the folder's stored high-water mark are fetched (up to
+    `limit` per run, oldest first), in chunks that are parsed in a worker pool
+    and inserted in batches. The mark is advanced in the same transaction as
+    each chunk's insert, so an interrupted run resumes where it stopped. With
+    backfill=True the first sync of a folder pages through its whole history
+    instead of starting from the newest `limit` messages.
+    """
+    m = connect()
+    try:
+        uidvalidity = select_folder(m, folder)
+        return sync_folder(m, folder, uidvalidity, limit, backfill, chunk_size, workers)
+    finally:
+        m.logout()
 
 
 
 if __name__ == "__main__":
-    fetch_and_store(limit=PROCESS_BATCH)
\ No newline at end of file
+    init_db()
+    parser = argparse.ArgumentParser(description="Fetch new mail from IMAP into the emails table.")
+    parser.add_argument("--limit", type=int, default=PROCESS_BATCH, help="max messages to fetch this run")
+    parser.add_argument("--backfill", action="store_true",
+                        help="on first sync, page through the whole folder instead of starting from the newest messages")
+    parser.add_argument("--folder", default=IMAP_FOLDER)
+    args = parser.parse_args()
+    fetch_and_store(limit=args.limit, backfill=args.backfill, folder=args.folder)
@@ -0,0 +1,128 @@
+"""
+IMAP IDLE Listener
+Long-running worker that keeps an IDLE connection open on IMAP_FOLDER, ingests new
+mail within seconds of arrival and runs NLP analysis on it straight away.
+Reconnects with exponential backoff when the connection drops. Set IMAP_SSL=0 and
+IMAP_HOST/IMAP_PORT to point it at a local IMAP server for testing.
+
+Usage: python imap_idle.py
+"""
+
+import imaplib
+import random
+import re
+import select
+import ssl
+import time
+from config import IMAP_FOLDER, PROCESS_BATCH, IMAP_IDLE_TIMEOUT, IMAP_RECONNECT_MAX_BACKOFF
+from imap_fetcher import connect, select_folder, sync_folder
+from nlp import process_new_emails
+from db import init_db
+
+EXISTS_RE = re.compile(rb"^\* \d+ EXISTS")
+
+
+def _buffered(m) -> bool:
+    """True if a server line is already waiting in imaplib's read buffer or the socket."""
+    sock = m.socket()
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        return bool(m.file.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+def idle_wait(m, timeout=IMAP_IDLE_TIMEOUT) -> bool:
+    """Send IDLE and block until the server reports new mail or `timeout` seconds pass.
+
+    Returns True when an EXISTS notification arrived. Always ends the IDLE with
+    DONE and consumes the tagged reply, so the connection can be used normally.
+    """
+    tag = m._new_tag()
+    m.send(tag + b" IDLE\r\n")
+    line = m.readline()
+    if not line.startswith(b"+"):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+    got_mail = False
+    deadline = time.monotonic() + timeout
+    try:
+        while not got_mail:
+            if not _buffered(m):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                readable, _, _ = select.select([m.socket()], [], [], remaining)
+                if not readable:
+                    break
+            line = m.readline()
+            if not line or line.startswith(b"* BYE"):
+                raise imaplib.IMAP4.abort(f"server closed the connection during IDLE: {line!r}")
+            got_mail = bool(EXISTS_RE.match(line))
+    finally:
+        m.send(b"DONE\r\n")
+        while True:
+            line = m.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("connection closed while ending IDLE")
+            if line.startswith(tag):
+                break
+    return got_mail
+
+
+def ingest(m, folder, uidvalidity, limit=PROCESS_BATCH):
+    """Fetch everything above the high-water mark, page by page, then analyze it."""
+    fetched = total = sync_folder(m, folder, uidvalidity, limit)
+    while fetched == limit:
+        fetched = sync_folder(m, folder, uidvalidity, limit)
+        total += fetched
+    if total:
+        process_new_emails()
+    return total
+
+
+def run(folder=IMAP_FOLDER, idle_timeout=IMAP_IDLE_TIMEOUT, max_backoff=IMAP_RECONNECT_MAX_BACKOFF):
+    backoff = 1
+    while True:
+        m = None
+        try:
+            m = connect()
+            uidvalidity = select_folder(m, folder)
+            supports_idle = "IDLE" in m.capabilities
+            if not supports_idle:
+                print(f"⚠️ Server does not support IDLE, polling every {idle_timeout}s instead.")
+            print(f"👂 Listening for new mail in {folder}...")
+            backoff = 1
+            # Catch up on anything that arrived while we were disconnected
+            ingest(m, folder, uidvalidity)
+            while True:
+                if supports_idle:
+                    idle_wait(m, idle_timeout)
+                else:
+                    time.sleep(idle_timeout)
+                    m.noop()
+                # A sync with nothing new is a single UID SEARCH, so run it after every cycle
+                ingest(m, folder, uidvalidity)
+                m.untagged_responses.clear()
+        except KeyboardInterrupt:
+            print("Stopping IMAP listener.")
+            break
+        except Exception as e:
+            delay = backoff + random.uniform(0, backoff / 2)
+            print(f"⚠️ IMAP connection lost: {e}. Reconnecting in {delay:.0f}s...")
+            time.sleep(delay)
+            backoff = min(backoff * 2, max_backoff)
+        finally:
+            if m is not None:
+                try:
+                    m.logout()
+                except Exception:
+                    pass
+
+
+if __name__ == "__main__":
+    init_db()
+    run()
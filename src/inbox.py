@@ -0,0 +1,97 @@
+"""
+Email Queue Queries
+SQL-side filtering, pagination and column projection for the dashboard, so a
+page render only loads the rows and columns it shows.
+"""
+
+from sqlalchemy import exists, func, or_, select
+from sqlalchemy.orm import aliased, defer
+from models import Email
+
+PENDING_STATUSES = ["pending", "analyzed", "drafted", "approved"]
+
+
+def _filtered(stmt, statuses=None, exclude_statuses=None, model=Email):
+    if statuses:
+        stmt = stmt.where(model.status.in_(statuses))
+    if exclude_statuses:
+        stmt = stmt.where(model.status.not_in(exclude_statuses))
+    return stmt
+
+
+def count_emails(session, statuses=None, exclude_statuses=None) -> int:
+    stmt = _filtered(select(func.count()).select_from(Email), statuses, exclude_statuses)
+    return session.execute(stmt).scalar_one()
+
+
+def list_emails(session, statuses=None, exclude_statuses=None, page=1, page_size=25, order_by=None):
+    """One page of emails matching the status filter, with body and draft_reply deferred."""
+    if order_by is None:
+        order_by = (Email.priority.desc(), Email.date_received.desc())
+    stmt = (
+        _filtered(select(Email), statuses, exclude_statuses)
+        .options(defer(Email.body), defer(Email.draft_reply))
+        .order_by(*order_by)
+        .limit(page_size)
+        .offset((max(page, 1) - 1) * page_size)
+    )
+    return session.execute(stmt).scalars().all()
+
+
+def _thread_key():
+    # Rows stored before threading have no thread_id and form a thread of their own
+    return func.coalesce(Email.thread_id, Email.id)
+
+
+def count_threads(session, statuses=None, exclude_statuses=None) -> int:
+    stmt = _filtered(select(func.count(func.distinct(_thread_key()))).select_from(Email), statuses, exclude_statuses)
+    return session.execute(stmt).scalar_one()
+
+
+def list_threads(session, statuses=None, exclude_statuses=None, page=1, page_size=25):
+    """One page of conversations as (latest matching email, number of matching messages) rows.
+
+    Each thread collapses into its newest email that passes the status filter;
+    body and draft_reply are deferred as in list_emails(). The page is picked from
+    the status-filtered rows of the covering (status, priority, date_received,
+    thread_id, id) index, keeping an email when its thread has no newer matching
+    message (one probe of the (thread_id, date_received, status) index). Only the
+    page's emails are then loaded and their threads counted.
+    """
+    key = _thread_key()
+    other = aliased(Email)
+    newer = _filtered(
+        select(other.id).where(
+            other.thread_id == key,
+            # The >= bound lets the probe seek on (thread_id, date_received)
+            other.date_received >= Email.date_received,
+            or_(other.date_received > Email.date_received, other.id > Email.id),
+        ),
+        statuses, exclude_statuses, other,
+    )
+    heads = session.execute(
+        _filtered(select(Email.id, key.label("key")), statuses, exclude_statuses)
+        .where(~exists(newer))
+        .order_by(Email.priority.desc(), Email.date_received.desc())
+        .limit(page_size)
+        .offset((max(page, 1) - 1) * page_size)
+    ).all()
+    if not heads:
+        return []
+
+    keys = [row.key for row in heads]
+    # A root stored before threading has no thread_id but still belongs to its replies' thread
+    counts = dict(session.execute(
+        _filtered(select(key, func.count()), statuses, exclude_statuses)
+        .where(or_(Email.thread_id.in_(keys), Email.id.in_(keys)))
+        .group_by(key)
+    ).all())
+    emails = {em.id: em for em in session.execute(
+        select(Email).where(Email.id.in_([row.id for row in heads]))
+        .options(defer(Email.body), defer(Email.draft_reply))
+    ).scalars()}
+    return [(emails[row.id], counts.get(row.key, 1)) for row in heads]
+
+
+def page_count(total: int, page_size: int) -> int:
+    return max(1, -(-total // page_size))
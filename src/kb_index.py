@@ -1,68 +1,397 @@
-import faiss
-import pickle
-from sentence_transformers import SentenceTransformer
-from db import SessionLocal
-from models import KBDoc
+import argparse
+import hashlib
+import os
+import threading
+import numpy as np
+from db import SessionLocal, init_db
+from models import KBDoc, KBEmbedding
+from embed_cache import EmbeddingCache
+from response_cache import get_response_cache
+from search import rrf, search_kb
+from config import (KB_INDEX_TYPE, KB_IVF_NLIST, KB_PQ_M, KB_HNSW_M, KB_TRAIN_SAMPLE,
+                    KB_NPROBE, KB_EF_SEARCH, KB_RETRIEVAL_MODE, KB_HYBRID_CANDIDATES)
 
 INDEX_PATH = "data/kb.index"
 MODEL_NAME = "all-MiniLM-L6-v2"
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
 
-def build_index():
+# Below these corpus sizes the approximate indexes can't be trained sensibly
+_MIN_PQ_TRAIN = 39 * 256
+_MIN_IVF_TRAIN = 39
+
+
+def make_index(vectors, index_type=KB_INDEX_TYPE, nlist=KB_IVF_NLIST, pq_m=KB_PQ_M,
+               hnsw_m=KB_HNSW_M, train_sample=KB_TRAIN_SAMPLE):
+    """Create an empty index of the requested type, trained on a sample of `vectors`.
+
+    Labels are KBDoc ids: flat and HNSW indexes are wrapped in an IndexIDMap2, while
+    IVF indexes store ids in their inverted lists themselves. IndexIDMap2 assumes
+    remove_ids() compacts the inner index in order, which IVF doesn't, so wrapping
+    an IVF index would mislabel results after the first incremental removal.
+    nlist is capped to what the corpus can train (~39 points per list); IVF-PQ
+    falls back to IVF-Flat, and IVF-Flat to flat, when there are too few vectors.
+    """
+    import faiss
+    vectors = np.asarray(vectors, dtype="float32")
+    n, dim = vectors.shape
+    index_type = resolve_index_type(index_type, n, dim, pq_m)
+
+    if index_type == "flat":
+        inner = faiss.IndexFlatL2(dim)
+    elif index_type == "hnsw":
+        inner = faiss.IndexHNSWFlat(dim, hnsw_m)
+    else:
+        nlist = max(1, min(nlist, n // _MIN_IVF_TRAIN))
+        quantizer = faiss.IndexFlatL2(dim)
+        if index_type == "ivf_flat":
+            inner = faiss.IndexIVFFlat(quantizer, dim, nlist)
+        else:
+            inner = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, 8)
+        sample = vectors
+        if n > train_sample:
+            rows = np.random.default_rng(0).choice(n, train_sample, replace=False)
+            sample = vectors[rows]
+        inner.train(sample)
+        return inner
+
+    return faiss.IndexIDMap2(inner)
+
+def resolve_index_type(index_type, n, dim, pq_m=KB_PQ_M) -> str:
+    """The index type make_index actually builds for `n` vectors of size `dim`."""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown KB index type {index_type!r}, expected one of {INDEX_TYPES}")
+    if index_type == "ivf_pq" and (n < _MIN_PQ_TRAIN or dim % pq_m):
+        index_type = "ivf_flat"
+    if index_type == "ivf_flat" and n < _MIN_IVF_TRAIN:
+        index_type = "flat"
+    return index_type
+
+def index_type_of(index) -> str:
+    import faiss
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(inner, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+def set_search_params(index, nprobe=KB_NPROBE, ef_search=KB_EF_SEARCH):
+    """Apply the search-time knobs (nprobe for IVF, efSearch for HNSW) to a loaded index."""
+    import faiss
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if isinstance(inner, faiss.IndexIVF):
+        inner.nprobe = min(nprobe, inner.nlist)
+    elif isinstance(inner, faiss.IndexHNSW):
+        inner.hnsw.efSearch = ef_search
+
+
+class KBRetriever:
+    """Process-wide retriever that keeps the encoder and FAISS index resident.
+
+    The model is loaded once on first use. The index is reloaded only when its
+    file changes on disk (mtime/size), so a sync from another process is picked
+    up on the next query. The index's labels are KBDoc ids (see make_index).
+    Query embeddings go through a persistent EmbeddingCache before the encoder.
+    Safe to share across threads and Streamlit sessions.
+    """
+
+    def __init__(self, index_path=INDEX_PATH, model_name=MODEL_NAME, nprobe=KB_NPROBE, ef_search=KB_EF_SEARCH):
+        self.index_path = index_path
+        self.model_name = model_name
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.cache = EmbeddingCache(model_name)
+        self._lock = threading.RLock()
+        self._model = None
+        # (stamp, index) is swapped as one tuple so readers never see a mix
+        self._state = (None, None)
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    # Imported here: torch alone takes seconds to import
+                    from sentence_transformers import SentenceTransformer
+                    self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    def _file_stamp(self):
+        try:
+            idx = os.stat(self.index_path)
+        except FileNotFoundError:
+            return None
+        return (idx.st_mtime_ns, idx.st_size)
+
+    def _load(self):
+        stamp = self._file_stamp()
+        if stamp is None:
+            return None
+        current, index = self._state
+        if stamp == current:
+            return index
+        with self._lock:
+            current, index = self._state
+            if stamp != current:
+                import faiss
+                index = faiss.read_index(self.index_path)
+                set_search_params(index, self.nprobe, self.ef_search)
+                self._state = (stamp, index)
+            return index
+
+    def set_search_params(self, nprobe=None, ef_search=None):
+        """Tune nprobe/efSearch for subsequent queries."""
+        with self._lock:
+            if nprobe is not None:
+                self.nprobe = nprobe
+            if ef_search is not None:
+                self.ef_search = ef_search
+            _, index = self._state
+            if index is not None:
+                set_search_params(index, self.nprobe, self.ef_search)
+
+    def invalidate(self):
+        """Drop the cached index so the next query reloads it from disk."""
+        with self._lock:
+            self._state = (None, None)
+
+    def is_ready(self) -> bool:
+        return self._file_stamp() is not None
+
+    def encode(self, texts):
+        return self.model.encode(list(texts), convert_to_numpy=True)
+
+    def embed(self, texts):
+        """Like encode(), but served from the embedding cache when the text was seen before."""
+        return self.cache.get_or_encode(texts, self.encode)
+
+    def search(self, query: str, top_k=2):
+        """Return (doc_ids, distances) for the nearest KB docs to `query`."""
+        hits = self.search_batch([query], top_k)
+        if not hits:
+            return [], []
+        return [doc_id for doc_id, _ in hits[0]], [dist for _, dist in hits[0]]
+
+    def search_batch(self, queries, top_k=2):
+        """Encode all queries in one call and run a single FAISS search.
+
+        Returns one list of (doc_id, distance) pairs per query.
+        """
+        queries = list(queries)
+        index = self._load()
+        if index is None or not queries:
+            return [[] for _ in queries]
+        return self.search_vectors(self.embed(queries), top_k)
+
+    def search_vectors(self, embeddings, top_k=2):
+        index = self._load()
+        if index is None:
+            return [[] for _ in range(len(embeddings))]
+        D, I = index.search(np.asarray(embeddings, dtype="float32"), top_k)
+        results = []
+        for dists, labels in zip(D, I):
+            # FAISS pads with -1 when the index holds fewer than top_k docs
+            results.append([(int(label), float(dist)) for dist, label in zip(dists, labels) if label >= 0])
+        return results
+
+
+_retriever = None
+_retriever_lock = threading.Lock()
+
+
+def get_retriever() -> KBRetriever:
+    global _retriever
+    if _retriever is None:
+        with _retriever_lock:
+            if _retriever is None:
+                _retriever = KBRetriever()
+    return _retriever
+
+
+def _content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def _read_index(path=INDEX_PATH):
+    import faiss
+    if not os.path.exists(path):
+        return None
+    index = faiss.read_index(path)
+    if isinstance(index, faiss.IndexIVF):
+        return index
+    # Indexes written before doc-id labels were introduced can't be patched in place,
+    # nor can IVF indexes from versions that wrapped them in an IndexIDMap2
+    if not isinstance(index, faiss.IndexIDMap2) or isinstance(faiss.downcast_index(index.index), faiss.IndexIVF):
+        return None
+    return index
+
+def _write_index(index, path=INDEX_PATH):
+    import faiss
+    # Write to a temp file and swap it in so a concurrent reader never loads a half-written file
+    faiss.write_index(index, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def _load_cached_embeddings(session):
+    rows = session.query(KBEmbedding.doc_id, KBEmbedding.embedding).order_by(KBEmbedding.doc_id).all()
+    ids = np.array([r.doc_id for r in rows], dtype="int64")
+    vecs = np.vstack([np.frombuffer(r.embedding, dtype="float32") for r in rows]) if rows else None
+    return ids, vecs
+
+def sync_index(rebuild=False):
+    """Bring the FAISS index in line with kb_docs, re-encoding only new or edited docs.
+
+    Embeddings are cached in kb_embeddings together with a hash of the content
+    they were computed from, so unchanged docs are never re-encoded. Changed and
+    deleted docs are removed from the index by their KBDoc id. With
+    rebuild=True, or when KB_INDEX_TYPE no longer matches the index on disk, the
+    index is recreated (and trained, for IVF types) from the embedding cache.
+    Returns a dict with the number of docs added, changed and removed.
+    """
     session = SessionLocal()
-    docs = session.query(KBDoc).all()
-    session.close()
+    try:
+        docs = {row.id: row.content for row in session.query(KBDoc.id, KBDoc.content)}
+        cached = {row.doc_id: row.content_hash for row in session.query(KBEmbedding.doc_id, KBEmbedding.content_hash)}
 
-    if not docs:
-        print("⚠️ No KB docs found. Add some into kb_docs table first.")
-        return
+        hashes = {doc_id: _content_hash(content) for doc_id, content in docs.items()}
+        added = [doc_id for doc_id in docs if doc_id not in cached]
+        changed = [doc_id for doc_id in docs if doc_id in cached and cached[doc_id] != hashes[doc_id]]
+        removed = [doc_id for doc_id in cached if doc_id not in docs]
+        stats = {"added": len(added), "changed": len(changed), "removed": len(removed)}
 
-    texts = [d.content for d in docs]
-    ids = [d.id for d in docs]
+        to_encode = added + changed
+        vecs = None
+        if to_encode:
+            vecs = get_retriever().encode([docs[doc_id] for doc_id in to_encode]).astype("float32")
+            for doc_id, vec in zip(to_encode, vecs):
+                session.merge(KBEmbedding(doc_id=doc_id, content_hash=hashes[doc_id], embedding=vec.tobytes()))
+        if removed:
+            session.query(KBEmbedding).filter(KBEmbedding.doc_id.in_(removed)).delete(synchronize_session=False)
+        if changed or removed:
+            # Drafts written from the old text of these docs must not be served again. Same
+            # transaction as the embedding changes, so a failure leaves both to the next sync
+            stats["drafts_invalidated"] = get_response_cache().invalidate_docs(changed + removed, session.connection())
+        session.commit()
 
-    model = SentenceTransformer(MODEL_NAME)
-    embeddings = model.encode(texts, convert_to_numpy=True)
+        index = None if rebuild else _read_index()
+        if index is not None and index.ntotal != len(cached):
+            print("⚠️ KB index is out of step with the embedding cache, rebuilding it.")
+            index = None
+        if index is not None and index_type_of(index) != resolve_index_type(KB_INDEX_TYPE, len(docs), index.d):
+            index = None
+        # HNSW graphs don't support deletion, so edits mean rebuilding from the cache
+        if index is not None and (changed or removed) and index_type_of(index) == "hnsw":
+            index = None
 
-    index = faiss.IndexFlatL2(embeddings.shape[1])
-    index.add(embeddings)
+        if index is None:
+            ids, all_vecs = _load_cached_embeddings(session)
+            if all_vecs is None:
+                # The last docs were deleted: drop the old index so nothing serves them any more
+                if os.path.exists(INDEX_PATH):
+                    os.remove(INDEX_PATH)
+                    get_retriever().invalidate()
+                print("⚠️ No KB docs found. Add some into kb_docs table first.")
+                return stats
+            index = make_index(all_vecs)
+            index.add_with_ids(all_vecs, ids)
+        elif to_encode or removed:
+            stale = changed + removed
+            if stale:
+                index.remove_ids(np.array(stale, dtype="int64"))
+            if to_encode:
+                index.add_with_ids(vecs, np.array(to_encode, dtype="int64"))
+        else:
+            print(f"✅ KB index up to date ({index.ntotal} docs).")
+            return stats
 
-    # Save both index + mapping
-    with open("data/kb_mapping.pkl", "wb") as f:
-        pickle.dump(ids, f)
-    faiss.write_index(index, INDEX_PATH)
+        _write_index(index)
+        get_retriever().invalidate()
+        print(f"✅ KB index synced: {stats['added']} added, {stats['changed']} changed, "
+              f"{stats['removed']} removed ({index.ntotal} docs indexed, {index_type_of(index)}).")
+        return stats
+    finally:
+        session.close()
 
-    print(f"✅ KB index built with {len(docs)} docs.")
+def embedding_cache_stats() -> dict:
+    return get_retriever().cache.stats()
 
-def query_kb(query: str, top_k=2):
+def build_index():
+    return sync_index()
+
+def _ensure_index(retriever: KBRetriever) -> bool:
+    # Check if index files exist
+    if not retriever.is_ready():
+        print("⚠️ Knowledge base index not found. Building index first...")
+        build_index()
+        # If build_index returns without creating files, there is nothing to search
+        if not retriever.is_ready():
+            print("⚠️ No knowledge base documents available.")
+            return False
+    return True
+
+def fetch_docs(doc_ids):
+    """Load KB docs for the given ids with a single IN (...) query, keyed by id."""
+    doc_ids = set(doc_ids)
+    if not doc_ids:
+        return {}
+    session = SessionLocal()
     try:
-        # Check if index files exist
-        import os
-        if not os.path.exists(INDEX_PATH) or not os.path.exists("data/kb_mapping.pkl"):
-            print("⚠️ Knowledge base index not found. Building index first...")
-            build_index()
-            # If build_index returns without creating files, return empty results
-            if not os.path.exists(INDEX_PATH):
-                print("⚠️ No knowledge base documents available.")
-                return []
-
-        model = SentenceTransformer(MODEL_NAME)
-        emb = model.encode([query], convert_to_numpy=True)
-
-        index = faiss.read_index(INDEX_PATH)
-        with open("data/kb_mapping.pkl", "rb") as f:
-            ids = pickle.load(f)
-
-        D, I = index.search(emb, top_k)
-
-        session = SessionLocal()
-        results = []
-        for idx in I[0]:
-            if idx < len(ids):  # Prevent index out of range
-                doc = session.query(KBDoc).get(ids[idx])
-                if doc:
-                    results.append(doc.content)
+        docs = session.query(KBDoc).filter(KBDoc.id.in_(doc_ids)).all()
+        return {d.id: d for d in docs}
+    finally:
         session.close()
-        return results
-    
+
+def hits_to_results(hits_per_query):
+    """Turn per-query (doc_id, distance) lists into result dicts with doc content."""
+    docs = fetch_docs(doc_id for hits in hits_per_query for doc_id, _ in hits)
+    results = []
+    for hits in hits_per_query:
+        results.append([
+            {"id": doc_id, "title": docs[doc_id].title, "content": docs[doc_id].content, "score": dist}
+            for doc_id, dist in hits if doc_id in docs
+        ])
+    return results
+
+def hybrid_hits(queries, vector_hits, top_k=2, candidates=KB_HYBRID_CANDIDATES):
+    """Fuse each query's FAISS ranking with its FTS5 BM25 ranking (reciprocal rank fusion)."""
+    fused = []
+    for query, hits in zip(queries, vector_hits):
+        keyword = [doc_id for doc_id, _ in search_kb(query, candidates)]
+        fused.append(rrf([[doc_id for doc_id, _ in hits], keyword], top_k))
+    return fused
+
+def query_kb_batch(queries, top_k=2, mode=KB_RETRIEVAL_MODE):
+    """Retrieve KB context for many queries at once.
+
+    Every query is encoded in one batch, searched with one FAISS call, and all
+    hit documents are loaded with one DB query. Returns one list per query of
+    {"id", "title", "content", "score"} dicts. With mode="vector" score is the
+    L2 distance (lower is closer); with mode="hybrid" the top KB_HYBRID_CANDIDATES
+    FAISS and BM25 results are fused, so exact product names and error codes count,
+    and score is the fused RRF score (higher is closer).
+    """
+    queries = list(queries)
+    try:
+        retriever = get_retriever()
+        if not queries or not _ensure_index(retriever):
+            return [[] for _ in queries]
+        if mode == "hybrid":
+            vector_hits = retriever.search_batch(queries, max(top_k, KB_HYBRID_CANDIDATES))
+            return hits_to_results(hybrid_hits(queries, vector_hits, top_k))
+        return hits_to_results(retriever.search_batch(queries, top_k))
+
     except Exception as e:
         print(f"⚠️ Knowledge base query failed: {e}")
-        return []
+        return [[] for _ in queries]
+
+def query_kb(query: str, top_k=2):
+    return [hit["content"] for hit in query_kb_batch([query], top_k)[0]]
+
+
+if __name__ == "__main__":
+    init_db()
+    parser = argparse.ArgumentParser(description="Sync the KB FAISS index with the kb_docs table.")
+    parser.add_argument("command", nargs="?", choices=["sync", "rebuild"], default="sync",
+                        help="sync: apply only added/changed/removed docs; rebuild: recreate the index from cached embeddings")
+    args = parser.parse_args()
+    sync_index(rebuild=args.command == "rebuild")
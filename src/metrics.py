@@ -0,0 +1,64 @@
+"""
+Metrics
+A small in-process registry of latency and size samples (e.g. draft time-to-first-token).
+Each metric keeps its most recent METRICS_WINDOW samples for percentile summaries;
+when METRICS_LOG is set every sample is also appended to that file as a JSON line,
+so runs from the worker, CLI and dashboard can be compared later.
+"""
+
+import json
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from config import METRICS_LOG, METRICS_WINDOW
+
+_lock = threading.Lock()
+_samples = defaultdict(lambda: deque(maxlen=METRICS_WINDOW))
+_totals = defaultdict(int)
+
+
+def record(name: str, value: float, **labels):
+    with _lock:
+        _samples[name].append(value)
+        _totals[name] += 1
+        if METRICS_LOG:
+            with open(METRICS_LOG, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"ts": time.time(), "metric": name, "value": value, **labels}) + "\n")
+
+
+@contextmanager
+def timer(name: str, **labels):
+    """Record the duration of the block in milliseconds."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, (time.perf_counter() - start) * 1000, **labels)
+
+
+def _percentile(sorted_values, q):
+    idx = min(len(sorted_values) - 1, int(round(q * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def summary(name: str) -> dict:
+    """{"count", "mean", "p50", "p95", "max"} over the recent window (count is all-time)."""
+    with _lock:
+        values = sorted(_samples.get(name, ()))
+        count = _totals.get(name, 0)
+    if not values:
+        return {"count": count, "mean": None, "p50": None, "p95": None, "max": None}
+    return {
+        "count": count,
+        "mean": sum(values) / len(values),
+        "p50": _percentile(values, 0.5),
+        "p95": _percentile(values, 0.95),
+        "max": values[-1],
+    }
+
+
+def snapshot() -> dict:
+    with _lock:
+        names = list(_samples)
+    return {name: summary(name) for name in names}
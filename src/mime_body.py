@@ -0,0 +1,216 @@
+"""
+MIME Body Extraction
+Helpers that let imap_fetcher.py read a message from its IMAP BODYSTRUCTURE
+instead of its full RFC822 source: parse FETCH responses, list the parts of a
+message with their IMAP section numbers, pick the text parts worth downloading
+(text/plain, or text/html when a message has no plain text), decode a possibly
+truncated part, and convert HTML to plain text. Attachments are described from
+the structure alone (name, type, size), so their content is never downloaded.
+"""
+
+import base64
+import binascii
+import quopri
+import re
+from email.header import decode_header, make_header
+from html.parser import HTMLParser
+from urllib.parse import unquote
+
+_OPEN, _CLOSE = object(), object()
+_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|\{\d+\}$|([^\s()"]+))')
+_RESPONSE_START_RE = re.compile(rb"\d+ \(")
+_PARTIAL_RE = re.compile(r"<\d+>$")
+
+
+def _tokens(pieces):
+    """Tokenize (text, literal) pieces of one IMAP response; literals are yielded as bytes."""
+    for text, literal in pieces:
+        text = text.rstrip()
+        pos = 0
+        while pos < len(text):
+            m = _TOKEN_RE.match(text, pos)
+            if not m:
+                raise ValueError(f"unparsable IMAP response near {text[pos:pos + 40]!r}")
+            pos = m.end()
+            opened, closed, quoted, atom = m.groups()
+            if opened:
+                yield _OPEN
+            elif closed:
+                yield _CLOSE
+            elif quoted is not None:
+                yield re.sub(rb"\\(.)", rb"\1", quoted)
+            elif atom is not None:
+                yield None if atom.upper() == b"NIL" else atom
+        if literal is not None:
+            yield literal
+
+
+def _parse(pieces):
+    stack = [[]]
+    for tok in _tokens(pieces):
+        if tok is _OPEN:
+            stack.append([])
+        elif tok is _CLOSE:
+            done = stack.pop()
+            stack[-1].append(done)
+        else:
+            stack[-1].append(tok)
+    if len(stack) != 1:
+        raise ValueError("unbalanced parentheses in IMAP response")
+    return stack[0]
+
+
+def parse_fetch(data) -> dict:
+    """Turn imaplib's FETCH data into {uid: {item name: value}}.
+
+    Item names are upper-case strings such as "BODYSTRUCTURE", "BODY[HEADER]" or
+    "BODY[1.2]" (a partial fetch's <origin> suffix is dropped). Literal values are
+    bytes, parenthesized lists are nested lists and NIL is None. Responses without
+    a UID (unsolicited flag updates) are skipped.
+    """
+    responses = []
+    for item in data:
+        head, literal = item if isinstance(item, tuple) else (item, None)
+        if not head:
+            continue
+        # A literal's continuation starts with a space or ")"; a new response with "<seq> ("
+        if _RESPONSE_START_RE.match(head) or not responses:
+            responses.append([])
+        responses[-1].append((head, literal))
+
+    messages = {}
+    for pieces in responses:
+        parsed = _parse(pieces)
+        items = parsed[1] if len(parsed) > 1 and isinstance(parsed[1], list) else []
+        fields = {}
+        for key, value in zip(items[::2], items[1::2]):
+            name = key.decode("ascii", errors="replace").upper() if isinstance(key, bytes) else str(key)
+            fields[_PARTIAL_RE.sub("", name)] = value
+        if "UID" in fields:
+            messages[int(fields["UID"])] = fields
+    return messages
+
+
+def _str(value) -> str:
+    return value.decode("utf-8", errors="replace") if isinstance(value, bytes) else ""
+
+
+def _params(value) -> dict:
+    if not isinstance(value, list):
+        return {}
+    return {_str(k).lower(): _str(v) for k, v in zip(value[::2], value[1::2])}
+
+
+def _filename(params: dict):
+    name = params.get("filename") or params.get("name")
+    if name:
+        try:
+            return str(make_header(decode_header(name)))
+        except Exception:
+            return name
+    # RFC 2231 form: filename*=utf-8''Invoice%20May.pdf
+    extended = params.get("filename*") or params.get("name*")
+    if extended:
+        charset, _, rest = extended.partition("''")
+        try:
+            return unquote(rest or charset, encoding=charset if rest else "utf-8", errors="replace")
+        except LookupError:
+            return unquote(rest, errors="replace")
+    return None
+
+
+def walk_structure(bs, section=""):
+    """Yield a dict per leaf part of a parsed BODYSTRUCTURE: section, type, charset,
+    encoding, size (encoded bytes), disposition and filename."""
+    if bs and isinstance(bs[0], list):
+        # multipart: (part)(part)... "subtype" [extension data]; the children are the leading lists
+        for i, child in enumerate(bs):
+            if not isinstance(child, list):
+                break
+            yield from walk_structure(child, f"{section}.{i + 1}" if section else str(i + 1))
+        return
+    ctype = f"{_str(bs[0])}/{_str(bs[1])}".lower()
+    params = _params(bs[2])
+    # Disposition follows the MD5 extension field, whose position depends on the type
+    md5 = 8 if ctype.startswith("text/") else 10 if ctype == "message/rfc822" else 7
+    disp = bs[md5 + 1] if len(bs) > md5 + 1 else None
+    disposition, disp_params = ((_str(disp[0]).lower(), _params(disp[1] if len(disp) > 1 else None))
+                                if isinstance(disp, list) and disp else (None, {}))
+    try:
+        size = int(bs[6])
+    except (TypeError, ValueError):
+        size = 0
+    yield {
+        "section": section or "1",
+        "type": ctype,
+        "charset": params.get("charset"),
+        "encoding": _str(bs[5]).lower() or "7bit",
+        "size": size,
+        "disposition": disposition,
+        "filename": _filename(disp_params) or _filename(params),
+    }
+
+
+def split_parts(parts):
+    """Split walk_structure() output into (text parts to download, attachments)."""
+    inline = [p for p in parts if p["disposition"] != "attachment" and not p["filename"]]
+    text = ([p for p in inline if p["type"] == "text/plain"]
+            or [p for p in inline if p["type"] == "text/html"])
+    attachments = [p for p in parts if p not in text and (
+        p["disposition"] == "attachment" or p["filename"] or not p["type"].startswith("text/"))]
+    return text, attachments
+
+
+def decode_part(raw: bytes, encoding: str, charset=None) -> str:
+    """Decode a part's transfer encoding and charset; tolerates a part cut off by a size cap."""
+    if encoding == "base64":
+        data = re.sub(rb"[^A-Za-z0-9+/=]", b"", raw)
+        try:
+            raw = base64.b64decode(data[:len(data) // 4 * 4])
+        except binascii.Error:
+            raw = b""
+    elif encoding == "quoted-printable":
+        raw = quopri.decodestring(raw)
+    try:
+        return raw.decode(charset or "utf-8", errors="replace")
+    except LookupError:
+        return raw.decode("latin-1", errors="replace")
+
+
+class _HTMLText(HTMLParser):
+    BLOCK = {"p", "div", "br", "tr", "table", "ul", "ol", "blockquote", "pre", "hr",
+             "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "header", "footer"}
+    SKIP = {"script", "style", "head", "title", "noscript"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self._skip += 1
+        elif tag == "li":
+            self.out.append("\n- ")
+        elif tag in self.BLOCK:
+            self.out.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self._skip = max(0, self._skip - 1)
+        elif tag in self.BLOCK:
+            self.out.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.out.append(data)
+
+
+def html_to_text(html: str) -> str:
+    """Strip tags, scripts and styles in one pass, keeping paragraph and list breaks."""
+    parser = _HTMLText()
+    parser.feed(html)
+    parser.close()
+    text = re.sub(r"[ \t\r\f\v\xa0]+", " ", "".join(parser.out))
+    text = re.sub(r" *\n *", "\n", text)
+    return re.sub(r"\n{3,}", "\n\n", text).strip()
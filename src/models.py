@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime
+from sqlalchemy import Column, Index, Integer, String, Text, DateTime, LargeBinary, Float, UniqueConstraint
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -6,17 +6,108 @@ Base = declarative_base()
 class Email(Base):
     __tablename__ = "emails"
 
-    id = Column(String(9), primary_key=True)
+    id = Column(String(24), primary_key=True)
+    message_id = Column(String(998), nullable=True, unique=True, index=True)
+    in_reply_to = Column(String(998), nullable=True)
+    reference_ids = Column(Text, nullable=True)
+    # make_email_id() of the conversation's root Message-ID, see threads.py
+    thread_id = Column(String(24), nullable=True, index=True)
     sender = Column(String(255), nullable=False)
     subject = Column(Text, nullable=True)
     body = Column(Text, nullable=True)
-    date_received = Column(DateTime, nullable=True)
+    date_received = Column(DateTime, nullable=True, index=True)
     support = Column(String(50), default="No")
-    priority = Column(String(50), default="Not urgent")
-    sentiment = Column(String(50), default="Neutral")
-    status = Column(String(50), default="pending")
+    category = Column(String(50), nullable=True)
+    priority = Column(String(50), default="Not urgent", index=True)
+    sentiment = Column(String(50), default="Neutral", index=True)
+    status = Column(String(50), default="pending", index=True)
     draft_reply = Column(Text, nullable=True)
     date_sent = Column(DateTime, nullable=True) 
+    extracted_emails = Column(Text, nullable=True)
+    extracted_phones = Column(Text, nullable=True)
+    analyzer_version = Column(Integer, nullable=True, index=True)
+    analyzed_at = Column(DateTime, nullable=True)
+    # Set when a person confirmed sentiment/priority/category; these rows train classifier.py
+    labeled_at = Column(DateTime, nullable=True, index=True)
+
+    __table_args__ = (
+        # Replies sent in a date range (analytics.median_reply_seconds)
+        Index("ix_emails_status_date_sent", "status", "date_sent"),
+        # Pending queue order, and "is there a newer message in this thread" probes (inbox.list_threads)
+        Index("ix_emails_status_priority_date", "status", "priority", "date_received", "thread_id", "id"),
+        Index("ix_emails_thread_date_status", "thread_id", "date_received", "status"),
+    )
+
+class Attachment(Base):
+    """An attachment listed from the message's BODYSTRUCTURE; its content is never downloaded."""
+    __tablename__ = "attachments"
+    __table_args__ = (UniqueConstraint("email_id", "section"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    email_id = Column(String(24), nullable=False, index=True)
+    # IMAP part number, e.g. "2" or "1.3", for fetching the content later with BODY[section]
+    section = Column(String(50), nullable=False)
+    filename = Column(Text, nullable=True)
+    content_type = Column(String(255), nullable=False)
+    # Encoded size on the server, as reported by BODYSTRUCTURE
+    size = Column(Integer, nullable=False, default=0)
+    disposition = Column(String(50), nullable=True)
+
+class SyncState(Base):
+    """Per-folder IMAP sync position: only UIDs above last_uid are fetched while uidvalidity holds."""
+    __tablename__ = "sync_state"
+
+    folder = Column(String(255), primary_key=True)
+    uidvalidity = Column(Integer, nullable=False)
+    last_uid = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, nullable=True)
+
+class EmailRollup(Base):
+    """Counts of emails per status / priority / sentiment value, maintained by triggers (db.py)."""
+    __tablename__ = "email_rollups"
+
+    metric = Column(String(50), primary_key=True)
+    value = Column(String(50), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class EmailHourly(Base):
+    """Emails received and replied per hour."""
+    __tablename__ = "email_hourly"
+
+    bucket = Column(DateTime, primary_key=True)
+    received = Column(Integer, nullable=False, default=0)
+    replied = Column(Integer, nullable=False, default=0)
+
+class OutboxMessage(Base):
+    """An approved reply waiting to be sent (or already sent) by sender.py."""
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    email_id = Column(String(24), nullable=False, index=True)
+    to_addr = Column(String(255), nullable=False)
+    subject = Column(Text, nullable=True)
+    body = Column(Text, nullable=False)
+    in_reply_to = Column(String(998), nullable=True)
+    reference_ids = Column(Text, nullable=True)
+    # Our Message-ID, so a customer's answer that only carries In-Reply-To still finds its thread
+    message_id = Column(String(998), nullable=True, index=True)
+    # queued -> sending -> sent, or back to queued / failed after an error
+    status = Column(String(20), nullable=False, default="queued", index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+    claim = Column(String(32), nullable=True, index=True)
+    claimed_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    sent_at = Column(DateTime, nullable=True)
+
+class ThreadContext(Base):
+    """KB docs retrieved for a conversation's first draft, reused when drafting its follow-ups."""
+    __tablename__ = "thread_context"
+
+    thread_id = Column(String(24), primary_key=True)
+    # Doc ids in rank order, comma separated
+    doc_ids = Column(Text, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
 
 class KBDoc(Base):
     __tablename__ = "kb_docs"
@@ -24,3 +115,43 @@ class KBDoc(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     title = Column(String(255), nullable=False)
     content = Column(Text, nullable=False)
+
+class KBEmbedding(Base):
+    """Cached embedding of a KB doc; content_hash tells sync_index when it must be re-encoded."""
+    __tablename__ = "kb_embeddings"
+
+    doc_id = Column(Integer, primary_key=True)
+    content_hash = Column(String(64), nullable=False)
+    embedding = Column(LargeBinary, nullable=False)
+
+class QueryEmbedding(Base):
+    """Persistent cache of query embeddings keyed by a hash of model name + normalized text."""
+    __tablename__ = "query_embeddings"
+
+    text_hash = Column(String(64), primary_key=True)
+    embedding = Column(LargeBinary, nullable=False)
+    last_used = Column(DateTime, nullable=False, index=True)
+
+class ResponseCacheEntry(Base):
+    """A generated draft, reusable for emails from the same customer whose embedding is
+    close enough and that retrieved the same KB docs (doc_ids is a sorted ",1,5," list)."""
+    __tablename__ = "response_cache"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    model = Column(String(100), nullable=False)
+    # Lowercased sender address; a draft can carry the customer's name and details
+    scope = Column(String(255), nullable=True, index=True)
+    doc_ids = Column(String(255), nullable=False, index=True)
+    embedding = Column(LargeBinary, nullable=False)
+    draft = Column(Text, nullable=False)
+    gen_ms = Column(Float, nullable=False, default=0.0)
+    hits = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False)
+    last_used = Column(DateTime, nullable=False, index=True)
+
+class ResponseCacheDoc(Base):
+    """One KB doc a cached draft was written from, so edits to the doc find its drafts by index."""
+    __tablename__ = "response_cache_docs"
+
+    entry_id = Column(Integer, primary_key=True)
+    doc_id = Column(Integer, primary_key=True, index=True)
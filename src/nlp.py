@@ -1,24 +1,47 @@
 import re
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
+import time
+import zlib
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
 from db import SessionLocal
-from sqlalchemy import or_
+from sqlalchemy import or_, select, func, update
 from models import Email
+from config import NLP_BATCH, NLP_WORKERS
+from rules import get_engine
+from classifier import classify_results
 #import nltk
 
 #nltk.download('vader_lexicon')
 
-# Initialize VADER
-sia = SentimentIntensityAnalyzer()
+# VADER is initialized on first use; importing nltk is slow
+_sia = None
+
+def get_sia():
+    global _sia
+    if _sia is None:
+        from nltk.sentiment.vader import SentimentIntensityAnalyzer
+        _sia = SentimentIntensityAnalyzer()
+    return _sia
+
+# Bump whenever the analysis code changes so existing rows get re-analyzed once;
+# rule changes are picked up through the rule engine's fingerprint
+ANALYZER_CODE_VERSION = 3
+
+def analyzer_version() -> int:
+    """ANALYZER_CODE_VERSION combined with the loaded rules, as a non-negative 32-bit int."""
+    key = f"{ANALYZER_CODE_VERSION}:{get_engine().fingerprint}"
+    return zlib.crc32(key.encode("utf-8")) & 0x7FFFFFFF
 
 # Regex patterns
 EMAIL_RE = re.compile(r"[\w\.-]+@[\w\.-]+\.\w+")
 PHONE_RE = re.compile(r"\+?\d[\d\-\(\) ]{7,}\d")
+# Blocks that older versions appended to the body
+LEGACY_CONTACTS_RE = re.compile(r"\n\n\[Extracted (?:emails|phones): [^\]\n]*\]")
 
-# Urgency keywords
-URGENCY_KEYWORDS = ["urgent", "immediately", "asap", "critical", "cannot access", "down", "issue"]
+LABEL_COLUMNS = ("sentiment", "priority", "support", "category")
 
 def analyze_sentiment(text: str) -> str:
-    scores = sia.polarity_scores(text)
+    scores = get_sia().polarity_scores(text)
     compound = scores["compound"]
     if compound >= 0.05:
         return "Positive"
@@ -28,39 +51,107 @@ def analyze_sentiment(text: str) -> str:
         return "Neutral"
 
 def detect_urgency(text: str) -> str:
-    text_lower = text.lower()
-    if any(kw in text_lower for kw in URGENCY_KEYWORDS):
-        return "Urgent"
-    return "Not urgent"
+    return get_engine().evaluate("", text).priority
 
 def extract_contacts(text: str):
     emails = EMAIL_RE.findall(text)
     phones = PHONE_RE.findall(text)
     return emails, phones
 
-def process_new_emails():
+def analyze_record(record) -> dict:
+    """Analyze one (id, subject, body, status, labeled_at) row and return the columns to update.
+
+    Top-level and free of DB access so it can run in worker processes.
+    """
+    em_id, subject, body, status, labeled_at = record
+    original = body or ""
+    body = LEGACY_CONTACTS_RE.sub("", original)
+    full_text = f"{subject} {body}"
+
+    # Extract contacts
+    found_emails, found_phones = extract_contacts(full_text)
+
+    # Priority and support category in one pass over subject and body
+    rules = get_engine().evaluate(subject, body)
+
+    result = {
+        "id": em_id,
+        "sentiment": analyze_sentiment(full_text),
+        "priority": rules.priority,
+        "support": rules.support,
+        "category": rules.category,
+        "extracted_emails": ", ".join(found_emails) or None,
+        "extracted_phones": ", ".join(found_phones) or None,
+        "analyzer_version": analyzer_version(),
+        "analyzed_at": datetime.utcnow(),
+        # Re-analysis after a version bump must not move drafted/replied mail back
+        "status": "analyzed" if status in (None, "pending") else status,
+    }
+    if labeled_at:
+        # Labels a person confirmed survive re-analysis
+        for key in LABEL_COLUMNS:
+            del result[key]
+    if body != original:
+        result["body"] = body
+    return result
+
+def _pending_filter():
+    return or_(Email.analyzer_version == None, Email.analyzer_version != analyzer_version())
+
+def _pages(session, page_size):
+    """Yield unanalyzed rows as lists of (id, subject, body, status, labeled_at), one fixed-size page at a time.
+
+    Pages are keyed on id rather than held open with a server-side cursor, so
+    each page's UPDATE can commit while later pages are still to be read.
+    """
+    last_id = ""
+    while True:
+        page = session.execute(
+            select(Email.id, Email.subject, Email.body, Email.status, Email.labeled_at)
+            .where(_pending_filter(), Email.id > last_id)
+            .order_by(Email.id)
+            .limit(page_size)
+        ).all()
+        if not page:
+            return
+        yield [tuple(row) for row in page]
+        last_id = page[-1].id
+
+def process_new_emails(page_size=NLP_BATCH, workers=NLP_WORKERS):
+    """Analyze emails not yet seen by the current analyzer_version(), page by page,
+    in a process pool, with one bulk UPDATE per page. Labels from the trained
+    classifier replace the VADER/rule ones where it is confident."""
     session = SessionLocal()
-    emails = session.query(Email).filter(or_(Email.sentiment == None, Email.sentiment == "Neutral")).all()
-    print(f"🔎 Processing {len(emails)} new emails...")
-
-    for em in emails:
-        full_text = f"{em.subject} {em.body}"
-
-        # Sentiment
-        em.sentiment = analyze_sentiment(full_text)
-
-        # Urgency
-        em.priority = detect_urgency(full_text)
-
-        # Extract contacts
-        found_emails, found_phones = extract_contacts(full_text)
-        if found_emails:
-            em.body += f"\n\n[Extracted emails: {', '.join(found_emails)}]"
-        if found_phones:
-            em.body += f"\n\n[Extracted phones: {', '.join(found_phones)}]"
-        
-        em.status = "analyzed"
-
-    session.commit()
-    session.close()
-    print("✅ NLP processing complete.")
+    total = session.execute(select(func.count()).select_from(Email).where(_pending_filter())).scalar_one()
+    print(f"🔎 Processing {total} new emails...")
+    if not total:
+        session.close()
+        return 0
+
+    started = time.perf_counter()
+    done = 0
+    # Spinning up worker processes only pays off for a reasonably sized backlog
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 and total >= 4 * workers else None
+    try:
+        for page in _pages(session, page_size):
+            if pool:
+                results = list(pool.map(analyze_record, page, chunksize=max(1, len(page) // (workers * 4))))
+            else:
+                results = [analyze_record(record) for record in page]
+            # The trained heads (if any) run on the page's embeddings in one batch
+            unlabelled = [(record, result) for record, result in zip(page, results) if not record[4]]
+            classify_results([f"{record[1]} {result.get('body', record[2])}" for record, result in unlabelled],
+                             [result for _, result in unlabelled])
+            session.execute(update(Email), results)
+            session.commit()
+            done += len(results)
+            elapsed = time.perf_counter() - started
+            print(f"   {done}/{total} emails ({done / elapsed if elapsed else 0:.0f} emails/s)")
+    finally:
+        if pool:
+            pool.shutdown()
+        session.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"✅ NLP processing complete: {done} emails in {elapsed:.1f}s ({done / elapsed if elapsed else 0:.0f} emails/s).")
+    return done
@@ -0,0 +1,200 @@
+"""
+Prompt Builder
+Builds the drafting prompt within PROMPT_TOKEN_BUDGET so generation latency and
+cost don't grow with the size of an email or of the KB documents it matched:
+
+- the email body loses its quoted history, signature and the contact blocks older
+  versions appended, then is cut to PROMPT_BODY_TOKENS;
+- our last reply in a thread is cut to PROMPT_HISTORY_TOKENS;
+- retrieved KB documents are split into chunks of about KB_CHUNK_TOKENS, ranked by
+  TF-IDF similarity to the email (ties go to the better-retrieved document), and
+  added best first while they fit in what is left of the budget.
+
+Token counts are estimates at ~4 characters per token, close enough to Gemini's
+tokenizer to bound prompt size without a count_tokens round trip per draft.
+"""
+
+import math
+import re
+from collections import Counter
+from nlp import LEGACY_CONTACTS_RE
+from threads import strip_quoted
+from config import PROMPT_TOKEN_BUDGET, PROMPT_BODY_TOKENS, PROMPT_HISTORY_TOKENS, KB_CHUNK_TOKENS
+
+CHARS_PER_TOKEN = 4
+SUBJECT_TOKENS = 64
+# "-- " on its own line is the standard signature delimiter
+SIGNATURE_RE = re.compile(r"^-- ?$", re.M)
+# A sign-off or client footer this close to the end starts the signature
+SIGN_OFF_RE = re.compile(
+    r"^(?:(?:best|kind|warm|many)?\s*(?:regards|thanks|thank you|cheers|sincerely|best)[,.!]?"
+    r"|sent from my [\w ]+|get outlook for \w+)$",
+    re.I,
+)
+SIGN_OFF_LINES = 6
+SIGNATURE_LINE_CHARS = 60
+TERM_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do for from has have hi hello i if in is it me my no not of on or "
+    "our please so that the this to was we what when with you your".split()
+)
+
+PROMPT_TEMPLATE = """You are a professional customer support assistant.
+{history}The customer sent the following email:
+
+Subject: {subject}
+Body: {body}
+
+Customer tone: {sentiment}
+Priority level: {priority}
+
+Knowledge base context (may be useful):
+{context}
+
+Write a helpful, empathetic, professional reply. Use plain text formatting only - do not use markdown, bold text, asterisks, or any special formatting. Write in a natural, conversational tone without special text styling. Do not include the subject in generated response, add company details at the end as done professionally.
+"""
+
+
+def estimate_tokens(text) -> int:
+    return -(-len(text or "") // CHARS_PER_TOKEN)
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """Cut `text` to about `max_tokens`, at a word boundary, marking the cut with "[…]"."""
+    limit = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text.rfind(" ", 0, limit)
+    return text[:cut if cut > limit // 2 else limit].rstrip() + " […]"
+
+
+def strip_signature(body: str) -> str:
+    """Drop a "-- " signature, or everything from a sign-off in the last few lines.
+
+    Returns the body unchanged if nothing would be left.
+    """
+    m = SIGNATURE_RE.search(body)
+    text = body[:m.start()] if m else body
+    lines = text.rstrip().split("\n")
+    for i in range(len(lines) - 1, max(-1, len(lines) - 1 - SIGN_OFF_LINES), -1):
+        # Only short lines (name, title, company) may follow a sign-off
+        if any(len(line) > SIGNATURE_LINE_CHARS for line in lines[i + 1:]):
+            break
+        if SIGN_OFF_RE.match(lines[i].strip()):
+            lines = lines[:i]
+            break
+    text = "\n".join(lines).strip()
+    return text or body
+
+
+def clean_body(body: str) -> str:
+    """The part of an email worth sending to the LLM."""
+    return strip_signature(strip_quoted(LEGACY_CONTACTS_RE.sub("", body or "")))
+
+
+def chunk_text(text: str, chunk_tokens: int = KB_CHUNK_TOKENS) -> list:
+    """Split a document into chunks of at most ~chunk_tokens, by paragraph, then sentence."""
+    limit = chunk_tokens * CHARS_PER_TOKEN
+    pieces = []
+    for para in re.split(r"\n\s*\n", text or ""):
+        para = para.strip()
+        if len(para) <= limit:
+            pieces.append(para)
+        else:
+            pieces += re.split(r"(?<=[.!?])\s+", para)
+    chunks, current = [], ""
+    for piece in filter(None, pieces):
+        # A single sentence longer than a chunk is split by length
+        while len(piece) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(piece[:limit])
+            piece = piece[limit:]
+        if current and len(current) + 1 + len(piece) > limit:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _stem(term):
+    """Crude suffix stripping so "refunds"/"refunded" match "refund"."""
+    for suffix in ("ing", "ed", "es", "s"):
+        if term.endswith(suffix) and len(term) - len(suffix) >= 3:
+            return term[:-len(suffix)]
+    return term
+
+
+def _terms(text):
+    return [_stem(t) for t in TERM_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+def rank_chunks(query: str, docs, chunk_tokens: int = KB_CHUNK_TOKENS) -> list:
+    """Chunks of `docs` as (doc rank, position, text), most similar to `query` first."""
+    chunks = [(rank, pos, text) for rank, doc in enumerate(docs)
+              for pos, text in enumerate(chunk_text(doc, chunk_tokens))]
+    if not chunks:
+        return []
+    tfs = [Counter(_terms(text)) for _, _, text in chunks]
+    df = Counter(term for tf in tfs for term in tf)
+    idf = {term: math.log(1 + len(chunks) / n) for term, n in df.items()}
+    query_tf = Counter(_terms(query))
+
+    def score(tf):
+        dot = sum(n * tf[t] * idf[t] ** 2 for t, n in query_tf.items() if t in tf)
+        norm = math.sqrt(sum((n * idf[t]) ** 2 for t, n in tf.items()))
+        return dot / norm if norm else 0.0
+
+    scores = [score(tf) for tf in tfs]
+    order = sorted(range(len(chunks)), key=lambda i: (-scores[i], chunks[i][0], chunks[i][1]))
+    return [chunks[i] for i in order]
+
+
+def select_context(query: str, docs, budget: int, chunk_tokens: int = KB_CHUNK_TOKENS):
+    """Return (text, chunks used, chunks total): the best chunks fitting in `budget`, in document order."""
+    ranked = rank_chunks(query, docs or [], chunk_tokens)
+    picked, used = [], 0
+    for chunk in ranked:
+        cost = estimate_tokens(chunk[2]) + 1
+        # Keep going after a miss: a shorter, less relevant chunk may still fit
+        if used + cost <= budget:
+            picked.append(chunk)
+            used += cost
+    picked.sort()
+    return "\n".join(text for _, _, text in picked), len(picked), len(ranked)
+
+
+def build_prompt(email, context_docs, thread=None, budget=PROMPT_TOKEN_BUDGET):
+    """Return (prompt, stats) for drafting a reply to `email`.
+
+    `thread` is from threads.load_threads; with an earlier reply of ours the prompt
+    includes it as conversation history. stats holds estimated "tokens" for the whole
+    prompt, "body_tokens", "context_tokens", and "chunks"/"chunks_total" from the KB.
+    """
+    body = truncate_tokens(clean_body(email.body), PROMPT_BODY_TOKENS)
+    history = ""
+    if thread and thread.get("last_reply"):
+        last_reply = truncate_tokens(thread["last_reply"].strip(), PROMPT_HISTORY_TOKENS)
+        history = f"This is a follow-up in an ongoing conversation. Our previous reply was:\n{last_reply}\n\n"
+    fields = {
+        "history": history,
+        "subject": truncate_tokens(email.subject or "", SUBJECT_TOKENS),
+        "body": body,
+        "sentiment": email.sentiment,
+        "priority": email.priority,
+    }
+    remaining = budget - estimate_tokens(PROMPT_TEMPLATE.format(context="", **fields))
+    context, chunks, chunks_total = select_context(f"{fields['subject']} {body}", context_docs, max(0, remaining))
+    prompt = PROMPT_TEMPLATE.format(context=context or "No extra context.", **fields)
+    stats = {
+        "tokens": estimate_tokens(prompt),
+        "body_tokens": estimate_tokens(body),
+        "context_tokens": estimate_tokens(context),
+        "chunks": chunks,
+        "chunks_total": chunks_total,
+    }
+    return prompt, stats
@@ -1,24 +1,57 @@
 import os
-import smtplib
-import google.generativeai as genai
-from db import SessionLocal
+import time
 from models import Email
-from kb_index import query_kb
-from sqlalchemy import or_
-from email.mime.text import MIMEText
-from config import SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASS
+from kb_index import get_retriever, hits_to_results, query_kb, query_kb_batch
+from threads import load_threads, save_thread_contexts, strip_quoted, thread_key
+from prompts import build_prompt
+from response_cache import get_response_cache, scope_key
+from sender import queue_reply, send_outbox
+import metrics
+from config import GEMINI_MODEL, GEMINI_API_ENDPOINT, GEMINI_TRANSPORT, LLM_TIMEOUT
 
 
 GEMINI_API_KEY = os.getenv("GOOGLE_API_KEY")
 
-if GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-
-def generate_with_gemini(prompt: str) -> str:
-    model = genai.GenerativeModel("gemini-2.0-flash")
-    resp = model.generate_content(prompt)
+_genai = None
+_model = None
+
+def get_genai():
+    """Import and configure google.generativeai on first use; the import alone takes seconds."""
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai
+        if GEMINI_API_KEY:
+            options = {}
+            if GEMINI_TRANSPORT:
+                options["transport"] = GEMINI_TRANSPORT
+            if GEMINI_API_ENDPOINT:
+                options["client_options"] = {"api_endpoint": GEMINI_API_ENDPOINT}
+            genai.configure(api_key=GEMINI_API_KEY, **options)
+        _genai = genai
+    return _genai
+
+def get_model():
+    """One GenerativeModel per process; it is thread-safe and reuses the client's connections."""
+    global _model
+    if _model is None:
+        _model = get_genai().GenerativeModel(GEMINI_MODEL)
+    return _model
+
+def generate_with_gemini(prompt: str, timeout=LLM_TIMEOUT) -> str:
+    resp = get_model().generate_content(prompt, request_options={"timeout": timeout})
     return resp.text.strip()
 
+def stream_with_gemini(prompt: str, timeout=LLM_TIMEOUT):
+    """Yield the reply text in chunks as Gemini produces them."""
+    for chunk in get_model().generate_content(prompt, stream=True, request_options={"timeout": timeout}):
+        try:
+            text = chunk.text
+        except ValueError:
+            # Chunks without text parts (e.g. only a finish reason) raise on .text
+            continue
+        if text:
+            yield text
+
 def fallback_reply(email: Email) -> str:
     return f"""Hello {email.sender},
 
@@ -29,70 +62,149 @@ Best regards,
 Support Team
 """
 
-def make_prompt(email: Email) -> str:
-    context_docs = query_kb(f"{email.subject} {email.body}", top_k=2)
-    context_text = "\n".join(context_docs) if context_docs else "No extra context."
-
-    return f"""You are a professional customer support assistant.
-The customer sent the following email:
-
-Subject: {email.subject}
-Body: {email.body}
-
-Customer tone: {email.sentiment}
-Priority level: {email.priority}
-
-Knowledge base context (may be useful):
-{context_text}
-
-Write a helpful, empathetic, professional reply. Use plain text formatting only - do not use markdown, bold text, asterisks, or any special formatting. Write in a natural, conversational tone without special text styling. Do not include the subject in generated response, add company details at the end as done professionally.
-"""
-
-def generate_draft(email: Email):
-    # session = SessionLocal()
-    # emails = session.query(Email).filter(
-    #     or_(Email.draft_reply == None, Email.draft_reply == "")
-    # ).all()
+def make_prompt(email: Email, context_docs=None, thread=None) -> str:
+    """Prompt for drafting a reply, kept within PROMPT_TOKEN_BUDGET by prompts.build_prompt.
+
+    `thread` is from threads.load_threads; a follow-up includes our last reply. The
+    estimated prompt size is recorded as the draft.prompt_tokens metric.
+    """
+    if context_docs is None:
+        context_docs = query_kb(f"{email.subject} {email.body}", top_k=2)
+    prompt, stats = build_prompt(email, context_docs, thread)
+    metrics.record("draft.prompt_tokens", stats.pop("tokens"), email_id=email.id, **stats)
+    return prompt
+
+def email_text(email) -> str:
+    """Text used both for KB retrieval and as the response cache key."""
+    return f"{email.subject} {email.body}"
+
+def cache_keys(emails, hits):
+    """(embedding, KB doc ids, sender scope) per email for the response cache, or None when it can't be used.
+
+    The embedding is the one retrieval just computed, so it comes from the embedding cache.
+    """
+    emails = list(emails)
+    if not GEMINI_API_KEY or not get_response_cache().enabled or not emails:
+        return [None] * len(emails)
+    try:
+        vecs = get_retriever().embed([email_text(em) for em in emails])
+    except Exception as e:
+        print(f"⚠️ Response cache skipped: {e}")
+        return [None] * len(emails)
+    return [(vec, [hit["id"] for hit in em_hits], scope_key(em.sender))
+            for em, vec, em_hits in zip(emails, vecs, hits)]
+
+def retrieve_context(emails):
+    """(KB hits, response cache keys, thread contexts) for a batch of emails.
+
+    Emails in a thread whose context is cached reuse its KB docs without embedding
+    or searching; the rest are retrieved in one batch (follow-ups on their new text
+    only) and their doc ids cached for the thread. Follow-ups get no cache key,
+    since their draft depends on the conversation.
+    """
+    emails = list(emails)
+    threads = load_threads(emails)
+    hits = [None] * len(emails)
+    reuse = [i for i, t in enumerate(threads) if t and t["doc_ids"]]
+    for i, em_hits in zip(reuse, hits_to_results([[(doc_id, None) for doc_id in threads[i]["doc_ids"]] for i in reuse])):
+        hits[i] = em_hits
+    fresh = [i for i, h in enumerate(hits) if h is None]
+    queries = [f"{emails[i].subject} {strip_quoted(emails[i].body)}" if threads[i] else email_text(emails[i])
+               for i in fresh]
+    for i, em_hits in zip(fresh, query_kb_batch(queries, top_k=2)):
+        hits[i] = em_hits
+    save_thread_contexts([(thread_key(emails[i]), [hit["id"] for hit in hits[i]]) for i in fresh])
+    keys = [None] * len(emails)
+    first = [i for i, t in enumerate(threads) if not (t and t["last_reply"])]
+    for i, key in zip(first, cache_keys([emails[i] for i in first], [hits[i] for i in first])):
+        keys[i] = key
+    return hits, keys, threads
+
+def _retrieve(email, hits=None, key=None, thread=None):
+    if hits is None:
+        (hits,), (found_key,), (thread,) = retrieve_context([email])
+        return hits, key if key is not None else found_key, thread
+    if key is None:
+        key = cache_keys([email], [hits])[0]
+    return hits, key, thread
+
+def generate_draft(email: Email, hits=None, key=None, thread=None):
+    """Draft a reply for `email`, reusing a cached draft of a near-identical email when there is one.
+
+    `hits`, `key` and `thread` are the email's retrieve_context() entries; they
+    are looked up when not given. The caller commits.
+    """
     print(f"✍️ Generating draft for email {email.id}.")
-
-    
-    prompt = make_prompt(email)
-    if GEMINI_API_KEY:
-        email.draft_reply = generate_with_gemini(prompt)
+    hits, key, thread = _retrieve(email, hits, key, thread)
+    cache = get_response_cache()
+    draft = cache.lookup(*key) if key else None
+    if draft is not None:
+        print(f"♻️ Reused a cached draft for email {email.id}.")
+    elif GEMINI_API_KEY:
+        prompt = make_prompt(email, [hit["content"] for hit in hits], thread)
+        started = time.perf_counter()
+        draft = generate_with_gemini(prompt)
+        if key:
+            cache.store(*key, draft, (time.perf_counter() - started) * 1000)
     else:
-        email.draft_reply = fallback_reply(email)
+        draft = fallback_reply(email)
+    email.draft_reply = draft
     print(f"✅ Draft generated for email {email.id} ({email.subject[:40]}...)")
     email.status = "drafted"
 
-    # session.commit()
-    # session.close()
-    # print("🎯 Draft generation complete.")
+def stream_draft(email: Email, hits=None, key=None, thread=None):
+    """Generate a draft like generate_draft(), yielding text chunks as they arrive.
+
+    The complete text is stored on `email` (status "drafted") only once the stream
+    has finished; the caller commits. Time to first token and total generation
+    time are recorded as draft.ttft_ms and draft.total_ms. A cached draft is
+    yielded in one piece.
+    """
+    print(f"✍️ Streaming draft for email {email.id}.")
+    hits, key, thread = _retrieve(email, hits, key, thread)
+    cache = get_response_cache()
+    started = time.perf_counter()
+    cached = cache.lookup(*key) if key else None
+    if cached is not None:
+        chunks = iter([cached])
+    elif GEMINI_API_KEY:
+        chunks = stream_with_gemini(make_prompt(email, [hit["content"] for hit in hits], thread))
+    else:
+        chunks = iter([fallback_reply(email)])
+    parts = []
+    for text in chunks:
+        if not parts:
+            metrics.record("draft.ttft_ms", (time.perf_counter() - started) * 1000, email_id=email.id,
+                           cached=cached is not None)
+        parts.append(text)
+        yield text
+    total_ms = (time.perf_counter() - started) * 1000
+    metrics.record("draft.total_ms", total_ms, email_id=email.id, cached=cached is not None)
+    email.draft_reply = "".join(parts).strip()
+    if cached is None and key and GEMINI_API_KEY:
+        cache.store(*key, email.draft_reply, total_ms)
+    email.status = "drafted"
+    print(f"✅ Draft streamed for email {email.id} ({email.subject[:40]}...)")
+
+def generate_drafts(emails):
+    """Draft replies for many emails, retrieving KB context for all of them in one batch."""
+    emails = list(emails)
+    hits, keys, threads = retrieve_context(emails)
+    for em, em_hits, key, thread in zip(emails, hits, keys, threads):
+        generate_draft(em, em_hits, key, thread)
+    print(f"🎯 Draft generation complete for {len(emails)} emails.")
 
 def send_reply(email_obj: Email, reply_text: str):
-    """Send a reply to the given email using SMTP and mark it as replied."""
-    try:
-        # Build MIME message
-        msg = MIMEText(reply_text, "plain")
-        msg["Subject"] = f"Re: {email_obj.subject}"
-        msg["From"] = SMTP_USER
-        msg["To"] = email_obj.sender
-
-        # Send via SMTP
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-            server.starttls()
-            server.login(SMTP_USER, SMTP_PASS)
-            server.sendmail(SMTP_USER, [email_obj.sender], msg.as_string())
-
-        # Mark as replied in DB
-        from datetime import datetime
-        session = SessionLocal()
-        db_email = session.query(Email).get(email_obj.id)
-        db_email.status = "replied"
-        db_email.draft_reply = reply_text  # store final sent reply
-        db_email.date_sent = datetime.now()  # record when reply was sent
-        session.commit()
-        session.close()
+    """Send a reply to the given email now and mark it as replied.
 
+    The reply goes through the outbox and the pooled SMTP connection in sender.py,
+    like batch sends, so clicking Send on many emails reuses one SMTP session.
+    """
+    try:
+        queue_reply(email_obj.id, reply_text)
+        result = send_outbox(email_ids=[email_obj.id])
+        if not result["sent"]:
+            return False
         print(f"✅ Reply sent to {email_obj.sender} for email {email_obj.id}")
         return True
     except Exception as e:
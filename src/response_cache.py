@@ -0,0 +1,188 @@
+"""
+Response cache.
+Reuses a generated draft for near-duplicate emails ("how do I reset my password")
+from the same customer. A draft is written for one person and can quote their
+name, order or account, so entries are scoped to the sender's address. An entry
+is keyed on that scope, the email's embedding and the KB doc ids its retrieval
+returned: a lookup only considers entries with the same scope, exactly the same
+doc ids and generator model, and returns the closest one whose cosine similarity reaches
+RESPONSE_CACHE_THRESHOLD. Entries expire after RESPONSE_CACHE_TTL seconds, the
+least recently used are evicted past RESPONSE_CACHE_MAX_ENTRIES, and sync_index
+drops every entry that referenced a KB doc that was edited or deleted, found
+through the response_cache_docs table.
+"""
+
+import threading
+from datetime import datetime, timedelta
+import numpy as np
+from sqlalchemy import delete, func, insert, select, update
+from db import engine
+from models import ResponseCacheDoc, ResponseCacheEntry
+from config import (GEMINI_MODEL, RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_THRESHOLD, RESPONSE_CACHE_TTL,
+                    RESPONSE_CACHE_MAX_ENTRIES)
+
+_table = ResponseCacheEntry.__table__
+_docs = ResponseCacheDoc.__table__
+# Ids per IN (...) list, well under SQLite's bound-parameter limit
+_IN_CHUNK = 500
+
+
+def doc_key(doc_ids) -> str:
+    """Canonical form of a set of KB doc ids, e.g. [7, 3] -> ",3,7,"."""
+    return "," + ",".join(str(d) for d in sorted(set(doc_ids))) + ","
+
+
+def scope_key(sender) -> str:
+    """Cache scope for an email from `sender`: its address, lowercased."""
+    return (sender or "").strip().lower()
+
+
+def _chunks(ids):
+    ids = list(ids)
+    for i in range(0, len(ids), _IN_CHUNK):
+        yield ids[i:i + _IN_CHUNK]
+
+
+def _delete_entries(conn, entry_ids) -> int:
+    removed = 0
+    for chunk in _chunks(entry_ids):
+        conn.execute(delete(_docs).where(_docs.c.entry_id.in_(chunk)))
+        removed += conn.execute(delete(_table).where(_table.c.id.in_(chunk))).rowcount
+    return removed
+
+
+def _unit(vec):
+    vec = np.asarray(vec, dtype="float32").ravel()
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec
+
+
+class ResponseCache:
+    def __init__(self, threshold=RESPONSE_CACHE_THRESHOLD, ttl=RESPONSE_CACHE_TTL,
+                 max_entries=RESPONSE_CACHE_MAX_ENTRIES, model_name=GEMINI_MODEL, enabled=RESPONSE_CACHE_ENABLED):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.model_name = model_name
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.saved_ms = 0.0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def lookup(self, embedding, doc_ids, scope):
+        """Return the cached draft for a near-identical email in `scope` with the same KB docs, or None."""
+        if not self.enabled:
+            return None
+        query = _unit(embedding)
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        with engine.connect() as conn:
+            rows = conn.execute(
+                select(_table.c.id, _table.c.embedding, _table.c.draft, _table.c.gen_ms)
+                .where(_table.c.scope == scope, _table.c.doc_ids == doc_key(doc_ids),
+                       _table.c.model == self.model_name, _table.c.created_at >= cutoff)
+            ).all()
+        best = None
+        if rows:
+            sims = np.vstack([np.frombuffer(r.embedding, dtype="float32") for r in rows]) @ query
+            i = int(np.argmax(sims))
+            if sims[i] >= self.threshold:
+                best = rows[i]
+        if best is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with engine.begin() as conn:
+            conn.execute(update(_table).where(_table.c.id == best.id)
+                         .values(hits=_table.c.hits + 1, last_used=datetime.utcnow()))
+        with self._lock:
+            self.hits += 1
+            self.saved_ms += best.gen_ms
+        return best.draft
+
+    def store(self, embedding, doc_ids, scope, draft, gen_ms=0.0):
+        """Remember `draft`, generated in `gen_ms` milliseconds, for this embedding, KB docs and scope."""
+        if not self.enabled or not draft:
+            return
+        now = datetime.utcnow()
+        with engine.begin() as conn:
+            entry_id = conn.execute(insert(_table).values(
+                model=self.model_name, scope=scope, doc_ids=doc_key(doc_ids), embedding=_unit(embedding).tobytes(),
+                draft=draft, gen_ms=gen_ms, hits=0, created_at=now, last_used=now,
+            )).inserted_primary_key[0]
+            if doc_ids:
+                conn.execute(insert(_docs), [{"entry_id": entry_id, "doc_id": int(d)} for d in set(doc_ids)])
+        self._evict()
+
+    def _evict(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.ttl)
+        with engine.begin() as conn:
+            expired = conn.execute(select(_table.c.id).where(_table.c.created_at < cutoff)).scalars().all()
+            removed = _delete_entries(conn, expired)
+            excess = conn.execute(select(func.count()).select_from(_table)).scalar_one() - self.max_entries
+            if excess > 0:
+                oldest = conn.execute(select(_table.c.id).order_by(_table.c.last_used).limit(excess)).scalars().all()
+                removed += _delete_entries(conn, oldest)
+        with self._lock:
+            self.evictions += removed
+
+    def invalidate_docs(self, doc_ids, conn=None) -> int:
+        """Drop every entry whose retrieval included one of `doc_ids`.
+
+        With `conn`, the entries are deleted in the caller's transaction.
+        """
+        doc_ids = sorted({int(d) for d in doc_ids})
+        if not doc_ids:
+            return 0
+        if conn is None:
+            with engine.begin() as conn:
+                return self.invalidate_docs(doc_ids, conn)
+        entry_ids = set()
+        for chunk in _chunks(doc_ids):
+            entry_ids.update(conn.execute(select(_docs.c.entry_id).where(_docs.c.doc_id.in_(chunk))).scalars())
+        removed = _delete_entries(conn, sorted(entry_ids))
+        with self._lock:
+            self.invalidations += removed
+        return removed
+
+    def stats(self) -> dict:
+        """Counters for this process, plus lifetime hits and saved time from the stored entries."""
+        with engine.connect() as conn:
+            entries, total_hits, total_saved = conn.execute(
+                select(func.count(), func.coalesce(func.sum(_table.c.hits), 0),
+                       func.coalesce(func.sum(_table.c.hits * _table.c.gen_ms), 0.0))
+            ).one()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_ms": self.saved_ms,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": entries,
+                "lifetime_hits": total_hits,
+                "lifetime_saved_ms": total_saved,
+            }
+
+    def clear(self):
+        with engine.begin() as conn:
+            conn.execute(delete(_docs))
+            conn.execute(delete(_table))
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResponseCache()
+    return _cache
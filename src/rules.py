@@ -0,0 +1,164 @@
+"""
+Keyword Rule Engine
+Scores priority and support category for an email in a single pass over its
+subject and body. Every rule phrase is compiled into one trie-shaped regex
+alternation, tried at every word start, and each match is mapped back to the
+rules that own the phrase. Phrases nested in others still fire: "password"
+within "reset password" is found at its own start, and "reset" through the
+longer phrase it begins.
+
+Rules are dicts (or JSON objects in RULES_PATH) with:
+    phrase    word or phrase to match, case-insensitive, on word boundaries
+    kind      "priority" or "support"
+    weight    score added when the rule fires (default 1.0)
+    category  support category, e.g. "billing" (default "general")
+    team      optional owning team, returned with the fired rules
+    field     "any" (default), "subject" or "body"
+"""
+
+import hashlib
+import json
+import re
+import threading
+from collections import defaultdict
+from typing import NamedTuple
+from config import RULES_PATH, URGENCY_THRESHOLD
+
+DEFAULT_RULES = [
+    {"phrase": "urgent", "kind": "priority"},
+    {"phrase": "immediately", "kind": "priority"},
+    {"phrase": "asap", "kind": "priority"},
+    {"phrase": "critical", "kind": "priority"},
+    {"phrase": "cannot access", "kind": "priority"},
+    {"phrase": "down", "kind": "priority"},
+    {"phrase": "issue", "kind": "priority"},
+    {"phrase": "issues", "kind": "priority"},
+    {"phrase": "support", "kind": "support", "field": "subject"},
+    {"phrase": "query", "kind": "support", "field": "subject"},
+    {"phrase": "request", "kind": "support", "field": "subject"},
+    {"phrase": "help", "kind": "support", "field": "subject"},
+]
+
+
+class Rule(NamedTuple):
+    phrase: str
+    kind: str
+    weight: float = 1.0
+    category: str = "general"
+    team: str = None
+    field: str = "any"
+
+
+class RuleResult(NamedTuple):
+    priority: str
+    priority_score: float
+    support: str
+    category: str
+    fired: list
+
+
+def _normalize(phrase: str) -> str:
+    return " ".join(phrase.lower().split())
+
+
+def _trie_pattern(phrases) -> str:
+    """Build a regex alternation shaped like a trie, so matching at each position
+    walks shared prefixes once instead of trying every phrase in turn."""
+    trie = {}
+    for phrase in phrases:
+        node = trie
+        for ch in phrase:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def build(node):
+        alts = [(r"\s+" if ch == " " else re.escape(ch)) + build(child)
+                for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        group = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        if "" in node:
+            # A phrase ends here but longer ones continue; prefer the longer match
+            return "(?:" + group + ")?"
+        return group
+
+    return build(trie)
+
+
+class RuleEngine:
+    def __init__(self, rules, urgency_threshold=URGENCY_THRESHOLD):
+        self.rules = [Rule(**{**r, "phrase": _normalize(r["phrase"])}) for r in rules]
+        self.urgency_threshold = urgency_threshold
+        self._by_phrase = defaultdict(list)
+        for rule in self.rules:
+            if rule.kind not in ("priority", "support"):
+                raise ValueError(f"Unknown rule kind {rule.kind!r} for phrase {rule.phrase!r}")
+            self._by_phrase[rule.phrase].append(rule)
+        # The match is a zero-width lookahead, so the scan resumes at the next word start
+        # rather than after the match. Matching lowercased text case-sensitively is about
+        # twice as fast as re.I
+        self._pattern = re.compile(r"(?<!\w)(?=(" + _trie_pattern(self._by_phrase) + r")(?!\w))")
+        # Only the longest phrase matches at each start; shorter phrases that begin it and
+        # end on a word boundary match there too
+        self._nested = {
+            phrase: [phrase] + [phrase[:m.start()] for m in re.finditer(r"\W", phrase)
+                                if phrase[:m.start()] in self._by_phrase]
+            for phrase in self._by_phrase
+        }
+        # Changes whenever a rule or the threshold does; part of nlp.analyzer_version()
+        self.fingerprint = hashlib.sha256(json.dumps(
+            [[rule._asdict() for rule in self.rules], self.urgency_threshold], sort_keys=True
+        ).encode("utf-8")).hexdigest()
+
+    def evaluate(self, subject: str, body: str) -> RuleResult:
+        """Match all rules, including overlapping ones, against subject and body in one scan."""
+        subject = (subject or "").lower()
+        text = f"{subject}\n{(body or '').lower()}"
+        subject_end = len(subject)
+
+        fired = {}
+        for m in self._pattern.finditer(text):
+            in_subject = m.start() < subject_end
+            for phrase in self._nested[_normalize(m.group(1))]:
+                for rule in self._by_phrase[phrase]:
+                    if rule.field == "subject" and not in_subject:
+                        continue
+                    if rule.field == "body" and in_subject:
+                        continue
+                    # Each rule counts once per email, however often its phrase repeats
+                    fired.setdefault(rule, None)
+
+        priority_score = sum(r.weight for r in fired if r.kind == "priority")
+        categories = defaultdict(float)
+        for r in fired:
+            if r.kind == "support":
+                categories[r.category] += r.weight
+        category = max(categories, key=categories.get) if categories else None
+
+        return RuleResult(
+            priority="Urgent" if priority_score >= self.urgency_threshold else "Not urgent",
+            priority_score=priority_score,
+            support="Yes" if category else "No",
+            category=category,
+            fired=list(fired),
+        )
+
+
+def load_rules(path=RULES_PATH):
+    if not path:
+        return DEFAULT_RULES
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine() -> RuleEngine:
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = RuleEngine(load_rules())
+    return _engine
@@ -0,0 +1,151 @@
+"""
+Full-text Search
+BM25 keyword search over emails (subject, body) and KB docs (title, content) using
+the SQLite FTS5 tables that init_db() creates and triggers keep in sync. Subject and
+title matches are weighted above body matches. On other databases the email
+search falls back to an unindexed ILIKE scan and KB search returns nothing.
+
+Usage: python search.py "reset password" [--kb] [--page 1]
+       python search.py --rebuild
+"""
+
+import argparse
+import re
+from collections import defaultdict
+from sqlalchemy import text
+from db import engine, read_engine, init_db, rebuild_fts
+from config import RRF_K
+
+# BM25 column weights: (subject, body) and (title, content)
+EMAIL_WEIGHTS = (5.0, 1.0)
+KB_WEIGHTS = (3.0, 1.0)
+# Cap on OR-ed terms when a whole email is used as a KB query
+MAX_QUERY_TERMS = 64
+
+_TERM_RE = re.compile(r'"[^"]+"|\S+')
+
+
+def fts_query(query: str, any_term=False) -> str:
+    """Turn user input into a safe FTS5 query.
+
+    Each whitespace-separated term (or "quoted phrase") becomes a quoted FTS5
+    string, so punctuation such as the dash in an error code E-1042 is matched
+    as a phrase instead of being parsed as query syntax; a trailing * keeps
+    prefix matching. Terms are AND-ed, or OR-ed with any_term=True.
+    """
+    terms = []
+    for raw in _TERM_RE.findall(query or ""):
+        prefix = raw.endswith("*") and not raw.startswith('"')
+        term = raw.strip('"*').replace('"', '""')
+        if not re.search(r"\w", term):
+            continue
+        terms.append(f'"{term}"' + ("*" if prefix else ""))
+    if any_term:
+        terms = list(dict.fromkeys(terms))[:MAX_QUERY_TERMS]
+    return (" OR " if any_term else " ").join(terms)
+
+
+def _fts_available() -> bool:
+    return engine.dialect.name == "sqlite"
+
+
+def _email_match(query, statuses=None):
+    """FROM/WHERE clause and params selecting emails that match `query`, or None for an empty query."""
+    params = {}
+    status_sql = ""
+    if statuses:
+        status_sql = " AND e.status IN (" + ", ".join(f":s{i}" for i in range(len(statuses))) + ")"
+        params.update({f"s{i}": s for i, s in enumerate(statuses)})
+    if not _fts_available():
+        params["like"] = f"%{query}%"
+        return f"FROM emails e WHERE (e.subject ILIKE :like OR e.body ILIKE :like){status_sql}", params
+    params["q"] = fts_query(query)
+    if not params["q"]:
+        return None
+    return f"FROM emails_fts JOIN emails e ON e.rowid = emails_fts.rowid WHERE emails_fts MATCH :q{status_sql}", params
+
+
+def count_matches(query: str, statuses=None) -> int:
+    match = _email_match(query, statuses)
+    if match is None:
+        return 0
+    clause, params = match
+    with read_engine.connect() as conn:
+        return conn.execute(text(f"SELECT COUNT(*) {clause}"), params).scalar_one()
+
+
+def search_emails(query: str, page=1, page_size=25, statuses=None):
+    """Return one page of emails matching `query`, best match first.
+
+    Each hit has id, sender, subject, status, date_received, snippet and score
+    (BM25, higher is better; the ILIKE fallback orders by date and scores 0).
+    """
+    match = _email_match(query, statuses)
+    if match is None:
+        return []
+    clause, params = match
+    params.update(limit=page_size, offset=(max(page, 1) - 1) * page_size)
+    if _fts_available():
+        weights = f"{EMAIL_WEIGHTS[0]}, {EMAIL_WEIGHTS[1]}"
+        columns = (f"snippet(emails_fts, 1, '[', ']', '…', 16) AS snippet, "
+                   f"-bm25(emails_fts, {weights}) AS score")
+        order = f"bm25(emails_fts, {weights})"
+    else:
+        columns = "substr(e.body, 1, 160) AS snippet, 0.0 AS score"
+        order = "e.date_received DESC"
+    with read_engine.connect() as conn:
+        rows = conn.execute(text(
+            f"SELECT e.id, e.sender, e.subject, e.status, e.date_received, {columns} "
+            f"{clause} ORDER BY {order} LIMIT :limit OFFSET :offset"
+        ), params).mappings().all()
+    return [dict(r) for r in rows]
+
+
+def search_kb(query: str, top_k=5, any_term=True):
+    """Return [(doc_id, score)] for the KB docs best matching `query` by BM25 (higher is better).
+
+    any_term=True ORs the terms, which suits using a whole email as the query.
+    """
+    q = fts_query(query, any_term=any_term)
+    if not q or not _fts_available():
+        return []
+    with read_engine.connect() as conn:
+        rows = conn.execute(text(
+            f"SELECT rowid, -bm25(kb_fts, {KB_WEIGHTS[0]}, {KB_WEIGHTS[1]}) AS score FROM kb_fts "
+            f"WHERE kb_fts MATCH :q ORDER BY bm25(kb_fts, {KB_WEIGHTS[0]}, {KB_WEIGHTS[1]}) LIMIT :k"
+        ), {"q": q, "k": top_k}).all()
+    return [(int(doc_id), float(score)) for doc_id, score in rows]
+
+
+def rrf(rankings, top_k, k=RRF_K):
+    """Reciprocal rank fusion: score(d) = sum over rankings of 1 / (k + rank of d).
+
+    `rankings` are lists of doc ids, best first. Returns [(doc_id, fused_score)],
+    best first. Ranks rather than raw scores are fused, so BM25 and L2 distances
+    need no normalisation against each other.
+    """
+    fused = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] += 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Full-text search over emails and KB docs.")
+    parser.add_argument("query", nargs="?")
+    parser.add_argument("--kb", action="store_true", help="search KB docs instead of emails")
+    parser.add_argument("--page", type=int, default=1)
+    parser.add_argument("--rebuild", action="store_true", help="re-index all emails and KB docs")
+    args = parser.parse_args()
+    init_db()
+    if args.rebuild:
+        rebuild_fts(engine)
+        print("✅ Full-text indexes rebuilt.")
+    if args.query and args.kb:
+        for doc_id, score in search_kb(args.query, any_term=False):
+            print(f"{score:8.3f}  KB doc {doc_id}")
+    elif args.query:
+        print(f"{count_matches(args.query)} matching emails (page {args.page})")
+        for hit in search_emails(args.query, page=args.page):
+            print(f"{hit['score']:8.3f}  {hit['id']}  {hit['status']:<9} {hit['subject']!r}\n          {hit['snippet']}")
@@ -0,0 +1,281 @@
+"""
+Reply Sender
+Approved replies are queued in the outbox table and sent in batches over one
+persistent, authenticated SMTP connection, instead of a TLS handshake and login
+per message. The connection is re-checked with NOOP after sitting idle, recycled
+every SMTP_MAX_PER_CONNECTION messages and re-opened once when the server drops
+it mid-batch. Accepted messages are marked sent (and their emails replied) with
+one executemany UPDATE each, flushed every SMTP_MARK_EVERY messages, before the
+connection is recycled and at the end of each batch, so a sender that crashes
+mid-batch re-sends at most SMTP_MARK_EVERY messages.
+
+Rows are claimed with a random token before sending, so several senders can share
+the outbox; a claim older than CLAIM_TIMEOUT (a crashed sender) is released again.
+
+Usage: python sender.py [--batch 50] [--limit N] [--watch SECONDS]
+Try it locally with `python fake_smtp.py` and SMTP_HOST=127.0.0.1 SMTP_PORT=1025 SMTP_STARTTLS=0.
+"""
+
+import argparse
+import smtplib
+import ssl
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+from email.utils import formataddr, make_msgid
+from sqlalchemy import bindparam, delete, func, insert, or_, select, update
+from db import engine, init_db
+from models import Email, OutboxMessage
+from config import (SMTP_HOST, SMTP_PORT, SMTP_USER, SMTP_PASS, SMTP_FROM, SENDER_NAME, SMTP_STARTTLS, SMTP_TIMEOUT,
+                    SMTP_MAX_PER_CONNECTION, SMTP_SEND_BATCH, SMTP_MARK_EVERY, OUTBOX_MAX_ATTEMPTS)
+
+CLAIM_TIMEOUT = timedelta(minutes=10)
+# Probe a connection with NOOP before reuse once it has been idle this long
+IDLE_CHECK_SECONDS = 30
+
+outbox = OutboxMessage.__table__
+emails = Email.__table__
+
+MARK_SENT = (update(outbox).where(outbox.c.id == bindparam("outbox_id"))
+             .values(status="sent", sent_at=bindparam("sent_at"), claim=None))
+MARK_REPLIED = (update(emails).where(emails.c.id == bindparam("email_id"))
+                .values(status="replied", draft_reply=bindparam("reply"), date_sent=bindparam("sent_at")))
+# Earlier messages of the thread that were still waiting are answered by the same reply
+_answered = emails.alias("answered")
+MARK_THREAD_REPLIED = (
+    update(emails)
+    .where(emails.c.thread_id == select(_answered.c.thread_id).where(_answered.c.id == bindparam("email_id"))
+           .scalar_subquery(),
+           emails.c.date_received <= select(_answered.c.date_received).where(_answered.c.id == bindparam("email_id"))
+           .scalar_subquery(),
+           # Not status.in_(): an expanding IN can't be used with executemany
+           or_(emails.c.status == "pending", emails.c.status == "analyzed", emails.c.status == "drafted"))
+    .values(status="replied", date_sent=bindparam("sent_at"))
+)
+MARK_FAILED = (update(outbox).where(outbox.c.id == bindparam("outbox_id"))
+               .values(status=bindparam("new_status"), attempts=outbox.c.attempts + 1,
+                       last_error=bindparam("error"), claim=None))
+
+
+class SMTPConnection:
+    """One lazily opened, reused SMTP session. Thread-safe; sends are serialized."""
+
+    def __init__(self, host=SMTP_HOST, port=SMTP_PORT, user=SMTP_USER, password=SMTP_PASS,
+                 starttls=SMTP_STARTTLS, timeout=SMTP_TIMEOUT, max_per_connection=SMTP_MAX_PER_CONNECTION):
+        self.host, self.port = host, port
+        self.user, self.password = user, password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.max_per_connection = max_per_connection
+        self._lock = threading.Lock()
+        self._smtp = None
+        self._sent_on_conn = 0
+        self._last_used = 0.0
+        self.connects = 0
+
+    def _open(self):
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        smtp.ehlo()
+        if self.starttls:
+            smtp.starttls(context=ssl.create_default_context())
+            smtp.ehlo()
+        if self.user:
+            smtp.login(self.user, self.password)
+        self._smtp, self._sent_on_conn = smtp, 0
+        self.connects += 1
+
+    def _drop(self):
+        smtp, self._smtp = self._smtp, None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except Exception:
+                smtp.close()
+
+    @property
+    def recycle_due(self) -> bool:
+        """True when the next send will close this session and open a new one."""
+        return self._smtp is not None and self._sent_on_conn >= self.max_per_connection
+
+    def _ready(self):
+        if self.recycle_due:
+            self._drop()
+        if self._smtp is not None and time.monotonic() - self._last_used > IDLE_CHECK_SECONDS:
+            try:
+                if self._smtp.noop()[0] != 250:
+                    self._drop()
+            except (smtplib.SMTPException, OSError):
+                self._drop()
+        if self._smtp is None:
+            self._open()
+        return self._smtp
+
+    def send(self, from_addr, to_addrs, message: str):
+        """Send one message, reconnecting once if the server dropped the session."""
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    self._ready().sendmail(from_addr, to_addrs, message)
+                    self._sent_on_conn += 1
+                    self._last_used = time.monotonic()
+                    return
+                except (smtplib.SMTPServerDisconnected, smtplib.SMTPResponseException, OSError) as e:
+                    # Refused recipients/content are the message's fault; only retry connection-level failures
+                    transient = isinstance(e, smtplib.SMTPServerDisconnected) or (
+                        isinstance(e, smtplib.SMTPResponseException) and e.smtp_code == 421
+                    ) or not isinstance(e, smtplib.SMTPException)
+                    if not transient:
+                        raise
+                    self._drop()
+                    if attempt:
+                        raise
+
+    def close(self):
+        with self._lock:
+            self._drop()
+
+
+_connection = None
+_connection_lock = threading.Lock()
+
+
+def get_connection() -> SMTPConnection:
+    global _connection
+    if _connection is None:
+        with _connection_lock:
+            if _connection is None:
+                _connection = SMTPConnection()
+    return _connection
+
+
+def build_message(row) -> MIMEText:
+    msg = MIMEText(row.body, "plain")
+    msg["Subject"] = row.subject if (row.subject or "").lower().startswith("re:") else f"Re: {row.subject}"
+    msg["From"] = formataddr((SENDER_NAME, SMTP_FROM))
+    msg["To"] = row.to_addr
+    msg["Message-ID"] = row.message_id or make_msgid()
+    if row.in_reply_to:
+        msg["In-Reply-To"] = row.in_reply_to
+        # The whole chain, so the customer's client (and threads.py) can find the conversation root
+        msg["References"] = " ".join(filter(None, [row.reference_ids, row.in_reply_to]))
+    return msg
+
+
+def queue_reply(email_id, reply_text) -> int:
+    """Put a reply to `email_id` in the outbox (replacing one still queued) and mark the email approved."""
+    now = datetime.utcnow()
+    with engine.begin() as conn:
+        em = conn.execute(select(emails.c.sender, emails.c.subject, emails.c.message_id, emails.c.reference_ids)
+                          .where(emails.c.id == email_id)).one()
+        conn.execute(delete(outbox).where(outbox.c.email_id == email_id, outbox.c.status == "queued"))
+        outbox_id = conn.execute(insert(outbox).values(
+            email_id=email_id, to_addr=em.sender, subject=em.subject, body=reply_text,
+            in_reply_to=em.message_id, reference_ids=em.reference_ids, message_id=make_msgid(),
+            status="queued", attempts=0, created_at=now,
+        )).inserted_primary_key[0]
+        conn.execute(update(emails).where(emails.c.id == email_id)
+                     .values(status="approved", draft_reply=reply_text))
+    return outbox_id
+
+
+def queued_count() -> int:
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(outbox).where(outbox.c.status == "queued")).scalar_one()
+
+
+def _claim(batch_size, email_ids=None):
+    token = uuid.uuid4().hex
+    now = datetime.utcnow()
+    claimable = or_(outbox.c.status == "queued",
+                    (outbox.c.status == "sending") & (outbox.c.claimed_at < now - CLAIM_TIMEOUT))
+    candidates = select(outbox.c.id).where(claimable).order_by(outbox.c.id).limit(batch_size)
+    if email_ids is not None:
+        candidates = candidates.where(outbox.c.email_id.in_(email_ids))
+    with engine.begin() as conn:
+        # One UPDATE claims the batch, so concurrent senders never get the same row
+        conn.execute(update(outbox).where(outbox.c.id.in_(candidates), claimable)
+                     .values(status="sending", claim=token, claimed_at=now))
+        return conn.execute(select(outbox).where(outbox.c.claim == token).order_by(outbox.c.id)).all()
+
+
+def _mark(done, errors):
+    """Record accepted and failed sends in one transaction."""
+    if not (done or errors):
+        return
+    with engine.begin() as conn:
+        if done:
+            conn.execute(MARK_SENT, done)
+            conn.execute(MARK_REPLIED, done)
+            conn.execute(MARK_THREAD_REPLIED, done)
+        if errors:
+            conn.execute(MARK_FAILED, errors)
+
+
+def send_outbox(batch_size=SMTP_SEND_BATCH, limit=None, email_ids=None, connection=None,
+                mark_every=SMTP_MARK_EVERY) -> dict:
+    """Send queued replies batch by batch over the pooled connection.
+
+    Returns {"sent", "failed", "elapsed", "connects"}. A message that fails is
+    re-queued until OUTBOX_MAX_ATTEMPTS, then marked failed.
+    """
+    connection = connection or get_connection()
+    connects_before = connection.connects
+    sent = failed = 0
+    started = time.perf_counter()
+    while limit is None or sent + failed < limit:
+        size = batch_size if limit is None else min(batch_size, limit - sent - failed)
+        rows = _claim(size, email_ids)
+        if not rows:
+            break
+        done, errors, pending = 0, 0, ([], [])
+        try:
+            for row in rows:
+                if len(pending[0]) >= mark_every or connection.recycle_due:
+                    _mark(*pending)
+                    pending = ([], [])
+                try:
+                    connection.send(SMTP_FROM, [row.to_addr], build_message(row).as_string())
+                except Exception as e:
+                    status = "failed" if row.attempts + 1 >= OUTBOX_MAX_ATTEMPTS else "queued"
+                    pending[1].append({"outbox_id": row.id, "new_status": status, "error": str(e)[:500]})
+                    errors += 1
+                    print(f"❌ Failed to send reply for email {row.email_id}: {e}")
+                    continue
+                pending[0].append({"outbox_id": row.id, "email_id": row.email_id, "reply": row.body,
+                                   "sent_at": datetime.now()})
+                done += 1
+        finally:
+            # Also on the way out of an error, so delivered messages are never re-sent
+            _mark(*pending)
+        sent += done
+        failed += errors
+        elapsed = time.perf_counter() - started
+        print(f"📤 Sent {sent} replies ({sent / elapsed if elapsed else 0:.1f} msg/s), {failed} failed")
+        if errors and email_ids is not None:
+            # A targeted send (one reply from the dashboard) reports the failure instead of retrying
+            break
+
+    elapsed = time.perf_counter() - started
+    if sent:
+        print(f"✅ Outbox flushed: {sent} sent in {elapsed:.1f}s ({sent / elapsed if elapsed else 0:.1f} msg/s), "
+              f"{failed} failed, {connection.connects - connects_before} SMTP connections opened.")
+    return {"sent": sent, "failed": failed, "elapsed": elapsed, "connects": connection.connects - connects_before}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send approved replies from the outbox.")
+    parser.add_argument("--batch", type=int, default=SMTP_SEND_BATCH)
+    parser.add_argument("--limit", type=int, help="max messages to send this run")
+    parser.add_argument("--watch", type=float, help="keep running, checking the outbox every N seconds")
+    args = parser.parse_args()
+    init_db()
+    try:
+        while True:
+            send_outbox(args.batch, args.limit)
+            if not args.watch:
+                break
+            time.sleep(args.watch)
+    finally:
+        get_connection().close()
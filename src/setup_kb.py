@@ -3,7 +3,7 @@ Knowledge Base Setup Script
 Creates sample knowledge base documents for the email support system.
 """
 
-from db import SessionLocal
+from db import SessionLocal, init_db
 from models import KBDoc
 from kb_index import build_index
 
@@ -110,4 +110,5 @@ We review all feature requests monthly and prioritize based on user demand and t
     session.close()
 
 if __name__ == "__main__":
+    init_db()
     create_sample_kb_data()
@@ -0,0 +1,143 @@
+"""
+Email Threads
+Groups messages into conversations by their In-Reply-To/References headers. A
+thread is identified by make_email_id() of its root Message-ID - the first entry
+of References, else In-Reply-To, else the message's own Message-ID - so the root
+message's thread_id is its own id. Rows stored before threading have no
+thread_id and count as threads of their own (thread_key()).
+
+The thread_context table keeps the KB docs retrieved for a conversation's first
+draft. Follow-ups reuse them instead of embedding and searching again, and are
+drafted from what is new in the customer's message plus our last reply, rather
+than the whole quoted history.
+"""
+
+import re
+from datetime import datetime
+from sqlalchemy import select, update
+from db import engine, insert_or_ignore
+from models import Email, OutboxMessage, ThreadContext
+
+MSGID_RE = re.compile(r"<[^<>\s]+>")
+# Where quoted history starts in a reply: "On <date>, <name> wrote:" (possibly wrapped
+# onto two lines), an "Original Message" separator, or an Outlook From:/Sent: block
+QUOTE_START_RE = re.compile(
+    r"^(?:On\b[^\n]{0,200}(?:\n[^\n]{0,200})?\bwrote:[ \t]*$"
+    r"|-{2,}[ \t]*Original Message[ \t]*-{2,}"
+    r"|_{10,}[ \t]*$"
+    r"|From:[^\n]*\n(?:[^\n]*\n)?(?:Sent|Date):)",
+    re.M | re.I,
+)
+QUOTED_LINE_RE = re.compile(r"^[ \t]*>[^\n]*(?:\n|$)", re.M)
+
+emails = Email.__table__
+outbox = OutboxMessage.__table__
+contexts = ThreadContext.__table__
+
+
+def parse_msgids(header) -> list:
+    return MSGID_RE.findall(header or "")
+
+
+def thread_root(message_id, in_reply_to, references):
+    """Message-ID of the conversation a message belongs to."""
+    refs = parse_msgids(references)
+    if refs:
+        return refs[0]
+    parents = parse_msgids(in_reply_to)
+    if parents:
+        return parents[0]
+    return message_id
+
+
+def thread_key(email) -> str:
+    return email.thread_id or email.id
+
+
+def strip_quoted(body: str) -> str:
+    """The new part of a reply: everything before the quoted history, minus "> " lines.
+
+    Returns the body unchanged if nothing would be left (e.g. a forward with no comment).
+    """
+    if not body:
+        return body or ""
+    m = QUOTE_START_RE.search(body)
+    text = body[:m.start()] if m else body
+    text = QUOTED_LINE_RE.sub("", text).strip()
+    return text or body
+
+
+def link_outbox_replies(conn, email_ids):
+    """Move answers to our own replies into the thread of the email we replied to.
+
+    Needed when the customer's client sends In-Reply-To but no References, so the
+    root can't be read from the headers.
+    """
+    if not email_ids:
+        return
+    answered = emails.alias("answered")
+    parent_thread = (
+        select(answered.c.thread_id)
+        .select_from(outbox.join(answered, answered.c.id == outbox.c.email_id))
+        .where(outbox.c.message_id == emails.c.in_reply_to, answered.c.thread_id != None)
+        .limit(1)
+        .scalar_subquery()
+    )
+    conn.execute(
+        update(emails)
+        .where(emails.c.id.in_(email_ids), emails.c.in_reply_to.in_(select(outbox.c.message_id)),
+               parent_thread != None)
+        .values(thread_id=parent_thread)
+    )
+
+
+def load_threads(batch):
+    """Per email (anything with id and thread_id): the conversation state drafting can reuse.
+
+    Returns {"doc_ids": [...] or None, "last_reply": str or None} per email, or None
+    when the thread has neither cached KB context nor an earlier reply of ours.
+    Two queries for the whole batch.
+    """
+    batch = list(batch)
+    keys = {thread_key(em) for em in batch}
+    if not keys:
+        return []
+    with engine.connect() as conn:
+        doc_ids = {row.thread_id: [int(i) for i in row.doc_ids.split(",") if i]
+                   for row in conn.execute(select(contexts.c.thread_id, contexts.c.doc_ids)
+                                           .where(contexts.c.thread_id.in_(keys)))}
+        replies = conn.execute(
+            select(emails.c.id, emails.c.thread_id, emails.c.draft_reply)
+            .where(emails.c.thread_id.in_(keys), emails.c.status == "replied", emails.c.draft_reply != None)
+            .order_by(emails.c.date_sent)
+        ).all()
+    by_thread = {}
+    for row in replies:
+        by_thread.setdefault(row.thread_id, []).append(row)
+    result = []
+    for em in batch:
+        key = thread_key(em)
+        # Rows are ordered by date_sent, so the last one is our latest reply
+        last_reply = next((row.draft_reply for row in reversed(by_thread.get(key, [])) if row.id != em.id), None)
+        ids = doc_ids.get(key)
+        result.append({"doc_ids": ids, "last_reply": last_reply} if ids or last_reply else None)
+    return result
+
+
+def save_thread_contexts(pairs):
+    """Remember the KB doc ids retrieved for each (thread key, [doc ids]); the first retrieval wins."""
+    now = datetime.utcnow()
+    rows = [{"thread_id": key, "doc_ids": ",".join(str(i) for i in ids), "updated_at": now}
+            for key, ids in pairs if ids]
+    if rows:
+        with engine.begin() as conn:
+            conn.execute(insert_or_ignore(contexts), rows)
+
+
+def thread_messages(session, email):
+    """Every message in `email`'s conversation, oldest first."""
+    if not email.thread_id:
+        return [email]
+    return session.execute(
+        select(Email).where(Email.thread_id == email.thread_id).order_by(Email.date_received)
+    ).scalars().all()